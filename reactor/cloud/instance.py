@@ -22,12 +22,13 @@ STATUS_ERROR = False
 
 class Instance(object):
 
-    def __init__(self, instance_id, name, ips, status=STATUS_OKAY):
+    def __init__(self, instance_id, name, ips, status=STATUS_OKAY, created=None):
         super(Instance, self).__init__()
         self._id = str(instance_id)
         self._name = name
         self._ips = ips
         self._status = status
+        self._created = created
 
     @property
     def id(self):
@@ -44,3 +45,8 @@ class Instance(object):
     @property
     def status(self):
         return self._status
+
+    @property
+    def created(self):
+        """ The launch time (seconds since the epoch), if known. """
+        return self._created
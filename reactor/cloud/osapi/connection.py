@@ -15,6 +15,7 @@
 
 import logging
 import time
+import calendar
 
 import email
 from email.mime.multipart import MIMEMultipart
@@ -252,7 +253,14 @@ class BaseOsConnection(CloudConnection):
             # Extract a status.
             status = STATUS_MAP.get(instance._info.get('status'), STATUS_ERROR)
 
-            return Instance(instance_id, name, addresses, status)
+            # Extract the creation time (e.g. 2013-06-10T15:18:22Z).
+            try:
+                created = calendar.timegm(time.strptime(
+                    instance._info.get('created', ''), "%Y-%m-%dT%H:%M:%SZ"))
+            except (TypeError, ValueError):
+                created = None
+
+            return Instance(instance_id, name, addresses, status, created=created)
 
         # Return all sanitizing instances.
         return map(_sanitize, instances)
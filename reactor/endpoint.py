@@ -18,6 +18,7 @@ import socket
 import sys
 import traceback
 import math
+import time
 
 from . import utils
 from . atomic import Atomic
@@ -206,6 +207,31 @@ class ScalingConfig(Config):
             Config.error("Ramp limit must be positive."),
         description="The maximum operations (start and stop instances) per round.")
 
+    warm_pool = Config.integer(label="Warm Standby Instances", default=0, order=2,
+        validate=lambda self: self.warm_pool >= 0 or \
+            Config.error("Warm standby instances must be non-negative."),
+        description="Idle instances kept running beyond what the rules demand" \
+                    + " (grows with pending connections).")
+
+    scale_down = Config.select(label="Scale-down Policy", default="inactive", order=2,
+        options=[
+            ("Inactive first", "inactive"),
+            ("Fewest sessions", "sessions"),
+            ("Youngest first", "youngest"),
+            ("Oldest first", "oldest"),
+            ("Lowest load", "load"),
+            ("Billing boundary", "billing")],
+        description="How instances are chosen for decommissioning (inactive" \
+                    + " instances are always chosen first).")
+
+    scale_down_metric = Config.string(label="Scale-down Load Metric", default="active", order=2,
+        description="The metric used to compare instances for the lowest load policy.")
+
+    billing_period = Config.integer(label="Billing Period", default=3600, order=2,
+        validate=lambda self: self.billing_period > 0 or \
+            Config.error("Billing period must be positive."),
+        description="Seconds per billing unit, for the billing boundary policy.")
+
 def _as_ip(ips):
     if isinstance(ips, list):
         return len(ips) > 0 and ips[0] or "unknown"
@@ -298,6 +324,9 @@ class Endpoint(Atomic):
         self.config = EndpointConfig()
         self.scaling = ScalingConfig()
 
+        # The parsed scaling rules (rebuilt only when the config changes).
+        self.rules = metric_calculator.RuleSet(self.scaling.rules)
+
         # Instances is a cache which maps instances to their names.
         self.instances = Cache(self.zkobj.instances(), update=self._clear_cloud_cache)
 
@@ -402,7 +431,9 @@ class Endpoint(Atomic):
                metrics=None,
                metric_instances=None,
                active_ports=None,
-               update_interval=None):
+               update_interval=None,
+               sketches=None,
+               port_metrics=None):
         """
         Update the endpoint based on current metrics and
         active instances. This will launch new instances or
@@ -414,8 +445,14 @@ class Endpoint(Atomic):
             metric_instances = []
         if active_ports is None:
             active_ports = []
+        if port_metrics is None:
+            port_metrics = {}
 
         try:
+            # Compute any aggregates (percentiles, etc.) used by the rules.
+            metrics = self.rules.derive(
+                metrics, sketches=sketches, elapsed=update_interval)
+
             # Save the live metrics and active connections
             # to the zookeeper backend. These don't serve
             # any practical purpose, they are simply exposed
@@ -447,7 +484,8 @@ class Endpoint(Atomic):
                                 active_ids=active_ids,
                                 inactive_ids=inactive_ids,
                                 metrics=metrics,
-                                metric_instances=metric_instances)
+                                metric_instances=metric_instances,
+                                port_metrics=port_metrics)
 
         except Exception, e:
             traceback.print_exc()
@@ -462,8 +500,7 @@ class Endpoint(Atomic):
 
         # Evaluate the metrics on these instances and get the ideal bounds on
         # the number of servers that should exist.
-        ideal_min, ideal_max = metric_calculator.calculate_ideal_uniform(
-                self.scaling.rules, metrics, num_instances)
+        ideal_min, ideal_max = self.rules.ideal(metrics, num_instances)
         if ideal_max < ideal_min:
             # Either the metrics are undefined or have conflicting answers. We simply
             # return this conflicting result.
@@ -501,11 +538,13 @@ class Endpoint(Atomic):
                 active_ids,
                 inactive_ids,
                 metrics,
-                metric_instances):
+                metric_instances,
+                port_metrics=None):
         """
         Launch new instances, decommission instances, etc.
         """
         # Look only at the current set of instances.
+        cloud_instances = instances
         instances = self._filter_instances(instances, errored=False, decommissioned=False)
         num_instances = len(instances)
         ramp_limit = self.scaling.ramp_limit
@@ -531,6 +570,12 @@ class Endpoint(Atomic):
                 # midpoint in the target range.
                 target = (target_min + target_max) / 2
 
+            # Ensure that we have enough warm spares on top of the
+            # instances that are currently in use. The pool will be
+            # refilled over the next rounds as clients lock instances.
+            target = max(target, self._warm_target(
+                instances, active_ids, metrics, metric_instances))
+
         elif self.state == State.stopped:
             target = 0
             ramp_limit = sys.maxint
@@ -561,8 +606,8 @@ class Endpoint(Atomic):
         elif target < num_instances:
 
             # Build our list of candidates (favoring those that are not active).
-            candidates = list(set(inactive_ids).intersection(instances))
-            candidates.extend(list(set(active_ids).intersection(instances)))
+            candidates = self._scale_down_candidates(
+                cloud_instances, instances, active_ids, inactive_ids, port_metrics)
 
             # Take all the instances that we can.
             to_do = min(len(candidates), ramp_limit, num_instances - target)
@@ -586,6 +631,93 @@ class Endpoint(Atomic):
         except Exception, e:
             self.logging.warn(self.logging.REBALANCE_FAILURE, str(e))
 
+    def _scale_down_candidates(self, cloud_instances, instances,
+                               active_ids, inactive_ids, port_metrics=None):
+        """
+        Returns the instances that may be decommissioned, cheapest first.
+
+        Inactive instances always come before active instances, and each
+        group is ordered according to the configured scale-down policy.
+        """
+        inactive = list(set(inactive_ids).intersection(instances))
+        active = list(set(active_ids).intersection(instances))
+
+        policy = self.scaling.scale_down
+        if policy in ("youngest", "oldest", "billing"):
+            # Cloud connections list instances in launch order, which we
+            # use when the instance does not report its creation time.
+            created = {}
+            position = {}
+            for (i, instance) in enumerate(cloud_instances):
+                created[instance.id] = getattr(instance, "created", None)
+                position[instance.id] = i
+
+            if policy == "billing":
+                # Favor instances that are closest to the end of the
+                # billing unit they have already been charged for.
+                period = self.scaling.billing_period
+                now = time.time()
+                def key(x):
+                    if created.get(x) is None:
+                        return period
+                    return period - ((now - created[x]) % period)
+            else:
+                def key(x):
+                    return (created.get(x) or 0, position.get(x, 0))
+
+            reverse = (policy == "youngest")
+            inactive.sort(key=key, reverse=reverse)
+            active.sort(key=key, reverse=reverse)
+
+        elif policy in ("sessions", "load"):
+            # Map all addresses back to their instances.
+            owners = {}
+            for instance_id in instances:
+                for ip in self.instance_ips.get(instance_id):
+                    owners[ip.split(":")[0]] = instance_id
+
+            counts = {}
+            if policy == "sessions":
+                for backend in self.zkobj.sessions().active_map().values():
+                    instance_id = owners.get(str(backend).split(":")[0])
+                    counts[instance_id] = counts.get(instance_id, 0) + 1
+            else:
+                metric = self.scaling.scale_down_metric
+                for (port, metrics) in (port_metrics or {}).items():
+                    instance_id = owners.get(port.split(":")[0])
+                    load = metric_calculator.calculate_weighted_averages(
+                        metrics).get(metric, 0.0)
+                    counts[instance_id] = counts.get(instance_id, 0.0) + load
+
+            key = lambda x: counts.get(x, 0)
+            inactive.sort(key=key)
+            active.sort(key=key)
+
+        return inactive + active
+
+    def _warm_target(self, instances, active_ids, metrics, metric_instances):
+        """
+        Returns the number of instances required to keep the configured
+        pool of warm standby instances available (or zero if disabled).
+        """
+        if self.scaling.warm_pool <= 0:
+            return 0
+
+        # Instances that are active (i.e. locked by a client or
+        # serving connections) are not considered spares. Any
+        # instance that is booting or confirmed and idle counts.
+        in_use = len(set(active_ids).intersection(instances))
+
+        # Every pending connection is a client that is waiting for
+        # an instance right now, so we grow the pool to match. Note
+        # that the manager scales the pending metric by the number
+        # of metric instances, so we undo that here.
+        pending = metrics.get("pending", 0.0) * (metric_instances or 1)
+        spares = self.scaling.warm_pool + int(math.ceil(pending))
+
+        # The pool never pushes us over the configured maximum.
+        return min(in_use + spares, self.scaling.max_instances)
+
     def session_opened(self, client, backend):
         self.zkobj.sessions().opened(client, backend)
 
@@ -652,6 +784,8 @@ class Endpoint(Atomic):
         # Reload the configuration.
         self.config = new_config
         self.scaling = new_scaling
+        if self.rules.rules != new_scaling.rules:
+            self.rules = metric_calculator.RuleSet(new_scaling.rules)
 
         # We can't really know if loadbalancer settings
         # have changed in the backend, so we really need
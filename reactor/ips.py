@@ -15,6 +15,9 @@
 
 import re
 import socket
+import struct
+import bisect
+import logging
 import platform
 import subprocess
 
@@ -45,6 +48,62 @@ def any_local(hosts):
 def find_global():
     return [x for x in list_local_ips() if is_public(x)]
 
+def _pack_address(address):
+    # Returns (version, integer value) for an address string.
+    try:
+        return (4, struct.unpack("!I", socket.inet_pton(socket.AF_INET, address))[0])
+    except (socket.error, TypeError, ValueError):
+        pass
+    try:
+        (high, low) = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6, address))
+        return (6, (high << 64) | low)
+    except (socket.error, TypeError, ValueError):
+        return (None, None)
+
+class SubnetSet(object):
+
+    """
+    A set of subnets, compiled for fast membership tests.
+
+    The subnets are merged into sorted, non-overlapping integer intervals
+    (one list per address family), so checking an address is a single
+    binary search on its packed value rather than a scan of every subnet.
+    """
+
+    def __init__(self, subnets):
+        super(SubnetSet, self).__init__()
+        from netaddr import IPNetwork, AddrFormatError
+
+        ranges = { 4 : [], 6 : [] }
+        for subnet in subnets:
+            try:
+                network = IPNetwork(str(subnet))
+            except (AddrFormatError, ValueError, TypeError):
+                # NOTE: An invalid subnet matches nothing (it does
+                # not widen the set), so we can safely ignore it.
+                logging.warning("Ignoring invalid subnet: %s", subnet)
+                continue
+            ranges[network.version].append((network.first, network.last))
+
+        self._starts = {}
+        self._ends = {}
+        for (version, intervals) in ranges.items():
+            merged = []
+            for (first, last) in sorted(intervals):
+                if merged and first <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], last)
+                else:
+                    merged.append([first, last])
+            self._starts[version] = [first for (first, _) in merged]
+            self._ends[version] = [last for (_, last) in merged]
+
+    def __contains__(self, address):
+        (version, value) = _pack_address(address)
+        if version is None:
+            return False
+        index = bisect.bisect_right(self._starts[version], value) - 1
+        return index >= 0 and value <= self._ends[version][index]
+
 def find_default_darwin():
     from netaddr import IPAddress, IPNetwork
     from netifaces import interfaces, ifaddresses, AF_INET
@@ -0,0 +1,160 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Background collection of loadbalancer metrics.
+
+Each source is a function returning metrics in the usual form,
+    { "host:port" : [ { key : (weight, value) }, ... ] }
+which is run in its own thread. Every call to metrics() returns the
+samples finished since the last call, and asks each source for a new
+one. So sources still sample once per call (many of them read and reset
+counters, and each sample should cover one interval), but a slow source
+can't hold up metrics(). Its sample is just returned by a later call.
+The first sample is taken when the source is registered, so that the
+first call has something to return.
+
+Sources which only read our own state (and so can't be slow) may be
+registered with background=False, and are then read by metrics() itself.
+
+Samples are handed over through a deque, which the source only appends
+to and the collector only pops from, so neither ever waits on the other.
+"""
+
+import logging
+import weakref
+import threading
+import collections
+
+# How often (in seconds) an idle source checks that its object is alive.
+IDLE_CHECK = 5.0
+
+# The most samples kept for each source (if nobody is asking).
+MAX_SAMPLES = 16
+
+class MetricsSource(object):
+
+    def __init__(self, name, collect):
+        super(MetricsSource, self).__init__()
+        self.name = name
+        self.samples = collections.deque(maxlen=MAX_SAMPLES)
+        self.thread = None
+        self.trigger = threading.Event()
+        self.stopped = threading.Event()
+
+        # Bound methods are held weakly, so that the source doesn't
+        # keep its object (a loadbalancer connection) alive forever.
+        if getattr(collect, "im_self", None) is not None:
+            self.obj = weakref.ref(collect.im_self)
+            self.func = collect.im_func
+        else:
+            self.obj = None
+            self.func = collect
+
+    def collect(self):
+        # Returns a sample, or None if the object is gone.
+        if self.obj is None:
+            return self.func()
+        obj = self.obj()
+        if obj is None:
+            return None
+        return self.func(obj)
+
+    def alive(self):
+        return self.obj is None or self.obj() is not None
+
+    def sample(self):
+        """ Returns a new sample (as a list, empty if there is none). """
+        try:
+            sample = self.collect()
+        except Exception:
+            logging.exception("Unable to collect metrics from %s.", self.name)
+            return []
+        if sample is None:
+            return []
+        return [sample]
+
+    def request(self):
+        """ Asks for a new sample (if one isn't already being taken). """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run,
+                name="metrics-%s" % self.name)
+            self.thread.daemon = True
+            self.thread.start()
+        self.trigger.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.trigger.set()
+
+    def run(self):
+        while not self.stopped.isSet() and self.alive():
+            if not self.trigger.wait(IDLE_CHECK):
+                continue
+            self.trigger.clear()
+            if self.stopped.isSet():
+                break
+            self.samples.extend(self.sample())
+
+    def swap(self):
+        """ Returns the samples finished since the last swap. """
+        samples = []
+        while True:
+            try:
+                samples.append(self.samples.popleft())
+            except IndexError:
+                break
+        return samples
+
+class MetricsCollector(object):
+
+    def __init__(self, name=None):
+        super(MetricsCollector, self).__init__()
+        self.name = name
+        self.sources = []
+        self.direct = []
+
+    def register(self, name, collect, background=True):
+        """
+        Adds a source of metrics, where collect() is called once for
+        each call to metrics() (in the background, unless asked not to).
+        """
+        if self.name:
+            name = "%s-%s" % (self.name, name)
+        source = MetricsSource(name, collect)
+        if background:
+            self.sources.append(source)
+            source.request()
+        else:
+            self.direct.append(source)
+        return source
+
+    def stop(self):
+        for source in self.sources:
+            source.stop()
+
+    def metrics(self):
+        """ Returns the samples from all sources since the last call. """
+        results = {}
+        for source in self.sources:
+            for sample in source.swap():
+                for (host, metrics) in sample.items():
+                    results.setdefault(host, []).extend(metrics)
+            source.request()
+        for source in self.direct:
+            for sample in source.sample():
+                for (host, metrics) in sample.items():
+                    results.setdefault(host, []).extend(metrics)
+        return results
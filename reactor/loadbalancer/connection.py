@@ -17,9 +17,14 @@
 The generic load balancer interface.
 """
 import re
+import time
+import logging
+import threading
 
 from reactor import utils
+from reactor.atomic import Atomic
 from reactor.config import Connection
+from reactor.loadbalancer.collector import MetricsCollector
 
 def get_connection(name, **kwargs):
     if not name:
@@ -45,6 +50,13 @@ class LoadBalancerConnection(Connection):
         ".*" : lambda m: m.group(0)
     }
 
+    # The time (in seconds) for which save() calls are coalesced.
+    # If this is zero, every save() is written out immediately.
+    _SAVE_DELAY = 0.0
+
+    # Set in __init__ (but __del__ may run without it).
+    collector = None
+
     def __init__(self,
         name,
         config=None,
@@ -55,6 +67,23 @@ class LoadBalancerConnection(Connection):
 
         super(LoadBalancerConnection, self).__init__(
             object_class="loadbalancer", name=name, config=config)
+        self._save_timer = None
+        self._saved = None
+
+        # Reload statistics (see reload_stats()).
+        self.reloads = 0
+        self.unchanged = 0
+        self.coalesced = 0
+        self.reload_time = None
+
+        # Drivers register their metrics sources here.
+        self.collector = MetricsCollector(name)
+
+    def __del__(self):
+        # Stop sampling (the sources only hold us weakly,
+        # but their threads would otherwise linger).
+        if self.collector is not None:
+            self.collector.stop()
 
     def url_info(self, url):
         if url is None:
@@ -80,18 +109,82 @@ class LoadBalancerConnection(Connection):
     def save(self):
         """
         Save current set of specified mappings.
+
+        The output of _render() is committed (see _commit()) only if it
+        has changed since the last save. Calls made within _SAVE_DELAY of
+        each other are coalesced into a single render.
+        """
+        if self._SAVE_DELAY > 0:
+            self._schedule()
+        else:
+            self._flush()
+
+    @Atomic.sync
+    def _schedule(self):
+        if self._save_timer is not None:
+            # Already pending.
+            self.coalesced += 1
+            return
+        self._save_timer = threading.Timer(self._SAVE_DELAY, self._flush_pending)
+        self._save_timer.daemon = True
+        self._save_timer.start()
+
+    def _flush_pending(self):
+        try:
+            self._flush()
+        except Exception:
+            logging.exception("Unable to save loadbalancer %s.", self._name)
+
+    @Atomic.sync
+    def _flush(self):
+        # Any save() from now on needs another render.
+        self._save_timer = None
+
+        output = self._render()
+        digest = utils.sha_hash(output)
+        if digest == self._saved:
+            self.unchanged += 1
+            return
+
+        start = time.time()
+        self._commit(output)
+        self._saved = digest
+        self.reloads += 1
+        self.reload_time = time.time() - start
+
+    def _render(self):
+        """
+        Returns the output (a string) for the current set of mappings.
+        """
+        return ""
+
+    def _commit(self, output):
+        """
+        Writes out the rendered output, and reloads as necessary.
         """
         pass
 
+    @Atomic.sync
+    def reload_stats(self):
+        """
+        Returns (reloads, unchanged, coalesced, last reload time), where
+        unchanged saves are those that were skipped as nothing changed.
+        """
+        return (self.reloads, self.unchanged, self.coalesced, self.reload_time)
+
     def dropped(self, ip):
         pass
 
     def metrics(self):
         """
         Returns metrics as a dictionary --
-            { "host:port" : (weight, value) }
+            { "host:port" : [ { key : (weight, value) }, ... ] }
+
+        These are sampled in the background, by the sources registered
+        with the collector, so this never waits on the loadbalancer. Each
+        call returns the samples finished since the last, and asks for more.
         """
-        return {}
+        return self.collector.metrics()
 
     def pending(self):
         """
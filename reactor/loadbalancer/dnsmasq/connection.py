@@ -14,15 +14,21 @@
 #    under the License.
 
 import os
+import glob
+import time
 import signal
+import logging
+import threading
 import subprocess
 
 from mako.template import Template
 
+from reactor.atomic import Atomic
 from reactor.config import Config
 from reactor.loadbalancer.connection import LoadBalancerConnection
 from reactor.loadbalancer.utils import read_pid
 from reactor.loadbalancer.utils import binary_exists
+from reactor.loadbalancer.utils import write_atomic
 
 class DnsmasqManagerConfig(Config):
 
@@ -36,6 +42,11 @@ class DnsmasqManagerConfig(Config):
     hosts_path = Config.string(label="Site Config Path", default="/etc/hosts.reactor", \
         description="The directory in which to generate site configurations.")
 
+    hosts_dir = Config.string(label="Hosts directory", default="", \
+        description="If set, a hosts file is generated in this directory " +
+                    "for each name (instead of one file at the hosts path), " +
+                    "so only the names that change are rewritten.")
+
 class Connection(LoadBalancerConnection):
 
     """ Dnsmasq """
@@ -45,6 +56,12 @@ class Connection(LoadBalancerConnection):
         "dns://([a-zA-Z0-9]+[a-zA-Z0-9.]*)" : lambda m: m.group(1)
     }
 
+    # Coalesce bursts of changes into one reload.
+    _SAVE_DELAY = 1.0
+
+    # The shortest time (in seconds) between reloads.
+    _RELOAD_INTERVAL = 5.0
+
     def __init__(self, **kwargs):
         super(Connection, self).__init__(**kwargs)
 
@@ -60,6 +77,24 @@ class Connection(LoadBalancerConnection):
         self.template = Template(filename=template_file)
         self.ipmappings = {}
 
+        # The contents of the files we've written (by path).
+        self.written = {}
+
+        # The last reload, and the pending one (if any).
+        self.last_reload = None
+        self.reload_timer = None
+
+        if kwargs.get('zkobj') is not None:
+            # Remove any host files left over from before.
+            hosts_dir = self._manager_config().hosts_dir
+            if hosts_dir:
+                for hosts in glob.glob(os.path.join(hosts_dir, "reactor.*")):
+                    try:
+                        os.remove(hosts)
+                    except OSError:
+                        pass
+
+    @Atomic.sync
     def change(self, url, backends, config=None):
         # Save the mappings.
         name = self.url_info(url)
@@ -69,7 +104,7 @@ class Connection(LoadBalancerConnection):
         else:
             self.ipmappings[name] = backends
 
-    def save(self):
+    def _render(self):
         # Compute the address mapping.
         # NOTE: We do not currently support the weight parameter
         # for dns-based loadbalancer. This may be implemented in
@@ -81,20 +116,88 @@ class Connection(LoadBalancerConnection):
                     ipmap[backend.ip] = []
                 ipmap[backend.ip].append(name)
 
-        # Write out our hosts file.
-        hosts = open(self._manager_config().hosts_path, 'wb')
-        for (address, names) in ipmap.items():
-            for name in set(names):
-                hosts.write("%s %s\n" % (address, name))
-        hosts.close()
-
-        # Write out our configuration template.
-        conf = self.template.render(hosts=self._manager_config().hosts_path)
-
-        # Write out the config file.
-        config_file = file(os.path.join(self._manager_config().config_path, "reactor.conf"), 'wb')
-        config_file.write(conf)
-        config_file.close()
+        # Generate our hosts file (in a stable order).
+        lines = []
+        for (address, names) in sorted(ipmap.items()):
+            for name in sorted(set(names)):
+                lines.append("%s %s\n" % (address, name))
+        return "".join(lines)
+
+    def _write(self, path, data):
+        # Write the file (if it has changed), and return True if written.
+        if self.written.get(path) == data:
+            return False
+        write_atomic(path, data)
+        self.written[path] = data
+        return True
+
+    def _write_hosts_dir(self, hosts_dir):
+        # Write one file per name, and remove the files for old names.
+        names = {}
+        for (name, backends) in self.ipmappings.items():
+            names[os.path.join(hosts_dir, "reactor.%s" % name)] = "".join(
+                ["%s %s\n" % (ip, name)
+                 for ip in sorted(set([backend.ip for backend in backends]))])
+
+        changed = False
+        for (path, data) in sorted(names.items()):
+            if self._write(path, data):
+                changed = True
+        for path in self.written.keys():
+            if os.path.dirname(path) == hosts_dir and not path in names:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                del self.written[path]
+                changed = True
+        return changed
+
+    def _commit(self, hosts_data):
+        config = self._manager_config()
+
+        # Write out our hosts file(s).
+        if config.hosts_dir:
+            hosts = config.hosts_dir
+            changed = self._write_hosts_dir(hosts)
+        else:
+            hosts = config.hosts_path
+            changed = self._write(hosts, hosts_data)
+
+        # Write out the config file (if it has changed).
+        conf = self.template.render(hosts=hosts)
+        if self._write(os.path.join(config.config_path, "reactor.conf"), conf):
+            changed = True
+
+        if changed:
+            self._reload()
+
+    def _reload(self):
+        if self.reload_timer is not None:
+            # Already pending.
+            return
+
+        # Don't reload more than once every interval.
+        if self.last_reload is not None:
+            delay = self.last_reload + self._RELOAD_INTERVAL - time.time()
+            if delay > 0:
+                self.reload_timer = threading.Timer(delay, self._reload_pending)
+                self.reload_timer.daemon = True
+                self.reload_timer.start()
+                return
+
+        self._signal()
+
+    @Atomic.sync
+    def _reload_pending(self):
+        self.reload_timer = None
+        try:
+            self._signal()
+        except Exception:
+            logging.exception("Unable to reload dnsmasq.")
+
+    def _signal(self):
+        self.last_reload = time.time()
 
         # Send a signal to dnsmasq to reload the configuration
         # (Note: we might need permission to do this!!).
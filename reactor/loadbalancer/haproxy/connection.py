@@ -14,16 +14,39 @@
 #    under the License.
 
 import hashlib
+import logging
 import os
 import subprocess
 
 from mako.template import Template
 
 from reactor import utils
+from reactor.atomic import Atomic
 from reactor.config import Config
 from reactor.loadbalancer.connection import LoadBalancerConnection
 from reactor.loadbalancer.utils import read_pid
 from reactor.loadbalancer.utils import binary_exists
+from reactor.loadbalancer.utils import FragmentCache
+from reactor.loadbalancer.haproxy.stats import StatsSocket
+from reactor.loadbalancer.haproxy.stats import StatsParser
+
+# The template (and the backend fragments within it).
+TEMPLATE = Template(filename=os.path.join(os.path.dirname(__file__), 'haproxy.template'))
+HTTP_BACKEND = TEMPLATE.get_def("http_backend")
+TCP_BACKEND = TEMPLATE.get_def("tcp_backend")
+
+# The cookie shared by all servers when sessions aren't sticky.
+NOSTICKY_COOKIE = hashlib.md5("nosticky").hexdigest()
+
+# The address of unused server slots (which are disabled).
+EMPTY_SLOT = "127.0.0.1:1"
+
+# Responses (besides an empty one) that mean a command worked.
+_ACCEPTED = ("IP changed", "no need to change")
+
+@utils.memoize(size=4096)
+def _cookie(ip, port):
+    return hashlib.md5("%s:%d" % (ip, port)).hexdigest()
 
 class HaproxyManagerConfig(Config):
 
@@ -59,6 +82,13 @@ class HaproxyManagerConfig(Config):
         default=50000,
         description="Client connection timeout.")
 
+    server_slots = Config.integer(label="Server slots",
+        default=0,
+        description="The number of servers pre-allocated for each backend. " +
+                    "If set, backends are changed through the stats socket " +
+                    "and HAProxy is only restarted when the frontends change " +
+                    "or a backend outgrows its slots.")
+
 class HaproxyEndpointConfig(Config):
 
     balance = Config.select(label="Loadbalancing mode",
@@ -102,15 +132,32 @@ class Connection(LoadBalancerConnection):
             lambda m: (m.group(1), None, m.group(2)),
     }
 
+    # Coalesce bursts of changes into one restart.
+    _SAVE_DELAY = 1.0
+
     def __init__(self, **kwargs):
         super(Connection, self).__init__(**kwargs)
-        template_file = os.path.join(os.path.dirname(__file__), 'haproxy.template')
-        self.template = Template(filename=template_file)
+        self.template = TEMPLATE
+        self.fragments = FragmentCache()
         self.frontends = {}
         self.http_backends = {}
         self.tcp_backends = {}
         self.error_notify = utils.callback(kwargs.get("error_notify"))
+        self.stats = None
+        self.stats_parser = StatsParser()
+
+        # The servers in each slot ([ (server, weight) or None ]), as
+        # they should be and as they are in the running HAProxy. Along
+        # with the layout of each backend (everything but its servers),
+        # this lets us know when a restart is really needed.
+        self.slots = {}
+        self.applied = {}
+        self.layouts = {}
+        self.layout = None
 
+        self.collector.register("stats", self._collect_metrics)
+
+    @Atomic.sync
     def change(self, url, backends, config=None):
         # We use a simple hash of the URL as the backend key.
         hash_fn = hashlib.new('md5')
@@ -133,7 +180,8 @@ class Connection(LoadBalancerConnection):
             backend_map = self.tcp_backends
 
         # Clear the frontend.
-        if listen in self.frontends:
+        if listen in self.frontends and \
+           (netloc, uniq_id) in self.frontends[listen][1]:
             self.frontends[listen][1].remove((netloc, uniq_id))
             if len(self.frontends[listen][1]) == 0:
                 del self.frontends[listen]
@@ -144,8 +192,10 @@ class Connection(LoadBalancerConnection):
                 return
 
             # Pull out the backend.
-            (ipspecs) = backend_map[uniq_id]
             del backend_map[uniq_id]
+            self.fragments.remove(uniq_id)
+            self.slots.pop(uniq_id, None)
+            self.layouts.pop(uniq_id, None)
             return
 
         # Check for a conflict (default HTTP and TCP on same port).
@@ -154,36 +204,146 @@ class Connection(LoadBalancerConnection):
 
         # Grab the backend configuration.
         config = self._endpoint_config(config)
-        ipspecs = []
-        for backend in backends:
-            if config.sticky:
-                hash_fn = hashlib.new('md5')
-                hash_fn.update("%s:%d" % (backend.ip, backend.port))
-                cookie = hash_fn.hexdigest()
-            else:
-                hash_fn = hashlib.new('md5')
-                hash_fn.update("nosticky")
-                cookie = hash_fn.hexdigest()
-            ipspecs.append("server %s:%d %s:%d weight %d cookie %s check" % \
-                (backend.ip, backend.port, backend.ip, backend.port, backend.weight, cookie))
+        server_slots = self._manager_config().server_slots
+        if server_slots > 0:
+            ipspecs = self._slot_specs(uniq_id, backends, server_slots, config.sticky)
+        else:
+            self.slots.pop(uniq_id, None)
+            ipspecs = []
+            for backend in backends:
+                if config.sticky:
+                    cookie = _cookie(backend.ip, backend.port)
+                else:
+                    cookie = NOSTICKY_COOKIE
+                ipspecs.append("server %s:%d %s:%d weight %d cookie %s check" % \
+                    (backend.ip, backend.port, backend.ip, backend.port, backend.weight, cookie))
+
+        # Everything but the servers themselves.
+        self.layouts[uniq_id] = (scheme, config.balance, config.check_url,
+            config.errorloc, config.contimeout, config.srvtimeout,
+            config.sticky, len(self.slots.get(uniq_id, [])))
 
         # Add it to our list of backends and frontends.
         if not listen in self.frontends:
             self.frontends[listen] = (scheme, [])
         self.frontends[listen][1].append((netloc, uniq_id))
-        backend_map[uniq_id] = (config, ipspecs)
 
-    def save(self):
+        # Render the backend (unless it is unchanged).
+        if scheme == "http":
+            backend_map[uniq_id] = self.fragments.render(uniq_id,
+                HTTP_BACKEND.render,
+                backend=uniq_id,
+                balance=config.balance,
+                check_url=config.check_url,
+                errorloc=config.errorloc,
+                contimeout=config.contimeout,
+                srvtimeout=config.srvtimeout,
+                servers=ipspecs)
+        else:
+            backend_map[uniq_id] = self.fragments.render(uniq_id,
+                TCP_BACKEND.render,
+                backend=uniq_id,
+                balance=config.balance,
+                servers=ipspecs)
+
+    def _slot_specs(self, uniq_id, backends, server_slots, sticky):
+        current = self.slots.get(uniq_id, [])
+        wanted = dict([("%s:%d" % (backend.ip, backend.port), backend.weight)
+                       for backend in backends])
+
+        # Slots are only ever added (in blocks), so that the servers can
+        # be shuffled around without changing the layout of the backend.
+        size = max(len(current), server_slots)
+        while size < len(wanted):
+            size += server_slots
+
+        # Keep existing servers where they are, and fill in the gaps.
+        slots = [None] * size
+        for (index, slot) in enumerate(current):
+            if slot is not None and slot[0] in wanted:
+                slots[index] = (slot[0], wanted.pop(slot[0]))
+        free = [index for index in range(size) if slots[index] is None]
+        for (index, server) in zip(free, sorted(wanted.keys())):
+            slots[index] = (server, wanted[server])
+        self.slots[uniq_id] = slots
+
+        # The cookie follows the slot, since the slot is the server.
+        ipspecs = []
+        for (index, slot) in enumerate(slots):
+            if sticky:
+                cookie = _cookie(uniq_id, index)
+            else:
+                cookie = NOSTICKY_COOKIE
+            if slot is None:
+                ipspecs.append("server s%d %s weight 0 cookie %s check disabled" % \
+                    (index, EMPTY_SLOT, cookie))
+            else:
+                ipspecs.append("server s%d %s weight %d cookie %s check" % \
+                    (index, slot[0], slot[1], cookie))
+        return ipspecs
+
+    def _layout(self):
+        return repr((
+            sorted([(port, mode, sorted(backends))
+                    for (port, (mode, backends)) in self.frontends.items()]),
+            sorted(self.layouts.items())))
+
+    def _update_servers(self):
+        # Bring the servers in the running HAProxy in line with the slots,
+        # and return True if all the commands were accepted.
+        commands = []
+        for (uniq_id, slots) in sorted(self.slots.items()):
+            applied = self.applied.get(uniq_id, [])
+            for (index, slot) in enumerate(slots):
+                if index < len(applied):
+                    current = applied[index]
+                else:
+                    current = None
+                if slot == current:
+                    continue
+                name = "%s/s%d" % (uniq_id, index)
+                if slot is None:
+                    commands.append("disable server %s" % name)
+                    continue
+                (server, weight) = slot
+                if current is None or current[0] != server:
+                    (ip, port) = server.rsplit(":", 1)
+                    commands.append("set server %s addr %s port %s" % (name, ip, port))
+                commands.append("set weight %s %d" % (name, weight))
+                if current is None:
+                    commands.append("enable server %s" % name)
+
+        if commands:
+            responses = self._stats_socket().command(*commands)
+            if responses is None:
+                return False
+            for (command, response) in zip(commands, responses):
+                response = response.strip()
+                if response and not response.startswith(_ACCEPTED):
+                    logging.warn("HAProxy rejected '%s': %s", command, response)
+                    return False
+
+        self.applied = dict(self.slots)
+        return True
+
+    def _render(self):
         # Render our given template.
         config = self._manager_config()
-        conf = self.template.render(global_opts=config.global_opts,
+        return self.template.render(global_opts=config.global_opts,
                                     maxconn=config.maxconn,
                                     clitimeout=config.clitimeout,
                                     stats_path=config.stats_path,
                                     stats_mode=config.stats_mode,
+                                    stats_admin=config.server_slots > 0,
                                     frontends=self.frontends,
-                                    http_backends=self.http_backends,
-                                    tcp_backends=self.tcp_backends)
+                                    backend_configs="".join(
+                                        [self.http_backends[uniq_id]
+                                         for uniq_id in sorted(self.http_backends.keys())] +
+                                        [self.tcp_backends[uniq_id]
+                                         for uniq_id in sorted(self.tcp_backends.keys())]))
+
+    def _commit(self, conf):
+        config = self._manager_config()
 
         # Write out the config file.
         config_file = file(config.config_file, 'wb')
@@ -191,8 +351,16 @@ class Connection(LoadBalancerConnection):
         config_file.flush()
         config_file.close()
 
-        # Restart gently.
+        # If only the servers have changed, there's no need to restart.
+        layout = self._layout()
         pid = read_pid(config.pid_file)
+        if config.server_slots > 0 and pid and \
+           layout == self.layout and self._update_servers():
+            return
+        self.layout = layout
+        self.applied = dict(self.slots)
+
+        # Restart gently.
         if len(self.frontends) > 0:
             if pid:
                 subprocess.call([
@@ -217,63 +385,47 @@ class Connection(LoadBalancerConnection):
                     ["service", "haproxy", "stop"],
                     close_fds=True)
 
-    def _sock_command(self, command):
-        if not os.path.exists(self._manager_config().stats_path):
+    @Atomic.sync
+    def _stats_socket(self):
+        # Reconnect if the path has changed.
+        path = self._manager_config().stats_path
+        if self.stats is None or self.stats.path != path:
+            if self.stats is not None:
+                self.stats.close()
+            self.stats = StatsSocket(path)
+        return self.stats
+
+    @Atomic.sync
+    def _slot_names(self):
+        # Map each slot in the running HAProxy back to its server (or None).
+        # The slots are copied under the lock, as change() replaces them.
+        applied = dict(self.applied)
+        if not applied:
             return None
-        socat = subprocess.Popen([
-            "socat",
-            "stdio",
-            "unix-connect:%s" % self._manager_config().stats_path],
-            close_fds=True,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE)
-        (stdout, _) = socat.communicate(command + '\n')
-        if socat.returncode != 0:
-            return None
-        return stdout.split("\n")
+        names = {}
+        for (uniq_id, slots) in applied.items():
+            for (index, slot) in enumerate(slots):
+                names[(uniq_id, "s%d" % index)] = slot and slot[0]
+        return names
+
+    def _collect_metrics(self):
+        # Name the slots before dumping them (from what HAProxy is
+        # actually running, rather than what we'd like it to run).
+        names = self._slot_names()
 
-    def metrics(self):
         # Dump all proxyIds, server objects, all serverIds.
-        output = self._sock_command("show stat -1 4 -1")
+        # (And reset the counters for next time.)
+        output = self._stats_socket().command(
+            "show stat -1 4 -1",
+            "clear counters all")
         if not output:
             return {}
 
-        # Reset counters for next time.
-        self._sock_command("clear counters all")
-
-        # Header is prefixed with '# '.
-        header = output[0].strip()[2:]
-        keys = header.split(",")
-        data_keys = keys[2:]
-
-        results = {}
-
-        for line in output[1:]:
-            # Skip blank lines.
-            line = line.strip()
-            if not line:
-                continue
-
-            # Slice the csv.
-            chunks = line.split(",")
-            port = chunks[1]
-
-            # Extract all legimate keys.
-            # (Obviously all keys are okay, but we can
-            # only really aggregate the integer-based keys.)
-            all_data = dict(zip(data_keys, chunks[2:]))
-            def is_int(v):
-                try:
-                    int(v)
-                    return True
-                except (TypeError, ValueError):
-                    return False
-            valid_data = dict([(k, int(v)) for (k, v) in all_data.items() if is_int(v)])
-            results[port] = [valid_data]
+        (results, down) = self.stats_parser.parse(output[0], names)
 
-            # Notify errors if status is DOWN.
-            if all_data.get('status') == 'DOWN':
-                self.error_notify(port)
+        # Notify errors if status is DOWN.
+        for port in down:
+            self.error_notify(port)
 
         return results
 
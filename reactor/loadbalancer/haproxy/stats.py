@@ -0,0 +1,195 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A client for the HAProxy stats socket.
+
+The connection is kept open in interactive ("prompt") mode, where every
+response is followed by a "> " prompt. This lets several commands be sent
+at once, and read back in order, over a single connection.
+"""
+
+import socket
+import logging
+
+from reactor.atomic import Atomic
+
+# The size of each read from the socket.
+READ_SIZE = 65536
+
+class StatsSocket(Atomic):
+
+    def __init__(self, path, timeout=5.0):
+        super(StatsSocket, self).__init__()
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = ""
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+        self.buffer = ""
+
+        # Switch to interactive mode, and wait for the first prompt.
+        self.sock.sendall("prompt\n")
+        self._read(1)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.buffer = ""
+
+    @staticmethod
+    def _split(data):
+        # Returns the complete responses in data, and what is left over.
+        # Each response is terminated by a prompt at the start of a line.
+        responses = []
+        start = 0
+        while True:
+            if data.startswith("> ", start):
+                index = start
+            else:
+                index = data.find("\n> ", start)
+                if index < 0:
+                    break
+                index += 1
+            responses.append(data[start:index])
+            start = index + 2
+        return (responses, data[start:])
+
+    def _read(self, count):
+        responses = []
+        while len(responses) < count:
+            data = self.sock.recv(READ_SIZE)
+            if not data:
+                raise socket.error("Connection closed.")
+            (more, self.buffer) = self._split(self.buffer + data)
+            responses.extend(more)
+        return responses
+
+    def _command(self, commands):
+        if self.sock is None:
+            self._connect()
+        self.sock.sendall("".join([command + "\n" for command in commands]))
+        return self._read(len(commands))
+
+    @Atomic.sync
+    def command(self, *commands):
+        """
+        Sends the given commands (in one go), and returns a list of their
+        responses, or None if the socket is not available.
+        """
+        for attempt in range(2):
+            try:
+                return self._command(commands)
+            except socket.error, e:
+                # The connection may have been closed by a restart,
+                # so we try once more with a new connection.
+                self.close()
+                error = e
+        logging.debug("Unable to use stats socket %s: %s", self.path, str(error))
+        return None
+
+class StatsParser(object):
+
+    """
+    Parses the CSV output of "show stat".
+
+    The columns are only looked up when the header changes, and each row
+    is then read by position.
+    """
+
+    def __init__(self):
+        super(StatsParser, self).__init__()
+        self.header = None
+        self.columns = []
+        self.status = None
+
+    def _index(self, header):
+        # Header is prefixed with '# '.
+        keys = header[2:].split(",")
+        self.header = header
+        self.columns = [(key, index) for (index, key) in enumerate(keys)
+                        if index >= 2 and key]
+        if "status" in keys:
+            self.status = keys.index("status")
+        else:
+            self.status = None
+
+    @staticmethod
+    def _int(value):
+        # Returns the integer value, or None.
+        if value.isdigit():
+            return int(value)
+        if value[:1] == "-" and value[1:].isdigit():
+            return int(value)
+        return None
+
+    def parse(self, output, names=None):
+        """
+        Returns ({ server : { key : value } }, [ down servers ]) for the
+        output, where only the integer-valued keys are included.
+
+        If given, names maps (proxy, server) to the name used in the results
+        (where servers mapped to None are skipped).
+        """
+        lines = output.split("\n")
+        header = lines[0].strip()
+        if not header.startswith("# "):
+            return ({}, [])
+        if header != self.header:
+            self._index(header)
+
+        results = {}
+        down = []
+        columns = self.columns
+        for line in lines[1:]:
+            # Skip blank lines.
+            line = line.strip()
+            if not line:
+                continue
+
+            # Slice the csv.
+            chunks = line.split(",")
+            port = chunks[1]
+            if names is not None:
+                port = names.get((chunks[0], port), port)
+                if port is None:
+                    continue
+            size = len(chunks)
+
+            # Extract all integer-based keys (the others
+            # can't be aggregated in any meaningful way).
+            data = {}
+            for (key, index) in columns:
+                if index < size:
+                    value = self._int(chunks[index])
+                    if value is not None:
+                        data[key] = value
+            results[port] = [data]
+
+            if self.status is not None and self.status < size and \
+               chunks[self.status] == "DOWN":
+                down.append(port)
+
+        return (results, down)
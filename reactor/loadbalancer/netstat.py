@@ -14,47 +14,240 @@
 #    under the License.
 
 """
-Simple parser to extract active connections via netstat.
+Count active connections by their remote address.
+
+The kernel is asked directly (via the sock_diag netlink interface), so
+that only the sockets to the destinations we care about are returned. If
+that is not available, /proc/net/tcp and /proc/net/tcp6 are read instead.
+Like "netstat -tn", all sockets except listening ones are counted.
 """
 
-import subprocess
+import errno
+import socket
+import struct
+import logging
 
-def connections():
-    active = []
+PROC_PATHS = ["/proc/net/tcp", "/proc/net/tcp6"]
+
+# The state of listening sockets (in /proc, and for sock_diag).
+TCP_LISTEN = 10
+PROC_LISTEN = "%02X" % TCP_LISTEN
+
+# Netlink constants (from linux/netlink.h, linux/sock_diag.h
+# and linux/inet_diag.h).
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+INET_DIAG_REQ_BYTECODE = 1
+INET_DIAG_BC_JMP = 1
+INET_DIAG_BC_D_COND = 8
+ALL_STATES = 0xfff & ~(1 << TCP_LISTEN)
+
+NLMSG_HEADER = struct.Struct("=IHHII")
+INET_DIAG_REQ = struct.Struct("=BBBBIHH16s16sI8s")
+NLATTR_HEADER = struct.Struct("=HH")
+BC_OP = struct.Struct("=BBH")
+HOSTCOND = struct.Struct("=BBxxi")
 
-    netstat = subprocess.Popen(["netstat", "-tn"], stdout=subprocess.PIPE)
-    (stdout, _) = netstat.communicate()
+# The prefix of IPv4-mapped IPv6 addresses.
+V4_MAPPED = "\0" * 10 + "\xff\xff"
 
-    lines = stdout.split("\n")
+# The size of each read from the netlink socket.
+READ_SIZE = 65536
 
-    if len(lines) < 2:
-        return []
+# Errors meaning that sock_diag isn't available here at all.
+NETLINK_UNSUPPORTED = (
+    errno.EPROTONOSUPPORT,
+    errno.EAFNOSUPPORT,
+    errno.EOPNOTSUPP,
+    errno.ENOENT,
+    errno.EPERM,
+    errno.EACCES,
+)
 
-    lines = lines[2:]
-    for line in lines:
+# Cleared if sock_diag turns out to be unavailable.
+_use_netlink = True
+
+def _address(ip):
+    # Returns (family, packed address).
+    if ":" in ip:
+        return (socket.AF_INET6, socket.inet_pton(socket.AF_INET6, ip))
+    else:
+        return (socket.AF_INET, socket.inet_aton(ip))
+
+def _addresses(destinations):
+    # Returns [(ip, port, family, packed address)] for the destinations.
+    # Sockets are only ever reported by address, so destinations given
+    # by name (which can't match anything) are skipped.
+    result = []
+    for (ip, port) in destinations:
         try:
-            # NOTE(amscanne): These variables are unused at the moment,
-            # but good to know what the different components of the netstat
-            # output are... just in case we want to enhance this function in
-            # the future.
-            #   (proto, recvq, sendq, local, foreign, state) = line.split()
-            (_, _, _, _, foreign, _) = line.split()
-            (host, port) = foreign.split(":")
-            active.append((host, int(port)))
-        except Exception:
-            pass
+            (family, packed) = _address(ip)
+        except (socket.error, ValueError):
+            logging.debug("Not counting connections to %s:%d.", ip, port)
+            continue
+        result.append((ip, port, family, packed))
+    return result
 
-    return active
+def _unpack(family, packed):
+    # Returns the ip for the packed address,
+    # with mapped IPv4 addresses as plain IPv4.
+    if family == socket.AF_INET:
+        return socket.inet_ntoa(packed[:4])
+    if packed.startswith(V4_MAPPED):
+        return socket.inet_ntoa(packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+def _bytecode(destinations):
+    # A filter accepting sockets to any of the destinations. The kernel
+    # requires the "yes" branches to run straight through the code, so
+    # each condition is followed by a jump to the end (accept), which the
+    # condition skips if it fails. The last condition skips past the end
+    # (reject) instead.
+    conditions = []
+    for (_, port, family, packed) in _addresses(destinations):
+        conditions.append(HOSTCOND.pack(family, len(packed) * 8, port) + packed)
+
+    code = []
+    remaining = sum([BC_OP.size * 2 + len(cond) for cond in conditions]) - BC_OP.size
+    for (index, cond) in enumerate(conditions):
+        size = BC_OP.size + len(cond)
+        code.append(BC_OP.pack(INET_DIAG_BC_D_COND, size, size + BC_OP.size) + cond)
+        remaining -= size
+        if index < len(conditions) - 1:
+            code.append(BC_OP.pack(INET_DIAG_BC_JMP, BC_OP.size, remaining))
+            remaining -= BC_OP.size
+    return "".join(code)
+
+def _netlink_request(family, bytecode):
+    request = INET_DIAG_REQ.pack(family, socket.IPPROTO_TCP, 0, 0,
+        ALL_STATES, 0, 0, "", "", 0, "\xff" * 8)
+    if bytecode:
+        request += NLATTR_HEADER.pack(NLATTR_HEADER.size + len(bytecode),
+            INET_DIAG_REQ_BYTECODE) + bytecode
+    return NLMSG_HEADER.pack(NLMSG_HEADER.size + len(request),
+        SOCK_DIAG_BY_FAMILY, NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + request
 
-def connection_count():
-    active_count = {}
-    active = connections()
+def _netlink_count(destinations, active):
+    if destinations is not None:
+        bytecode = _bytecode(destinations)
+        if not bytecode:
+            return
+    else:
+        bytecode = ""
 
-    for (host, port) in active:
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_SOCK_DIAG)
+    try:
+        sock.settimeout(5.0)
+        for family in (socket.AF_INET, socket.AF_INET6):
+            sock.send(_netlink_request(family, bytecode))
+            done = False
+            while not done:
+                data = sock.recv(READ_SIZE)
+                offset = 0
+                while offset + NLMSG_HEADER.size <= len(data):
+                    (length, msg_type, _, _, _) = \
+                        NLMSG_HEADER.unpack_from(data, offset)
+                    if msg_type == NLMSG_DONE:
+                        done = True
+                        break
+                    if msg_type == NLMSG_ERROR:
+                        (error,) = struct.unpack_from("=i", data,
+                            offset + NLMSG_HEADER.size)
+                        raise socket.error(-error, "sock_diag failed")
+
+                    # The inet_diag_msg (family, state, timer,
+                    # retrans, sport, dport, src, dst, ...).
+                    msg = offset + NLMSG_HEADER.size
+                    key = (_unpack(ord(data[msg]), data[msg + 24:msg + 40]),
+                           struct.unpack_from("!H", data, msg + 6)[0])
+                    active[key] = active.get(key, 0) + 1
+                    offset += (length + 3) & ~3
+                if not data:
+                    break
+    finally:
+        sock.close()
+
+def _proc_keys(destinations):
+    # Map the remote addresses in /proc to the destinations. The
+    # addresses are printed as native-endian words (in hex).
+    keys = {}
+    for (ip, port, family, packed) in _addresses(destinations):
+        if family == socket.AF_INET:
+            keys["%08X:%04X" % (struct.unpack("=I", packed) + (port,))] = (ip, port)
+            packed = V4_MAPPED + packed
+        keys["%08X%08X%08X%08X:%04X" % (struct.unpack("=4I", packed) + (port,))] = (ip, port)
+    return keys
+
+def _proc_decode(remote):
+    (address, port) = remote.split(":")
+    if len(address) == 8:
+        packed = struct.pack("=I", int(address, 16))
+        ip = _unpack(socket.AF_INET, packed)
+    else:
+        packed = struct.pack("=4I", *[int(address[i:i + 8], 16)
+                                      for i in range(0, 32, 8)])
+        ip = _unpack(socket.AF_INET6, packed)
+    return (ip, int(port, 16))
+
+def _proc_count(destinations, active, paths=None):
+    if destinations is not None:
+        keys = _proc_keys(destinations)
+        if not keys:
+            return
+    else:
+        keys = {}
+
+    for path in paths or PROC_PATHS:
+        try:
+            proc = open(path, "r")
+        except IOError:
+            continue
         try:
-            active_count[(host, port)] = \
-                active_count.get((host, port), 0) + 1
-        except Exception:
-            pass
+            # Skip the header.
+            proc.readline()
+            for line in proc:
+                # (sl, local, remote, state, ...)
+                fields = line.split(None, 4)
+                if len(fields) < 4 or fields[3] == PROC_LISTEN:
+                    continue
+                key = keys.get(fields[2])
+                if key is None:
+                    if destinations is not None:
+                        continue
+                    key = _proc_decode(fields[2])
+                    keys[fields[2]] = key
+                active[key] = active.get(key, 0) + 1
+        finally:
+            proc.close()
 
-    return active_count
+def connection_count(destinations=None):
+    """
+    Returns { (host, port) : count } for all connections, or just those
+    to the given destinations (a list of (host, port)) if specified.
+    """
+    global _use_netlink
+    active = {}
+    if _use_netlink:
+        try:
+            _netlink_count(destinations, active)
+            return active
+        except (socket.error, ValueError), e:
+            if getattr(e, "errno", None) in NETLINK_UNSUPPORTED:
+                logging.info("Unable to use sock_diag, falling back to /proc: %s", str(e))
+                _use_netlink = False
+            else:
+                # Something transient (e.g. a timeout), so just this once.
+                logging.warn("Error from sock_diag, reading /proc: %s", str(e))
+            active = {}
+    _proc_count(destinations, active)
+    return active
+
+def connections():
+    active = []
+    for (key, count) in connection_count().items():
+        active.extend([key] * count)
+    return active
@@ -0,0 +1,472 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Ingestion of the nginx access log.
+
+Records are written by nginx using one of the log formats declared in
+reactor.conf. The delimited format is split on a fixed separator, and the
+JSON format (log_format escape=json) is decoded directly, so no regular
+expression is applied on the common path. Lines in the original format
+are still understood, so that records written before an upgrade count.
+
+Records are either tailed from the log file in large blocks, or pushed
+by nginx directly over syslog (UDP or a unix socket).
+"""
+
+import io
+import os
+import re
+import json
+import time
+import socket
+import select
+import ctypes
+import ctypes.util
+
+from reactor.atomic import Atomic
+from reactor.atomic import AtomicRunnable
+from reactor.metrics.sketch import Histogram
+
+# The amount of the log read at once.
+CHUNK_SIZE = 1024 * 1024
+
+# The largest syslog datagram we accept.
+DATAGRAM_SIZE = 65536
+
+# The prefix and separator for the delimited format.
+DELIMITED_PREFIX = "reactor|"
+DELIMITED_SEPARATOR = "|"
+
+# The original (regex) log format.
+LEGACY_PREFIX = "reactor> "
+LEGACY_FILTER = re.compile(
+      "reactor> " \
+    + "\[([^\]]*)\]" \
+    + "[^<]*" \
+    + "<([^>]*?)>" \
+    + "[^<]*" \
+    + "<([^>]*?)>" \
+    + "[^<]*" \
+    + "<([^>]*?)>" \
+    + ".*")
+
+class HostRecord(object):
+
+    """
+    The accumulated requests for a single upstream.
+
+    Response times are logged by nginx with millisecond resolution, so
+    there are relatively few distinct values. They are counted here, and
+    only folded into the histogram when the record is reported.
+    """
+
+    __slots__ = ("hits", "bytes", "response", "samples")
+
+    def __init__(self):
+        self.hits = 0
+        self.bytes = 0
+        self.response = 0.0
+        self.samples = {}
+
+    def add(self, body, response):
+        self.hits += 1
+        self.bytes += body
+        self.response += response
+        self.samples[response] = self.samples.get(response, 0) + 1
+
+    def merge(self, other):
+        self.hits += other.hits
+        self.bytes += other.bytes
+        self.response += other.response
+        for (response, count) in other.samples.items():
+            self.samples[response] = self.samples.get(response, 0) + count
+
+    def histogram(self):
+        histogram = Histogram()
+        for (response, count) in self.samples.items():
+            histogram.add(response, count=count)
+        return histogram
+
+def parse_other(line):
+    """
+    Returns (host, body, response) fields for a JSON or legacy record,
+    or None if the line is not one of ours.
+    """
+    if line.startswith("{"):
+        try:
+            record = json.loads(line)
+            return (record["upstream"], record["bytes"], record["response"])
+        except (ValueError, KeyError, TypeError):
+            return None
+    elif line.startswith(LEGACY_PREFIX):
+        m = LEGACY_FILTER.match(line)
+        if m is not None:
+            return m.groups()[1:]
+    return None
+
+def accumulate(lines, record=None):
+    """
+    Adds the given log lines to record ({ host : HostRecord }), which is
+    returned. Lines which aren't ours (or have no upstream) are skipped.
+    """
+    if record is None:
+        record = {}
+    for line in lines:
+        if line.startswith(DELIMITED_PREFIX):
+            fields = line.split(DELIMITED_SEPARATOR)
+            if len(fields) < 4:
+                continue
+            host = fields[1]
+            body = fields[2]
+            response = fields[3]
+        else:
+            fields = parse_other(line)
+            if fields is None:
+                continue
+            (host, body, response) = fields
+        try:
+            # Requests which were not proxied (or were retried across
+            # multiple upstreams) don't parse, and aren't counted.
+            body = int(body)
+            response = float(response)
+        except (ValueError, TypeError):
+            continue
+        host_record = record.get(host)
+        if host_record is None:
+            host_record = record[host] = HostRecord()
+        # NOTE: This is HostRecord.add(), inlined.
+        host_record.hits += 1
+        host_record.bytes += body
+        host_record.response += response
+        samples = host_record.samples
+        samples[response] = samples.get(response, 0) + 1
+    return record
+
+def _load_inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        init = libc.inotify_init1
+        add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError, TypeError):
+        return None
+    init.argtypes = [ctypes.c_int]
+    init.restype = ctypes.c_int
+    add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    add_watch.restype = ctypes.c_int
+    return (init, add_watch)
+
+_inotify = _load_inotify()
+
+IN_MODIFY = 0x2
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+class Inotify(object):
+
+    """ Wakes up on writes to (or new files in) a directory. """
+
+    def __init__(self, path):
+        super(Inotify, self).__init__()
+        (init, add_watch) = _inotify
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if add_watch(self.fd, path, IN_MODIFY | IN_CREATE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, os.strerror(err))
+
+    def wait(self, timeout):
+        try:
+            (ready, _, _) = select.select([self.fd], [], [], timeout)
+        except select.error:
+            # Interrupted system call.
+            return
+        if ready:
+            # Discard the events, we only care that something happened.
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except OSError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+class LogFile(object):
+
+    """ A single open log file, and any trailing partial line. """
+
+    def __init__(self, filename, at_end=False):
+        super(LogFile, self).__init__()
+        self.file = io.open(filename, 'rb', buffering=0)
+        info = os.fstat(self.file.fileno())
+        self.ident = (info.st_dev, info.st_ino)
+        if at_end:
+            self.file.seek(0, 2)
+        self.partial = ""
+
+    def read(self):
+        data = self.file.read(CHUNK_SIZE)
+        if not(data) and \
+           os.fstat(self.file.fileno()).st_size < self.file.tell():
+            # The file was truncated (copytruncate), start over.
+            self.file.seek(0)
+            self.partial = ""
+            data = self.file.read(CHUNK_SIZE)
+        if not(data):
+            return []
+
+        # Hang on to any trailing partial line.
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        return lines
+
+    def flush(self):
+        lines = self.partial and [self.partial] or []
+        self.partial = ""
+        return lines
+
+    def close(self):
+        self.file.close()
+
+class NginxLogReader(object):
+
+    """
+    Tails the access log across rotations.
+
+    The file is tracked by inode. When the name points to a new file, the
+    old one is kept open and drained for ROTATE_GRACE seconds (nginx keeps
+    writing to it until it is told to reopen its logs), while the new file
+    is read from the start. A file that shrinks is read from the start.
+    """
+
+    # How long to keep reading a rotated file.
+    ROTATE_GRACE = 10.0
+
+    def __init__(self, log_filename):
+        super(NginxLogReader, self).__init__()
+        self.log_filename = log_filename
+        self.current = None
+        self.rotated = None
+        self.rotated_at = None
+        self.started = False
+        self.inotify = None
+        if _inotify is not None:
+            try:
+                self.inotify = Inotify(os.path.dirname(log_filename) or ".")
+            except OSError:
+                pass
+
+    def _rotate(self):
+        # Check if the name now refers to a different file.
+        try:
+            info = os.stat(self.log_filename)
+        except OSError:
+            # Moved away, but not yet recreated.
+            return []
+        if (info.st_dev, info.st_ino) == self.current.ident:
+            return []
+        lines = []
+        if self.rotated is not None:
+            lines = self.rotated.flush()
+            self.rotated.close()
+        self.rotated = self.current
+        self.rotated_at = time.time()
+        self.current = None
+        return lines
+
+    def read(self):
+        """ Returns the complete lines available (possibly none). """
+        if self.current is None:
+            try:
+                # Only skip what was in the log before we started.
+                self.current = LogFile(self.log_filename, at_end=not(self.started))
+            except (IOError, OSError):
+                pass
+            self.started = True
+
+        lines = []
+        if self.rotated is not None:
+            lines.extend(self.rotated.read())
+            if not(lines) and time.time() - self.rotated_at > self.ROTATE_GRACE:
+                lines.extend(self.rotated.flush())
+                self.rotated.close()
+                self.rotated = None
+
+        if self.current is not None:
+            lines.extend(self.current.read())
+            if not(lines):
+                lines.extend(self._rotate())
+        return lines
+
+    def wait(self, timeout):
+        """ Waits for the log to change, if possible. """
+        if self.inotify is None:
+            return False
+        self.inotify.wait(timeout)
+        return True
+
+    def close(self):
+        for logfile in (self.current, self.rotated):
+            if logfile is not None:
+                logfile.close()
+        self.current = None
+        self.rotated = None
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+class NginxSyslogReader(object):
+
+    """
+    Receives records pushed by nginx (access_log syslog:server=...).
+
+    The address is either host:port (UDP), or unix:/path (a datagram
+    socket created at the given path).
+    """
+
+    def __init__(self, address):
+        super(NginxSyslogReader, self).__init__()
+        if address.startswith("unix:"):
+            path = address[len("unix:"):]
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(path)
+            self.path = path
+        else:
+            (host, port) = address.rsplit(":", 1)
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind((host, int(port)))
+            self.path = None
+        self.sock.settimeout(1.0)
+
+    @staticmethod
+    def message(data):
+        # Strip the syslog header ("<pri>date host tag: ").
+        index = data.find(": ")
+        if index >= 0:
+            data = data[index + 2:]
+        return data.rstrip("\n")
+
+    def read(self):
+        try:
+            data = self.sock.recv(DATAGRAM_SIZE)
+        except socket.timeout:
+            return []
+        except socket.error:
+            return []
+        lines = [self.message(data)]
+
+        # Collect everything else that has already arrived.
+        self.sock.setblocking(0)
+        try:
+            while len(lines) < 1024:
+                lines.append(self.message(self.sock.recv(DATAGRAM_SIZE)))
+        except socket.error:
+            pass
+        finally:
+            self.sock.settimeout(1.0)
+        return lines
+
+    def wait(self, timeout):
+        # Reads already wait for a record to arrive.
+        return True
+
+    def close(self):
+        self.sock.close()
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+class NginxLogWatcher(AtomicRunnable):
+    """
+    This will monitor the nginx access log.
+
+    Lines are read and parsed without holding the lock, which is only
+    taken to fold each batch into the current records.
+    """
+
+    def __init__(self, access_logfile=None, syslog=None):
+        super(NginxLogWatcher, self).__init__()
+        self.daemon = True
+        if syslog:
+            self.log = NginxSyslogReader(syslog)
+        else:
+            self.log = NginxLogReader(access_logfile)
+        self.last_update = time.time()
+        self.record = {}
+
+    @Atomic.sync
+    def swap(self):
+        # Swap out the records.
+        now = time.time()
+        delta = now - self.last_update
+        self.last_update = now
+        cur = self.record
+        self.record = {}
+        return (cur, delta)
+
+    def pull(self):
+        (record, delta) = self.swap()
+
+        # Compute the response times.
+        for host in record:
+            host_record = record[host]
+            hits = host_record.hits
+            metrics = \
+                {
+                "rate" : (hits, hits / delta),
+                "response" : (hits, host_record.response / hits),
+                "bytes" : (hits, host_record.bytes / delta),
+                }
+            record[host] = [metrics, { "response" : host_record.histogram().dump() }]
+
+        return record
+
+    @Atomic.sync
+    def merge(self, batch):
+        for (host, host_record) in batch.items():
+            current = self.record.get(host)
+            if current is None:
+                self.record[host] = host_record
+            else:
+                current.merge(host_record)
+
+    @Atomic.sync
+    def idle(self):
+        if self._running:
+            self._wait(1.0)
+
+    def run(self):
+        while self.is_running():
+            lines = self.log.read()
+            if not(lines):
+                # No updates.
+                if not(self.log.wait(1.0)):
+                    self.idle()
+            else:
+                # We have some information.
+                self.merge(accumulate(lines))
+        self.log.close()
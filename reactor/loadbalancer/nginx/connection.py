@@ -15,10 +15,7 @@
 
 import os
 import signal
-import shutil
 import glob
-import re
-import time
 import logging
 import subprocess
 import tempfile
@@ -26,126 +23,28 @@ import tempfile
 from mako.template import Template
 
 from reactor.atomic import Atomic
-from reactor.atomic import AtomicRunnable
 from reactor.config import Config
 from reactor.utils import sha_hash
 from reactor.loadbalancer.connection import LoadBalancerConnection
 from reactor.loadbalancer.netstat import connection_count
 from reactor.loadbalancer.utils import read_pid
 from reactor.loadbalancer.utils import binary_exists
+from reactor.loadbalancer.utils import FragmentCache
+from reactor.loadbalancer.utils import write_atomic
+from reactor.loadbalancer.nginx.accesslog import NginxLogWatcher
+from reactor.loadbalancer.nginx.upstream import UpstreamApi
 
-class NginxLogReader(object):
+TEMPLATE = Template(filename=os.path.join(os.path.dirname(__file__), 'nginx.template'))
 
-    def __init__(self, log_filename, log_filter=None):
-        super(NginxLogReader, self).__init__()
-        self.logfile = None
-        self.log_filename = log_filename
-        self.log_filter = None
-        if log_filter != None:
-            self.log_filter = re.compile(log_filter)
-        self.connected = False
+# The base configuration (with our log formats).
+BASE_TEMPLATE = Template(filename=os.path.join(os.path.dirname(__file__), 'reactor.conf'))
 
-    def connect(self):
-        # Re-open the file by name.
-        self.logfile = open(self.log_filename, 'r')
+ACCESS_LOG = "/var/log/nginx/access.log"
 
-        # Seek to the end of the file, always.
-        self.logfile.seek(0, 2)
-        self.connected = True
-
-    def nextline(self):
-        # Open the file initially.
-        if not(self.connected):
-            try:
-                self.connect()
-            except IOError:
-                return None
-
-        line = self.logfile.readline().strip()
-        while self.log_filter != None and line:
-            # Apply the filter to the line.
-            m = self.log_filter.match(line)
-            if m != None:
-                return m.groups()
-            else:
-                line = self.logfile.readline().strip()
-
-        # If we got nothing, make sure we've got
-        # the right file open (due to rotation) and
-        # seek to the end where we should still be.
-        if not(line):
-            try:
-                self.connect()
-            except IOError:
-                logging.warn("Unable to reopen Nginx log.")
-
-        return line
-
-class NginxLogWatcher(AtomicRunnable):
-    """
-    This will monitor the nginx access log.
-    """
-
-    LOG_FILTER = "reactor> " \
-               + "\[([^\]]*)\]" \
-               + "[^<]*" \
-               + "<([^>]*?)>" \
-               + "[^<]*" \
-               + "<([^>]*?)>" \
-               + "[^<]*" \
-               + "<([^>]*?)>" \
-               + ".*"
-
-    def __init__(self, access_logfile):
-        super(NginxLogWatcher, self).__init__()
-        self.log = NginxLogReader(access_logfile, log_filter=self.LOG_FILTER)
-        self.last_update = time.time()
-        self.record = {}
-
-    @Atomic.sync
-    def swap(self):
-        # Swap out the records.
-        now = time.time()
-        delta = now - self.last_update
-        self.last_update = now
-        cur = self.record
-        self.record = {}
-        return (cur, delta)
-
-    def pull(self):
-        (record, delta) = self.swap()
-
-        # Compute the response times.
-        for host in record:
-            hits = record[host][0]
-            metrics = \
-                {
-                "rate" : (hits, hits / delta),
-                "response" : (hits, record[host][2] / hits),
-                "bytes" : (hits, record[host][1] / delta),
-                }
-            record[host] = [metrics]
-
-        return record
-
-    @Atomic.sync
-    def run(self):
-        while self.is_running():
-            line = self.log.nextline()
-            if not(line):
-                # No updates.
-                self._wait(1.0)
-            else:
-                # We have some information.
-                (_, host, body, response) = line
-                try:
-                    if not(host in self.record):
-                        self.record[host] = [0, 0, 0.0]
-                    self.record[host][0] += 1
-                    self.record[host][1] += int(body)
-                    self.record[host][2] += float(response)
-                except ValueError:
-                    continue
+LOG_FORMATS = {
+    "delimited" : "reactor",
+    "json" : "reactor_json",
+}
 
 class NginxManagerConfig(Config):
 
@@ -161,6 +60,24 @@ class NginxManagerConfig(Config):
         default="/etc/nginx/sites-enabled",
         description="The site path for nginx.")
 
+    log_format = Config.select(label="Access log format", default="delimited",
+        options=[
+            ("Delimited", "delimited"),
+            ("JSON", "json")],
+        description="The format nginx uses for access log records" \
+                    + " (JSON requires nginx 1.11.8 or later).")
+
+    syslog = Config.string(label="Syslog address", default=None,
+        description="If set, nginx sends access log records over syslog" \
+                    + " to this address (host:port for UDP, or unix:/path)" \
+                    + " rather than writing them to the access log.")
+
+    upstream_api = Config.string(label="Upstream API", default=None,
+        description="The URL of the nginx upstream API (for example," \
+                    + " http://127.0.0.1:8080/api/6). If set, backend changes" \
+                    + " are made through the API, and nginx is only reloaded" \
+                    + " when the server configuration itself changes.")
+
 class NginxEndpointConfig(Config):
 
     sticky_sessions = Config.boolean(label="Use Sticky Sessions", default=False,
@@ -196,13 +113,25 @@ class Connection(LoadBalancerConnection):
             lambda m: (m.group(1), None, m.group(2), None)
     }
 
+    # Coalesce bursts of changes into one reload.
+    _SAVE_DELAY = 1.0
+
     def __init__(self, **kwargs):
         super(Connection, self).__init__(**kwargs)
         self.tracked = {}
-        template_file = os.path.join(os.path.dirname(__file__), 'nginx.template')
-        self.template = Template(filename=template_file)
-        self.log_reader = NginxLogWatcher("/var/log/nginx/access.log")
+        self.servers = {}
+        self.sites = {}
+        self.written = {}
+        self.reload = True
+        self.template = TEMPLATE
+        self.fragments = FragmentCache()
+        self.log_reader = NginxLogWatcher(ACCESS_LOG,
+                                          syslog=self._manager_config().syslog)
         self.log_reader.start()
+        upstream_api = self._manager_config().upstream_api
+        self.upstream_api = upstream_api and UpstreamApi(upstream_api) or None
+
+        self.collector.register("access", self._collect_metrics)
 
         if kwargs.get('zkobj') is not None:
             # Remove all sites configurations.
@@ -218,6 +147,7 @@ class Connection(LoadBalancerConnection):
     def __del__(self):
         self.log_reader.stop()
         self.log_reader.join()
+        super(Connection, self).__del__()
 
     def _generate_ssl(self, uniq_id, config):
         key = config.ssl_key
@@ -264,10 +194,10 @@ class Connection(LoadBalancerConnection):
         # Return the certificate and key.
         return (crt_file, key_file)
 
+    @Atomic.sync
     def change(self, url, backends, config=None):
         # We use a simple hash of the URL as the file name for the configuration file.
         uniq_id = sha_hash(url)
-        conf_filename = "reactor.%s.conf" % uniq_id
 
         # Grab the endpoint configuration.
         config = self._endpoint_config(config)
@@ -277,14 +207,12 @@ class Connection(LoadBalancerConnection):
             # Remove the connection from our tracking list.
             if uniq_id in self.tracked:
                 del self.tracked[uniq_id]
-
-            try:
-                full_conf_file = os.path.join(
-                    self._manager_config().site_path, conf_filename)
-                if os.path.exists(full_conf_file):
-                    os.remove(full_conf_file)
-            except OSError:
-                logging.warn("Unable to remove file: %s", conf_filename)
+            if uniq_id in self.servers:
+                del self.servers[uniq_id]
+            if uniq_id in self.sites:
+                del self.sites[uniq_id]
+            self.fragments.remove(uniq_id)
+            self.reload = True
             return
 
         # Parse the given URL.
@@ -337,8 +265,40 @@ class Connection(LoadBalancerConnection):
         else:
             redirect = False
 
-        # Render our given template.
-        conf = self.template.render(id=uniq_id,
+        # Figure out where the access log goes.
+        manager_config = self._manager_config()
+        if manager_config.syslog:
+            access_log = "syslog:server=%s,tag=reactor" % manager_config.syslog
+        else:
+            access_log = ACCESS_LOG
+        log_format = LOG_FORMATS.get(manager_config.log_format, "reactor")
+
+        # Check whether anything other than the backends has changed.
+        # If not (and we can), the upstream is changed in place. The file is
+        # still written on save, so it is current whenever nginx next reloads.
+        server_key = sha_hash(repr((url, netloc, path, scheme, listen,
+                                    bool(redirect), config.ssl,
+                                    ssl_certificate, ssl_key,
+                                    access_log, log_format, extra)))
+        if self.upstream_api is not None and not(redirect) and \
+           self.servers.get(uniq_id) == server_key:
+            try:
+                self.upstream_api.update(uniq_id,
+                    dict([("%s:%d" % (backend.ip, backend.port), backend.weight)
+                          for backend in backends]))
+            except Exception, e:
+                # Whatever went wrong (including httplib errors, which
+                # aren't IOErrors), a full reload will sort it out.
+                logging.warn("Unable to update upstream %s: %s", uniq_id, str(e))
+                self.reload = True
+        else:
+            self.reload = True
+        self.servers[uniq_id] = server_key
+
+        # Render our given template (unless nothing has changed).
+        self.sites[uniq_id] = self.fragments.render(uniq_id,
+                                    self.template.render,
+                                    id=uniq_id,
                                     url=url,
                                     netloc=netloc,
                                     path=path,
@@ -349,18 +309,50 @@ class Connection(LoadBalancerConnection):
                                     ssl=config.ssl,
                                     ssl_certificate=ssl_certificate,
                                     ssl_key=ssl_key,
+                                    access_log=access_log,
+                                    log_format=log_format,
+                                    zone=self.upstream_api is not None,
                                     extra=extra)
 
-        # Write out the config file.
-        config_file = open(os.path.join(
-            self._manager_config().site_path, conf_filename), 'wb')
-        config_file.write(conf)
-        config_file.close()
+    def _render(self):
+        return "".join(["%s\n%s" % (uniq_id, self.sites[uniq_id])
+                        for uniq_id in sorted(self.sites.keys())])
+
+    def _commit(self, output):
+        site_path = self._manager_config().site_path
+
+        # Write out the config files that have changed.
+        for (uniq_id, conf) in self.sites.items():
+            if self.written.get(uniq_id) == conf:
+                continue
+            config_file = open(os.path.join(
+                site_path, "reactor.%s.conf" % uniq_id), 'wb')
+            config_file.write(conf)
+            config_file.close()
+
+        # Remove the ones that are gone.
+        for uniq_id in self.written.keys():
+            if uniq_id in self.sites:
+                continue
+            conf_filename = "reactor.%s.conf" % uniq_id
+            try:
+                full_conf_file = os.path.join(site_path, conf_filename)
+                if os.path.exists(full_conf_file):
+                    os.remove(full_conf_file)
+            except OSError:
+                logging.warn("Unable to remove file: %s", conf_filename)
+        self.written = dict(self.sites)
+
+        # Nothing needs to be reloaded.
+        if not(self.reload):
+            return
+        self.reload = False
 
-    def save(self):
-        # Copy over our base configuration.
-        shutil.copyfile(os.path.join(os.path.dirname(__file__), 'reactor.conf'),
-                        os.path.join(self._manager_config().config_path, 'reactor.conf'))
+        # Write out our base configuration. The JSON log format is only
+        # declared when it is used, as older nginx versions reject it.
+        manager_config = self._manager_config()
+        write_atomic(os.path.join(manager_config.config_path, 'reactor.conf'),
+                     BASE_TEMPLATE.render(json=(manager_config.log_format == "json")))
 
         # Send a signal to NginX to reload the configuration
         # (Note: we might need permission to do this!!)
@@ -372,14 +364,17 @@ class Connection(LoadBalancerConnection):
                 ["service", "nginx", "start"],
                 close_fds=True)
 
-    def metrics(self):
+    def _collect_metrics(self):
         # Grab the log records.
         records = self.log_reader.pull()
 
-        # Grab the active connections.
-        active_connections = connection_count()
+        # Grab the active connections (to our backends only).
+        tracked = self.tracked.values()
+        active_connections = connection_count(
+            set([backend for connection_list in tracked
+                         for backend in connection_list]))
 
-        for connection_list in self.tracked.values():
+        for connection_list in tracked:
             for (ip, port) in connection_list:
                 active = active_connections.get((ip, port), 0)
 
@@ -0,0 +1,78 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A client for the nginx upstream API.
+
+Upstreams declared with a shared memory zone can have their servers
+changed at runtime through the api module, which avoids reloading nginx
+(and respawning all of its workers) when only the backends change.
+"""
+
+import json
+import urllib2
+
+class UpstreamApi(object):
+
+    def __init__(self, url, timeout=5.0):
+        super(UpstreamApi, self).__init__()
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, method, path, body=None):
+        if body is not None:
+            body = json.dumps(body)
+        request = urllib2.Request(self.url + path, data=body,
+            headers={ "Content-Type" : "application/json" })
+        request.get_method = lambda: method
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        if not(data):
+            return None
+        return json.loads(data)
+
+    def _path(self, upstream, server_id=None):
+        path = "/http/upstreams/%s/servers" % upstream
+        if server_id is not None:
+            path += "/%s" % server_id
+        return path
+
+    def servers(self, upstream):
+        """ Returns { "ip:port" : (id, weight) } for the upstream. """
+        return dict([(server["server"], (server["id"], server.get("weight", 1)))
+                     for server in self._request("GET", self._path(upstream)) or []])
+
+    def update(self, upstream, backends):
+        """
+        Changes the servers in the upstream to backends ({ "ip:port" : weight }).
+        This raises IOError (or ValueError) if the API is not available.
+        """
+        current = self.servers(upstream)
+
+        # Add new servers before removing any, so the upstream never
+        # goes through a period with nothing in it.
+        for (server, weight) in backends.items():
+            if not server in current:
+                self._request("POST", self._path(upstream),
+                    body={ "server" : server, "weight" : weight })
+            elif current[server][1] != weight:
+                self._request("PATCH", self._path(upstream, current[server][0]),
+                    body={ "weight" : weight })
+        for (server, (server_id, _)) in current.items():
+            if not server in backends:
+                self._request("DELETE", self._path(upstream, server_id))
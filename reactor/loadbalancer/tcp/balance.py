@@ -0,0 +1,198 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Backend selection for non-exclusive TCP endpoints.
+
+Each balancer is kept for an endpoint and picks an (ip, port) backend per
+connection. Its backends and weights are changed in place by update(), so
+that any state (e.g. the round-robin position) carries over for backends
+that are still there. Connection counts are owned by the consumer (which
+updates them as sessions start and finish) and are passed in as a map of
+backend to active connections.
+"""
+
+import bisect
+import hashlib
+import random
+
+from reactor.atomic import Atomic
+
+class Balancer(Atomic):
+
+    def __init__(self, backends, weights=None):
+        super(Balancer, self).__init__()
+        self.backends = []
+        self.weights = []
+        self._totals = []
+        self.update(backends, weights=weights)
+
+    def __len__(self):
+        return len(self.backends)
+
+    @Atomic.sync
+    def update(self, backends, weights=None):
+        """ Changes the backends (and their weights). """
+        if weights is None:
+            weights = [1] * len(backends)
+        weights = [max(float(weight), 0.0) for weight in weights]
+        if not any(weights):
+            # Nothing has any weight, so treat them all the same.
+            weights = [1.0] * len(backends)
+        backends = [tuple(backend) for backend in backends]
+        if backends == self.backends and weights == self.weights:
+            return
+
+        previous = self.backends
+        self.backends = backends
+        self.weights = weights
+
+        # Cumulative weights for weighted random choices.
+        self._totals = []
+        total = 0.0
+        for weight in self.weights:
+            total += weight
+            self._totals.append(total)
+        self._updated(previous)
+
+    def _updated(self, previous):
+        # Called when the backends have changed (from previous).
+        pass
+
+    def _random(self):
+        # Returns a random index, in proportion to the weights.
+        point = random.random() * self._totals[-1]
+        return min(bisect.bisect_right(self._totals, point), len(self._totals) - 1)
+
+    def _load(self, index, active):
+        return active.get(self.backends[index], 0) / self.weights[index]
+
+    @Atomic.sync
+    def select(self, active, client):
+        """ Returns the (ip, port) for a new connection from client. """
+        return self._select(active, client)
+
+    def _select(self, active, client):
+        raise NotImplementedError()
+
+class RandomBalancer(Balancer):
+
+    """ Picks any backend, ignoring the weights. """
+
+    def _select(self, active, client):
+        return random.choice(self.backends)
+
+class WeightedRandomBalancer(Balancer):
+
+    def _select(self, active, client):
+        return self.backends[self._random()]
+
+class RoundRobinBalancer(Balancer):
+
+    """ Smooth weighted round-robin (as used by nginx). """
+
+    def __init__(self, backends, weights=None):
+        self.current = []
+        super(RoundRobinBalancer, self).__init__(backends, weights=weights)
+
+    def _updated(self, previous):
+        # Backends that are still here keep their place in the rotation.
+        current = dict(zip(previous, self.current))
+        self.current = [current.get(backend, 0.0) for backend in self.backends]
+
+    def _select(self, active, client):
+        best = None
+        for index in range(len(self.backends)):
+            self.current[index] += self.weights[index]
+            if best is None or self.current[index] > self.current[best]:
+                best = index
+        self.current[best] -= self._totals[-1]
+        return self.backends[best]
+
+class LeastConnBalancer(Balancer):
+
+    def _select(self, active, client):
+        # Start from a random point, so ties don't all go to the first.
+        count = len(self.backends)
+        offset = random.randint(0, count - 1)
+        best = None
+        for index in [(offset + i) % count for i in range(count)]:
+            if self.weights[index] == 0:
+                continue
+            if best is None or self._load(index, active) < self._load(best, active):
+                best = index
+        return self.backends[best]
+
+class TwoChoiceBalancer(Balancer):
+
+    """ Picks two backends at random, and uses the least loaded. """
+
+    def _select(self, active, client):
+        first = self._random()
+        second = self._random()
+        if self._load(second, active) < self._load(first, active):
+            return self.backends[second]
+        return self.backends[first]
+
+class HashBalancer(Balancer):
+
+    """ Consistent hashing on the client address. """
+
+    # Points on the ring per unit of weight.
+    REPLICAS = 100
+
+    def __init__(self, backends, weights=None):
+        self._points = []
+        self._ring = []
+        super(HashBalancer, self).__init__(backends, weights=weights)
+
+    def _updated(self, previous):
+        ring = []
+        for (backend, weight) in zip(self.backends, self.weights):
+            for replica in range(int(round(weight * self.REPLICAS))):
+                ring.append((self._hash("%s:%d-%d" % (backend + (replica,))), backend))
+        ring.sort()
+        self._points = [point for (point, _) in ring]
+        self._ring = [backend for (_, backend) in ring]
+
+    @staticmethod
+    def _hash(value):
+        return long(hashlib.md5(value).hexdigest()[:16], 16)
+
+    def _select(self, active, client):
+        if not self._ring:
+            return self.backends[self._random()]
+        index = bisect.bisect(self._points, self._hash(str(client)))
+        return self._ring[index % len(self._ring)]
+
+BALANCERS = {
+    "random" : RandomBalancer,
+    "weighted" : WeightedRandomBalancer,
+    "roundrobin" : RoundRobinBalancer,
+    "leastconn" : LeastConnBalancer,
+    "p2c" : TwoChoiceBalancer,
+    "hash" : HashBalancer,
+}
+
+def create(algorithm, backends, weights=None, balancer=None):
+    """
+    Returns a balancer for the given backends. If an existing balancer is
+    given and uses the same algorithm, it is updated and returned instead.
+    """
+    cls = BALANCERS.get(algorithm, RandomBalancer)
+    if balancer is not None and balancer.__class__ is cls:
+        balancer.update(backends, weights=weights)
+        return balancer
+    return cls(backends, weights=weights)
@@ -14,24 +14,28 @@
 #    under the License.
 
 import os
+import errno
 import socket
 import signal
 import time
-import threading
 import Queue
-import random
+import collections
 import select
+import struct
 import logging
-import netaddr
 
 from reactor import utils
 from reactor.ips import is_local
+from reactor.ips import SubnetSet
 from reactor.atomic import Atomic
 from reactor.atomic import AtomicRunnable
 from reactor.config import Config
 from reactor.objects.ip_address import IPAddresses
+from reactor.zookeeper.cache import LockCache
 from reactor.loadbalancer.connection import LoadBalancerConnection
 from reactor.loadbalancer.utils import binary_exists
+from reactor.loadbalancer.tcp import balance
+from reactor.loadbalancer.tcp.proxy import ProxyEngine
 
 def close_fds(except_fds=None):
     if except_fds is None:
@@ -48,7 +52,7 @@ def close_fds(except_fds=None):
             except OSError:
                 pass
 
-def fork_and_exec(cmd, child_fds=None):
+def fork_and_exec(cmd, child_fds=None, pgid=None):
     if child_fds is None:
         child_fds = []
 
@@ -60,12 +64,151 @@ def fork_and_exec(cmd, child_fds=None):
     # Close off all parent FDs.
     close_fds(except_fds=child_fds)
 
-    # Create process group.
-    os.setsid()
+    if pgid is None:
+        # Create process group.
+        os.setsid()
+    else:
+        # Join the given process group (or create a new one).
+        # See ChildReaper below for why this is done.
+        try:
+            os.setpgid(0, pgid)
+        except OSError:
+            os.setpgid(0, 0)
 
     # Exec the given command.
     os.execvp(cmd[0], cmd)
 
+class ChildReaper(AtomicRunnable):
+
+    """
+    Waits for all of our forked children with a single thread.
+
+    All children are placed in a shared process group, so that they can
+    be reaped by waiting on the group as a whole. This means that the
+    cost of reaping is proportional to the number of exits (not the
+    number of children), and that we never reap processes that belong
+    to someone else (e.g. subprocess calls made by other drivers).
+    """
+
+    def __init__(self):
+        super(ChildReaper, self).__init__()
+        self.pgid = None
+        self.children = {}
+
+        # Start the thread.
+        # NOTE: Unlike most other threads in the system, this
+        # thread is *not* a daemon thread. We want it to keep
+        # everything alive so that our Zookeeper locks are properly
+        # maintained while the children are alive.
+        self.start()
+
+    @Atomic.sync
+    def spawn(self, fn, exited):
+        """
+        Calls fn(pgid) to fork a child into the given process group, and
+        arranges for exited(pid, error) to be called once it exits.
+        """
+        pgid = self.pgid
+        child = fn(pgid or 0)
+        if child is None:
+            return None
+
+        # Set the process group from the parent as well, as we
+        # don't know whether the child has been scheduled yet.
+        try:
+            os.setpgid(child, pgid or child)
+        except OSError:
+            try:
+                os.setpgid(child, child)
+            except OSError:
+                # The child has already done it.
+                pass
+        try:
+            group = os.getpgid(child)
+        except OSError:
+            group = pgid or child
+
+        self.pgid = group
+        self.children[child] = (group, exited)
+        self._notify()
+        return child
+
+    @Atomic.sync
+    def _next_group(self):
+        while not self.children:
+            if not self._running:
+                return None
+            self.pgid = None
+            self._wait()
+        if self.pgid is None:
+            self.pgid = self.children.values()[0][0]
+        return self.pgid
+
+    @Atomic.sync
+    def _reaped(self, pid, status):
+        if not pid in self.children:
+            return []
+        (_, exited) = self.children.pop(pid)
+        return [(exited, pid, os.WEXITSTATUS(status) > 0)]
+
+    @Atomic.sync
+    def _lost(self, pgid):
+        # None of our children remain in this group, so
+        # anything still registered has been reaped elsewhere.
+        lost = [
+            (exited, pid, False)
+            for (pid, (group, exited)) in self.children.items()
+            if group == pgid
+        ]
+        for (_, pid, _) in lost:
+            del self.children[pid]
+        if self.pgid == pgid:
+            self.pgid = None
+        return lost
+
+    def run(self):
+        while True:
+            pgid = self._next_group()
+            if pgid is None:
+                break
+            try:
+                (pid, status) = os.waitpid(-pgid, 0)
+                results = self._reaped(pid, status)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                results = self._lost(pgid)
+
+            # Dispatch without holding our lock.
+            for (exited, pid, error) in results:
+                exited(pid, error)
+
+# The default listen backlog.
+DEFAULT_BACKLOG = 128
+
+# The longest time (in seconds) between snapshots while the consumer is
+# kept busy by a steady stream of connections (see ConnectionConsumer).
+PUBLISH_INTERVAL = 0.1
+
+# Not exposed by the socket module in Python 2.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+TCP_INFO = getattr(socket, "TCP_INFO", 11)
+
+def _accept_queue_depth(sock):
+    # For listening sockets, Linux reports the current length of
+    # the accept queue as tcpi_unacked in the TCP_INFO structure.
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, 104)
+        return struct.unpack_from("I", info, 24)[0]
+    except (socket.error, struct.error, TypeError):
+        return None
+
+@utils.memoize(size=256)
+def _compile_subnets(subnets):
+    # Subnets are given as a tuple, so that each distinct
+    # list of subnets is only compiled once.
+    return SubnetSet(subnets)
+
 def _as_client(src_ip, src_port):
     return "%s:%d" % (src_ip, src_port)
 
@@ -73,6 +216,7 @@ class Accept(object):
 
     def __init__(self, sock):
         super(Accept, self).__init__()
+        self.fd = None
         (client, address) = sock.accept()
         # Ensure that the underlying socket is closed.
         # It's probably crazy pills -- but I saw weird
@@ -97,33 +241,100 @@ class Accept(object):
                     _as_client(*(self.src)), self.fd)
             self.fd = None
 
-    def redirect(self, host, port):
+    def redirect(self, host, port, pgid=None):
         if self.fd is not None:
             cmd = [
                 "socat",
                 "fd:%d" % self.fd,
                 "tcp-connect:%s:%d" % (host, port)
             ]
-            child = fork_and_exec(cmd, child_fds=[self.fd])
+            child = fork_and_exec(cmd, child_fds=[self.fd], pgid=pgid)
             if child:
                 os.close(self.fd)
                 self.fd = None
             return child
 
+class SocatEngine(object):
+
+    """
+    Redirects connections by forking a socat process for each.
+
+    Engines return a handle for every redirected connection, and call
+    exited(handle, error) once the connection has finished. Here the
+    handle is the pid of the socat process.
+    """
+
+    def __init__(self):
+        super(SocatEngine, self).__init__()
+        self.reaper = ChildReaper()
+
+    def redirect(self, connection, host, port, exited):
+        return self.reaper.spawn(
+            lambda pgid: connection.redirect(host, port, pgid=pgid), exited)
+
+    def kill(self, child):
+        try:
+            os.kill(child, signal.SIGTERM)
+        except OSError:
+            # The process no longer exists.
+            pass
+
+    def stats(self, child):
+        return None
+
+    def traffic(self):
+        # Socat doesn't tell us how much it has relayed.
+        return None
+
+    def stop(self):
+        self.reaper.stop()
+
 class ConnectionConsumer(AtomicRunnable):
 
-    def __init__(self, locks, error_notify, discard_notify, producer):
+    def __init__(self, locks, error_notify, discard_notify, producer, engine=None):
         super(ConnectionConsumer, self).__init__()
 
         self.locks = locks
         self.error_notify = utils.callback(error_notify)
         self.discard_notify = utils.callback(discard_notify)
         self.producer = producer
+        if engine is None:
+            engine = SocatEngine()
+        self.engine = engine
 
         self.portmap = {}
-        self.postponed = []
         self.standby = {}
+
+        # Clients waiting for a backend, in FIFO order per port.
+        self.waiting = {}
+        # Ports which may have a free backend for waiting clients.
+        self.ready = set()
+        # Backends to the ports they serve (used to route release events).
+        self.backend_ports = {}
+
         self.children = {}
+        self.exits = Queue.Queue()
+
+        # Active sessions per backend (used for balancing).
+        self.active = {}
+
+        # Session start times, and cumulative per-backend accounting
+        # of [sessions started, sessions finished, seconds].
+        self.started = {}
+        self.accounting = {}
+
+        # Sessions (including standby) and clients per "ip:port",
+        # maintained as sessions come and go. These are published
+        # as a snapshot for metrics(), sessions() and pending().
+        self.counts = {}
+        self.clients = {}
+        self.changed = set()
+        self.backend_keys = []
+        self.snapshot = ({}, {}, {})
+
+        # The accounting last reported by metrics().
+        self.reported = {}
+        self.last_metrics = time.time()
 
         # Subscribe to events generated by the producer.
         # NOTE: These are cleaned up in stop().
@@ -135,8 +346,74 @@ class ConnectionConsumer(AtomicRunnable):
     @Atomic.sync
     def set(self, portmap):
         self.portmap = portmap
+        self.backend_ports = {}
+        for (listen, (_, _, _, _, backends, _, _)) in portmap.items():
+            for backend in backends:
+                self.backend_ports.setdefault(tuple(backend), set()).add(listen)
+        self.backend_keys = ["%s:%d" % backend for backend in self.backend_ports]
+
+        # Forget the accounting for backends that are gone.
+        for key in self.accounting.keys():
+            if not key in self.counts and not key in self.backend_keys:
+                del self.accounting[key]
+
+        # Compile the client subnets now, rather than on the first
+        # connection (see _compile_subnets() below).
+        for (_, _, _, _, _, client_subnets, _) in portmap.values():
+            if client_subnets:
+                _compile_subnets(tuple(client_subnets))
+
+        # The portmap has changed. New backends may be available
+        # for any waiting client (or their port may be gone).
+        self.ready.update(self.waiting.keys())
         self._notify()
 
+    @Atomic.sync
+    def locks_changed(self):
+        # Any waiting client may be able to get a backend now.
+        self.ready.update(self.waiting.keys())
+        self._notify()
+
+    def _count(self, key, delta):
+        count = self.counts.get(key, 0) + delta
+        if count > 0:
+            self.counts[key] = count
+        else:
+            self.counts.pop(key, None)
+
+    def _publish(self):
+        # The snapshot is a tuple of (active, sessions, pending). Once
+        # published it is never modified, only replaced, so readers can
+        # use it without taking our lock. Only backends with changed
+        # sessions are copied.
+        (_, sessions, _) = self.snapshot
+        if self.changed:
+            sessions = dict(sessions)
+            for key in self.changed:
+                clients = self.clients.get(key)
+                if clients:
+                    sessions[key] = clients.values()
+                else:
+                    sessions.pop(key, None)
+            self.changed = set()
+
+        active = dict.fromkeys(self.backend_keys, 0)
+        active.update(self.counts)
+
+        pending = {}
+        for (port, waiting) in self.waiting.items():
+            if not(self.portmap.has_key(port)) or not waiting:
+                continue
+            (url, _, _, _, _, _, _) = self.portmap[port]
+            pending[url] = pending.get(url, 0) + len(waiting)
+
+        self.snapshot = (active, sessions, pending)
+
+    def _released(self, ip, port):
+        # A backend lock has been released, so the ports that
+        # use this backend may be able to serve a waiting client.
+        self.ready.update(self.backend_ports.get((ip, port), ()))
+
     @Atomic.sync
     def _stop(self):
         super(ConnectionConsumer, self).stop()
@@ -168,19 +445,14 @@ class ConnectionConsumer(AtomicRunnable):
             return True
 
         # Grab the information for this port.
-        (_, exclusive, disposable, reconnect, backends, client_subnets) = self.portmap[port]
+        (_, exclusive, disposable, reconnect, backends, client_subnets, balancer) = \
+            self.portmap[port]
 
         # Check the subnet.
-        if client_subnets:
-            subnet_okay = False
-            for subnet in client_subnets:
-                if netaddr.ip.IPAddress(str(connection.src[0])) in \
-                   netaddr.ip.IPNetwork(str(subnet)):
-                    subnet_okay = True
-                    break
-            if not subnet_okay:
-                connection.drop()
-                return True
+        if client_subnets and \
+           not str(connection.src[0]) in _compile_subnets(tuple(client_subnets)):
+            connection.drop()
+            return True
 
         # Find a backend IP (exclusive or not).
         ip = None
@@ -197,6 +469,7 @@ class ConnectionConsumer(AtomicRunnable):
                         # NOTE: We will have a lock representing
                         # this connection, but is it already held.
                         del self.standby[(ip, port)]
+                        self._count("%s:%d" % (ip, port), -1)
             if not ip:
                 # Grab the grab the named lock (w/ ip and port).
                 candidates = ["%s:%d" % backend for backend in backends]
@@ -206,69 +479,58 @@ class ConnectionConsumer(AtomicRunnable):
                     (ip, port) = got.split(":", 1)
                     port = int(port)
         else:
-            # Select an IP at random.
-            (ip, port) = backends[random.randint(0, len(backends)-1)]
+            # Let the balancer choose a backend.
+            (ip, port) = balancer.select(self.active, connection.src[0])
 
         if ip and port:
             # Either redirect or drop the connection.
-            child = connection.redirect(ip, port)
+            child = self.engine.redirect(connection, ip, port, self.exited)
             standby_time = (exclusive and reconnect)
             # Note: disposable is either None or a mimumum session time.
             # So set the time to dispose as now + minimum session time,
             # or False.
             dispose_time = (disposable is not None and time.time() + disposable)
 
-            if child is not None:
-                # Start a notification thread. This will
-                # wake up the main consumer thread (so that
-                # the child can be reaped) when the child exits,
-                # but it will also mark the IP as failed if
-                # an error ultimately lead to the exit.
-                def closure(child_pid, error_fn, notify_fn):
-                    def fn():
-                        while True:
-                            try:
-                                (pid, status) = os.waitpid(child_pid, 0)
-                                if pid == child_pid:
-                                    break
-                            except (TypeError, OSError):
-                                (pid, status) = (child_pid, 0)
-                                break
-
-                        if os.WEXITSTATUS(status) > 0:
-                            # Notify the high-level manager about an error
-                            # found on this IP. This may ultimately result in
-                            # the instance being terminated, etc.
-                            error_fn()
-
-                        # Wait up the consumer that it may reap this
-                        # process and accept any new incoming connections.
-                        notify_fn()
-
-                    return fn
-
-                # Start threads that will wait for the child process.
-                # NOTE: Unlike most other threads in the system, these
-                # threads are *not* daemon threads. We want them to keep
-                # everything alive so that our Zookeeper locks are properly
-                # maintained while the socat processes are alive.
-                def error_fn():
-                    self.error_notify("%s:%d" % (ip, port))
-                t = threading.Thread(target=closure(
-                    child, error_fn, utils.callback(self.notify)))
-                t.start()
+            if child is None:
+                # The client can't be redirected, and retrying it would
+                # hold up everyone behind it. So it is dropped (and the
+                # backend given back, as nobody is using it).
+                logging.warn("Dropping connection from %s: unable to redirect to %s:%d",
+                    _as_client(*(connection.src)), ip, port)
+                connection.drop()
+                if exclusive:
+                    self.locks.remove("%s:%d" % (ip, port))
+                    self._released(ip, port)
+                self.error_notify("%s:%d" % (ip, port))
+                return True
 
+            if child is not None:
                 self.children[child] = (
                     ip,
                     port,
                     connection,
                     standby_time,
                     dispose_time)
+                self.active[(ip, port)] = self.active.get((ip, port), 0) + 1
+                key = "%s:%d" % (ip, port)
+                self._count(key, 1)
+                self.clients.setdefault(key, {})[child] = \
+                    _as_client(*(connection.src))
+                self.changed.add(key)
+                self.started[child] = time.time()
+                self.accounting.setdefault(key, [0, 0, 0.0])[0] += 1
 
                 return True
 
         return False
 
+    def exited(self, child, error):
+        # Called by the engine (from any thread) once a redirected
+        # connection has finished. This will wake up the main consumer
+        # thread so that the child can be reaped.
+        self.exits.put((child, error))
+        self.notify()
+
     @Atomic.sync
     def clear_standby(self, force=False):
         removed = []
@@ -284,142 +546,203 @@ class ConnectionConsumer(AtomicRunnable):
                 removed.append((ip, port))
         for (ip, port) in removed:
             del self.standby[(ip, port)]
+            self._count("%s:%d" % (ip, port), -1)
+            self._released(ip, port)
         return len(removed)
 
+    @Atomic.sync
+    def enqueue(self, connection):
+        port = connection.dst[1]
+        waiting = self.waiting.get(port)
+        if waiting:
+            # Other clients are already waiting on this port,
+            # so this one gets in line behind them.
+            waiting.append(connection)
+        elif not self.handle(connection):
+            self.waiting[port] = collections.deque([connection])
+
+    @Atomic.sync
+    def serve(self):
+        served = 0
+        while self.ready:
+            port = self.ready.pop()
+            waiting = self.waiting.get(port)
+            while waiting:
+                # If there is no backend for the client at the head of
+                # the line, there is none for anyone behind it either.
+                # We'll try again when a backend is released (or the
+                # backends for this port change).
+                if not self.handle(waiting[0]):
+                    break
+                waiting.popleft()
+                served += 1
+            if not waiting:
+                self.waiting.pop(port, None)
+        return served
+
+    def _timeout(self, now):
+        deadlines = [timeout for (timeout, _) in self.standby.values()]
+        if not deadlines:
+            return None
+        return max(min(deadlines) - now, 0)
+
     @Atomic.sync
     def run(self):
+        published = time.time()
         while self.is_running():
             connection = self.producer.next()
 
             # Service connection, if any.
             if connection:
-                if not self.handle(connection):
-                    # now, we add it to the list of postponed
-                    # connections, which we will try again shortly.
-                    self.postponed.append(connection)
+                self.enqueue(connection)
+
+                # Don't let the snapshot go stale if the
+                # producer queue never runs dry.
+                now = time.time()
+                if now - published >= PUBLISH_INTERVAL:
+                    self._publish()
+                    published = now
 
                 # Continue servicing connections while
                 # there is an active queue in the producer.
                 continue
 
-            # Try servicing postponed connections.
-            new_postponed = []
-            for connection in self.postponed:
-                if not self.handle(connection):
-                    # Arg, still not handled. We keep the connection
-                    # on our list of postponed connections and continue.
-                    new_postponed.append(connection)
-            self.postponed = new_postponed
-
-            # Clear any standby IPs.
-            if self.clear_standby():
-                continue
+            # Expired standby locks and exited children
+            # both release backends (and mark ports ready).
+            self.clear_standby()
+            self.reap_children()
 
-            # Reap children.
-            if self.reap_children():
-                continue
+            # Hand released backends to waiting clients.
+            self.serve()
 
-            # Wait for a second.
-            # This will be waken by either producer events,
-            # or by more backends appearing that may make
-            # available new backends for us to schedule.
-            # The only event that won't wake this is an
-            # existing connection expiring.
-            self._wait(1.0)
+            # Make the current state visible to readers.
+            self._publish()
+            published = time.time()
+
+            # Wait for the next event. This will be woken by
+            # producer events, exiting children, portmap and lock
+            # changes, or when the next standby lock is due.
+            self._wait(self._timeout(time.time()))
 
     def reap_children(self):
         reaped = 0
 
-        # Reap dead children.
-        for child in self.children.keys():
+        # Reap children that have exited.
+        while True:
             try:
-                # Check if child is alive.
-                os.kill(child, 0)
-            except OSError:
-                # Not alive - remove from children list.
-                (ip, port, _, standby_time, dispose_time) = self.children[child]
-                del self.children[child]
-                reaped += 1
-
-                # If VMs are disposable, make sure the minimum
-                # amount of session time has passed.
-                dispose = dispose_time and time.time() >= dispose_time
-
-                # If reconnect and exclusive is on, then
-                # we add this connection to the standby list.
-                # NOTE: At this point, you only get on the standby
-                # list if the IP is exclusive and with reconnect.
-                # This means that it will *not* get selected again
-                # and the only necessary means of removing the IP
-                # is through the clear_standby() hook.
-                if standby_time:
-                    self.standby[(ip, port)] = \
-                        (time.time() + standby_time, dispose)
-                else:
-                    if dispose:
-                        self.discard_notify(ip)
-                    self.locks.remove("%s:%d" % (ip, port))
+                (child, error) = self.exits.get(block=False)
+            except Queue.Empty:
+                break
+            if not child in self.children:
+                continue
+
+            # Remove from children list.
+            (ip, port, _, standby_time, dispose_time) = self.children[child]
+            del self.children[child]
+            reaped += 1
+            count = self.active.get((ip, port), 0) - 1
+            if count > 0:
+                self.active[(ip, port)] = count
+            else:
+                self.active.pop((ip, port), None)
+            key = "%s:%d" % (ip, port)
+            clients = self.clients.get(key, {})
+            clients.pop(child, None)
+            if not clients:
+                self.clients.pop(key, None)
+            self.changed.add(key)
+            started = self.started.pop(child, None)
+            if started is not None:
+                accounting = self.accounting.setdefault(key, [0, 0, 0.0])
+                accounting[1] += 1
+                accounting[2] += time.time() - started
+
+            if error:
+                # Notify the high-level manager about an error
+                # found on this IP. This may ultimately result in
+                # the instance being terminated, etc.
+                self.error_notify("%s:%d" % (ip, port))
+
+            # If VMs are disposable, make sure the minimum
+            # amount of session time has passed.
+            dispose = dispose_time and time.time() >= dispose_time
+
+            # If reconnect and exclusive is on, then
+            # we add this connection to the standby list.
+            # NOTE: At this point, you only get on the standby
+            # list if the IP is exclusive and with reconnect.
+            # This means that it will *not* get selected again
+            # and the only necessary means of removing the IP
+            # is through the clear_standby() hook.
+            if standby_time:
+                # NOTE: The session is still counted while on standby.
+                self.standby[(ip, port)] = \
+                    (time.time() + standby_time, dispose)
+            else:
+                if dispose:
+                    self.discard_notify(ip)
+                self.locks.remove(key)
+                self._count(key, -1)
+                self._released(ip, port)
 
         # Return the number of children reaped.
         # This means that callers can do if self.reap_children().
         return reaped
 
-    @Atomic.sync
     def pending(self):
-        pending = {}
-        for connection in self.postponed:
-            # Index by the destination port.
-            port = connection.dst[1]
-            if not(self.portmap.has_key(port)):
-                continue
-
-            # Get the associated URL for the postponed connection.
-            (url, _, _, _, _, _) = self.portmap[port]
-            if not pending.has_key(url):
-                pending[url] = 1
-            else:
-                pending[url] += 1
+        # NOTE: This doesn't take our lock (see _publish()).
+        (_, _, pending) = self.snapshot
         return pending
 
-    @Atomic.sync
     def metrics(self):
-        metric_map = {}
+        # NOTE: This doesn't take our lock (see _publish()).
+        # The accounting is cumulative, so we report the difference
+        # from the last call. The counters are only ever incremented
+        # in place, so at worst we miss an update until next time.
+        (active, _, _) = self.snapshot
 
-        # Set the active metric for all known backends to zero.
-        for (_, _, _, _, backends, _) in self.portmap.values():
-            for (ip, port) in backends:
-                metric_map["%s:%d" % (ip, port)] = [{ "active" : (1, 0) }]
+        now = time.time()
+        elapsed = max(now - self.last_metrics, 1.0)
+        self.last_metrics = now
 
-        # Add 1 for every active connection we're tracking.
-        ports = ["%s:%d" % (ip, port) for (ip, port, _, _, _) in self.children.values()]
-        ports.extend(["%s:%d" % (ip, port) for (ip, port) in self.standby.keys()])
-
-        for port in ports:
-            if not port in metric_map:
-                # Set the current active count to one.
-                # NOTE: This must be an ip that is no longer
-                # in the portmap, but we can still report it.
-                metric_map[port] = [{ "active" : (1, 1) }]
-            else:
-                # Add one to our current active count.
-                cur_count = metric_map[port][0]["active"][1]
-                metric_map[port][0]["active"] = (1, cur_count+1)
+        # The throughput (if the engine can measure it).
+        traffic = self.engine.traffic()
 
+        metric_map = {}
+        reported = {}
+        for (key, count) in active.items():
+            metrics = { "active" : (1, count) }
+
+            # Add the session rate and length since the last call.
+            current = tuple(self.accounting.get(key, (0, 0, 0.0)))
+            last = self.reported.get(key, (0, 0, 0.0))
+            if current[0] < last[0] or current[1] < last[1]:
+                # The accounting was reset.
+                last = (0, 0, 0.0)
+            (started, finished, seconds) = \
+                [now_value - last_value for (now_value, last_value) in zip(current, last)]
+            reported[key] = current
+            metrics["rate"] = (1, started / elapsed)
+            if finished:
+                # Weighted by the number of sessions, so that
+                # averaging across backends gives the mean length.
+                metrics["session_seconds"] = (finished, seconds / finished)
+
+            if traffic is not None:
+                (ip, port) = key.rsplit(":", 1)
+                (bytes_in, bytes_out) = traffic.get((ip, int(port)), (0, 0))
+                metrics["bytes_in"] = (1, bytes_in / elapsed)
+                metrics["bytes_out"] = (1, bytes_out / elapsed)
+
+            metric_map[key] = [metrics]
+
+        self.reported = reported
         return metric_map
 
-    @Atomic.sync
     def sessions(self):
-        session_map = {}
-        for (ip, port, conn, _, _) in self.children.values():
-            (src_ip, src_port) = conn.src
-            portinfo = "%s:%d" % (ip, port)
-            # We store clients as ip:port pairs.
-            # This matters for below, where we must match
-            # in order to drop the session.
-            ip_sessions = session_map.get(portinfo, [])
-            ip_sessions.append(_as_client(src_ip, src_port))
-            session_map[portinfo] = ip_sessions
-        return session_map
+        # NOTE: This doesn't take our lock (see _publish()).
+        (_, sessions, _) = self.snapshot
+        return sessions
 
     @Atomic.sync
     def drop_session(self, client, backend):
@@ -428,11 +751,7 @@ class ConnectionConsumer(AtomicRunnable):
             (src_ip, src_port) = conn.src
             portinfo = "%s:%d" % (ip, port)
             if client == _as_client(src_ip, src_port) and backend == portinfo:
-                try:
-                    os.kill(child, signal.SIGTERM)
-                except OSError:
-                    # The process no longer exists.
-                    pass
+                self.engine.kill(child)
 
 class ConnectionProducer(AtomicRunnable):
 
@@ -444,33 +763,33 @@ class ConnectionProducer(AtomicRunnable):
     # above, and when these objects are deleted,
     # they will explicitly drop the connection.
 
-    def __init__(self):
+    def __init__(self, backlog=DEFAULT_BACKLOG, reuseport=False, queue=None):
         super(ConnectionProducer, self).__init__()
 
-        self.epoll = None
-        self.queue = Queue.Queue()
+        self.epoll = select.epoll()
+        if queue is None:
+            queue = Queue.Queue()
+        self.queue = queue
+        self.backlog = backlog
+        self.reuseport = reuseport
         self.sockets = {}
         self.filemap = {}
         self.notifiers = []
+        self.accepted = {}
+        self.errors = {}
         self.set()
 
-        self._update_epoll()
-
         # Start the thread.
         super(ConnectionProducer, self).start()
 
-    @Atomic.sync
-    def _stop(self):
-        super(ConnectionProducer, self).stop()
-
-        if hasattr(self.epoll, 'close'):
-            self.epoll.close()
-
     def stop(self):
         # Stop the thread.
-        self._stop()
+        super(ConnectionProducer, self).stop()
         self.join()
 
+        # Only close once nothing is polling.
+        self.epoll.close()
+
     @Atomic.sync
     def set(self, ports=None):
         if ports is None:
@@ -481,21 +800,31 @@ class ConnectionProducer(AtomicRunnable):
             if not(self.sockets.has_key(port)):
                 sock = socket.socket()
                 sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if self.reuseport:
+                    # Allow other workers to listen on the same port,
+                    # and let the kernel balance accepts between us.
+                    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
                 try:
                     sock.bind(("", port))
                 except IOError as ioe:
                     # Can't bind this port (likely already in use), so skip it.
                     logging.warning("Can't bind port %d: %s", port, ioe.strerror)
                     continue
-                sock.listen(10)
+                sock.setblocking(0)
+                sock.listen(self.backlog)
                 self.sockets[port] = sock
                 self.filemap[sock.fileno()] = sock
+                self.epoll.register(sock.fileno(), select.EPOLLIN)
 
         ports_to_delete = []
         for port in self.sockets:
             if not(port in ports):
                 sock = self.sockets[port]
                 del self.filemap[sock.fileno()]
+                try:
+                    self.epoll.unregister(sock.fileno())
+                except (IOError, ValueError):
+                    pass
                 sock.close()
                 ports_to_delete.append(port)
 
@@ -503,14 +832,6 @@ class ConnectionProducer(AtomicRunnable):
         for port in ports_to_delete:
             del self.sockets[port]
 
-        self._update_epoll()
-
-    @Atomic.sync
-    def _update_epoll(self):
-        self.epoll = select.epoll()
-        for sock in self.sockets.values():
-            self.epoll.register(sock.fileno(), select.EPOLLIN)
-
     @Atomic.sync
     def subscribe(self, cb):
         self.notifiers.append(cb)
@@ -545,22 +866,86 @@ class ConnectionProducer(AtomicRunnable):
 
             # Scan the events and accept.
             for fileno, event in events:
-                if not(fileno in self.filemap):
-                    # Stale connection. Update epoll.
-                    self._update_epoll()
+                sock = self.filemap.get(fileno)
+                if sock is None:
+                    # The port was removed after the poll returned,
+                    # and the socket has already been unregistered.
                     continue
 
                 # Check that it's a read event.
                 assert (event & select.EPOLLIN) == select.EPOLLIN
 
+                # Accept everything that is waiting.
+                if self.accept(sock):
+                    # Notify all listens that there
+                    # are new connections available.
+                    self.notify()
+
+    def accept(self, sock):
+        accepted = 0
+        while True:
+            try:
                 # Create a new connection object.
-                sock = self.filemap[fileno]
                 connection = Accept(sock)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                elif e.errno == errno.EINTR:
+                    continue
+                # The connection was aborted, or we're out of
+                # file descriptors. Either way, it's gone.
+                logging.warning("Error accepting connection: %s", e)
+                self._count(self.errors, sock, 1)
+                break
+            self.queue.put(connection)
+            accepted += 1
+        if accepted:
+            self._count(self.accepted, sock, accepted)
+        return accepted
 
-                # Notify all listens that there
-                # are new connections available.
-                self.queue.put(connection)
-                self.notify()
+    @Atomic.sync
+    def _count(self, counters, sock, count):
+        try:
+            port = sock.getsockname()[1]
+        except socket.error:
+            return
+        counters[port] = counters.get(port, 0) + count
+
+    @Atomic.sync
+    def stats(self):
+        """
+        Returns { port : (accepted, errors, queued) }, where accepted and
+        errors (failed accept() calls) are counted since the last call and
+        queued is the current depth of the kernel accept queue (if known).
+        """
+        result = {}
+        for (port, sock) in self.sockets.items():
+            result[port] = (
+                self.accepted.get(port, 0),
+                self.errors.get(port, 0),
+                _accept_queue_depth(sock))
+        self.accepted = {}
+        self.errors = {}
+        return result
+
+class TcpManagerConfig(Config):
+
+    engine = Config.select(label="Proxy Engine", default="proxy",
+        options=[
+            ("In-process proxy", "proxy"),
+            ("Socat (process per connection)", "socat")],
+        description="How accepted connections are relayed to backends.")
+
+    backlog = Config.integer(label="Listen Backlog", default=DEFAULT_BACKLOG,
+        validate=lambda self: self.backlog > 0 or \
+            Config.error("The backlog must be positive."),
+        description="The kernel accept queue length for each listening port.")
+
+    accept_workers = Config.integer(label="Accept Workers", default=1,
+        validate=lambda self: self.accept_workers > 0 or \
+            Config.error("There must be at least one accept worker."),
+        description="Number of threads accepting on each port. More than one" \
+                    + " uses SO_REUSEPORT, so the kernel balances between them.")
 
 class TcpEndpointConfig(Config):
 
@@ -588,10 +973,22 @@ class TcpEndpointConfig(Config):
     client_subnets = Config.list(label="Client Subnets", order=7,
         description="Only allow connections from these client subnets.")
 
+    balance = Config.select(label="Balancing", default="random",
+        options=[
+            ("Random", "random"),
+            ("Weighted random", "weighted"),
+            ("Weighted round-robin", "roundrobin"),
+            ("Least connections", "leastconn"),
+            ("Power of two choices", "p2c"),
+            ("Source IP hash", "hash")],
+        description="How backends are chosen for each connection, when" \
+                    + " instances are not used exclusively.")
+
 class Connection(LoadBalancerConnection):
 
     """ Managed TCP """
 
+    _MANAGER_CONFIG_CLASS = TcpManagerConfig
     _ENDPOINT_CONFIG_CLASS = TcpEndpointConfig
     _SUPPORTED_URLS = {
         "tcp://([1-9][0-9]*)": lambda m: int(m.group(1))
@@ -599,37 +996,80 @@ class Connection(LoadBalancerConnection):
 
     producer = None
     consumer = None
+    engine = None
 
     def __init__(self,
                  zkobj=None,
                  error_notify=None,
                  discard_notify=None,
                  **kwargs):
+        self.workers = []
         super(Connection, self).__init__(**kwargs)
 
         self.portmap = {}
         self.active = set()
-        self.locks = zkobj and zkobj._cast_as(IPAddresses)
+        # NOTE: The locks are mirrored locally, so that assigning
+        # backends only goes to Zookeeper to actually take a lock.
+        self.locks = zkobj and \
+            LockCache(zkobj._cast_as(IPAddresses), update=self._locks_changed)
 
-        self.producer = ConnectionProducer()
+        if self._manager_config().engine == "socat":
+            self.engine = SocatEngine()
+        else:
+            self.engine = ProxyEngine()
+
+        # All accept workers feed the same queue.
+        manager_config = self._manager_config()
+        reuseport = manager_config.accept_workers > 1
+        self.producer = ConnectionProducer(
+            backlog=manager_config.backlog,
+            reuseport=reuseport)
+        self.workers = [
+            ConnectionProducer(
+                backlog=manager_config.backlog,
+                reuseport=reuseport,
+                queue=self.producer.queue)
+            for _ in range(manager_config.accept_workers - 1)
+        ]
         self.consumer = ConnectionConsumer(
             self.locks,
             error_notify,
             discard_notify,
-            self.producer)
+            self.producer,
+            engine=self.engine)
+        for worker in self.workers:
+            worker.subscribe(self.consumer.notify)
+        self.last_metrics = time.time()
+
+        # This only reads our own counters, so it's done in metrics().
+        self.collector.register("sessions", self._collect_metrics,
+            background=False)
 
     def __del__(self):
+        for worker in self.workers:
+            worker.unsubscribe(self.consumer.notify)
+            worker.set([])
+            worker.stop()
         if self.producer:
             self.producer.set([])
             self.producer.stop()
         if self.consumer:
-            self.consumer.set([])
+            self.consumer.set({})
             self.consumer.stop()
+        if self.engine:
+            self.engine.stop()
+        super(Connection, self).__del__()
+
+    def _locks_changed(self):
+        # Locks may have been released by another manager.
+        if self.consumer:
+            self.consumer.locks_changed()
 
     def dropped(self, ip):
         # Ensure the locks are gone.
         self.locks.remove(ip)
 
+    @Atomic.sync
     def change(self, url, backends, config=None):
         # Grab the listen port.
         listen = self.url_info(url)
@@ -639,8 +1079,10 @@ class Connection(LoadBalancerConnection):
             if backend.port == listen and
                is_local(backend.ip)]
 
-        # Clear existing data.
+        # Clear existing data (but keep the balancer).
+        balancer = None
         if self.portmap.has_key(listen):
+            balancer = self.portmap[listen][6]
             del self.portmap[listen]
 
         if len(looping_ips) > 0:
@@ -656,9 +1098,16 @@ class Connection(LoadBalancerConnection):
         portmap_backends = []
         for backend in backends:
             portmap_backends.append((backend.ip, backend.port))
+        # NOTE: The balancer is only replaced if the algorithm has changed,
+        # otherwise it keeps its state (e.g. the round-robin position).
+        balancer = balance.create(
+            config.balance,
+            portmap_backends,
+            weights=[backend.weight for backend in backends],
+            balancer=balancer)
 
         # Update the portmap (including exclusive info).
-        # NOTE: The reconnect/exclusive/client_subnets parameters
+        # NOTE: The reconnect/exclusive/client_subnets/balancer parameters
         # control how backends are mapped by the consumer, how machines
         # are cleaned up, etc. See the Consumer class and the metrics()
         # function below to understand the interactions there.
@@ -670,14 +1119,56 @@ class Connection(LoadBalancerConnection):
             (config.disposable or None) and config.dispose_min,
             config.reconnect,
             portmap_backends,
-            config.client_subnets)
+            config.client_subnets,
+            balancer)
+
+    def _render(self):
+        # The balancers are updated in place, so they are represented
+        # here by their algorithm and weights.
+        return repr(sorted([
+            (listen, info[:-1] + (info[-1].__class__.__name__, info[-1].weights))
+            for (listen, info) in self.portmap.items()]))
 
-    def save(self):
+    def _commit(self, output):
         self.consumer.set(self.portmap)
         self.producer.set(self.portmap.keys())
+        for worker in self.workers:
+            worker.set(self.portmap.keys())
 
-    def metrics(self):
-        return self.consumer.metrics()
+    def _collect_metrics(self):
+        metric_map = self.consumer.metrics()
+
+        now = time.time()
+        elapsed = max(now - self.last_metrics, 1.0)
+        self.last_metrics = now
+
+        # Combine the accept counters from all workers.
+        stats = {}
+        for producer in [self.producer] + self.workers:
+            for (port, (accepted, errors, queued)) in producer.stats().items():
+                (total_accepted, total_errors, total_queued) = \
+                    stats.get(port, (0, 0, 0))
+                stats[port] = (
+                    total_accepted + accepted,
+                    total_errors + errors,
+                    total_queued + (queued or 0))
+
+        # Report the port counters as an even share for each backend,
+        # so that the totals across the endpoint come out right.
+        for (port, (_, _, _, _, backends, _, _)) in self.portmap.items():
+            if not port in stats or not backends:
+                continue
+            (accepted, errors, queued) = stats[port]
+            share = float(len(backends))
+            for (ip, backend_port) in backends:
+                key = "%s:%d" % (ip, backend_port)
+                metric_map.setdefault(key, []).append({
+                    "accepts" : (1, accepted / elapsed / share),
+                    "accept_errors" : (1, errors / elapsed / share),
+                    "accept_queue" : (1, queued / share),
+                })
+
+        return metric_map
 
     def sessions(self):
         return self.consumer.sessions()
@@ -689,4 +1180,4 @@ class Connection(LoadBalancerConnection):
         return self.consumer.pending()
 
     def is_available(self):
-        return binary_exists("socat")
+        return self._manager_config().engine != "socat" or binary_exists("socat")
@@ -0,0 +1,462 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+An in-process TCP proxy.
+
+Rather than forking a socat process for every connection, all proxied
+connections are serviced by a single epoll loop. Where available, data is
+moved between the sockets with splice() through a pipe (so it is never
+copied into userspace), otherwise we fall back to a plain buffered relay.
+"""
+
+import os
+import errno
+import fcntl
+import socket
+import select
+import logging
+import ctypes
+import ctypes.util
+
+from reactor.atomic import Atomic
+from reactor.atomic import AtomicRunnable
+
+# The amount of data moved per operation.
+CHUNK_SIZE = 65536
+
+SPLICE_F_MOVE = 0x1
+SPLICE_F_NONBLOCK = 0x2
+
+def _load_splice():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fn = libc.splice
+    except (OSError, AttributeError, TypeError):
+        return None
+    fn.argtypes = [
+        ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint
+    ]
+    fn.restype = ctypes.c_ssize_t
+    return fn
+
+_splice = _load_splice()
+
+def splice_available():
+    return _splice is not None
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+# Errors which indicate that an operation should simply be retried later.
+_RETRY = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+class BufferChannel(object):
+
+    """
+    One direction of a proxied connection (data is copied via a buffer).
+    """
+
+    def __init__(self, src, dst, counter=None, index=0):
+        super(BufferChannel, self).__init__()
+        self.src = src
+        self.dst = dst
+        self.eof = False
+        self.bytes = 0
+        self.counter = counter
+        self.index = index
+        self.buffer = ""
+
+    def pending(self):
+        return len(self.buffer)
+
+    def fill(self):
+        """ Read from the source. Returns False if nothing was available. """
+        try:
+            data = os.read(self.src, CHUNK_SIZE)
+        except OSError, e:
+            if e.errno in _RETRY:
+                return False
+            raise
+        if not data:
+            self.eof = True
+        self.buffer = data
+        return True
+
+    def drain(self):
+        """ Write to the destination. Returns True when all data is out. """
+        while self.buffer:
+            try:
+                n = os.write(self.dst, self.buffer)
+            except OSError, e:
+                if e.errno in _RETRY:
+                    return False
+                raise
+            self.bytes += n
+            if self.counter is not None:
+                self.counter[self.index] += n
+            self.buffer = self.buffer[n:]
+        return True
+
+    def close(self):
+        self.buffer = ""
+
+class SpliceChannel(object):
+
+    """
+    One direction of a proxied connection (data is spliced via a pipe).
+    """
+
+    def __init__(self, src, dst, counter=None, index=0):
+        super(SpliceChannel, self).__init__()
+        self.src = src
+        self.dst = dst
+        self.eof = False
+        self.bytes = 0
+        self.counter = counter
+        self.index = index
+        self.count = 0
+        (self.rpipe, self.wpipe) = os.pipe()
+        _set_nonblocking(self.rpipe)
+        _set_nonblocking(self.wpipe)
+
+    def pending(self):
+        return self.count
+
+    @staticmethod
+    def _splice(fd_in, fd_out, length):
+        n = _splice(fd_in, None, fd_out, None, length,
+                    SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in _RETRY:
+                return None
+            raise OSError(err, os.strerror(err))
+        return n
+
+    def fill(self):
+        n = self._splice(self.src, self.wpipe, CHUNK_SIZE)
+        if n is None:
+            return False
+        if n == 0:
+            self.eof = True
+        self.count += n
+        return True
+
+    def drain(self):
+        while self.count > 0:
+            n = self._splice(self.rpipe, self.dst, self.count)
+            if n is None:
+                return False
+            self.bytes += n
+            if self.counter is not None:
+                self.counter[self.index] += n
+            self.count -= n
+        return True
+
+    def close(self):
+        for fd in (self.rpipe, self.wpipe):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+class ProxySession(object):
+
+    """
+    A single client connection proxied to a backend.
+    """
+
+    def __init__(self, sid, client, backend, use_splice=True, counter=None):
+        super(ProxySession, self).__init__()
+        self.sid = sid
+        self.client = client
+        self.backend = backend
+        self.counter = counter
+        self.connected = False
+        self.error = False
+        self.masks = {}
+        self.hungup = set()
+
+        if use_splice and splice_available():
+            channel = SpliceChannel
+        else:
+            channel = BufferChannel
+        # The counter (if given) is [bytes_in, bytes_out, sessions]
+        # for the backend, and is shared by all sessions to it.
+        self.upstream = channel(client.fileno(), backend.fileno(),
+                                counter=counter, index=0)
+        self.downstream = channel(backend.fileno(), client.fileno(),
+                                  counter=counter, index=1)
+        self._shutdown = set()
+
+    def bytes_in(self):
+        return self.upstream.bytes
+
+    def bytes_out(self):
+        return self.downstream.bytes
+
+    def _pump(self, channel, dst):
+        while True:
+            if channel.pending() and not channel.drain():
+                # The destination is full.
+                return
+            if channel.eof:
+                if not dst in self._shutdown:
+                    self._shutdown.add(dst)
+                    try:
+                        dst.shutdown(socket.SHUT_WR)
+                    except socket.error:
+                        pass
+                return
+            if not channel.fill():
+                # The source is empty.
+                return
+
+    def pump(self, ready_backend=False):
+        """
+        Move as much data as possible. Returns False once the session
+        is finished (and should be closed).
+        """
+        if not self.connected:
+            if not ready_backend:
+                return True
+            err = self.backend.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                logging.warn("Unable to connect to backend: %s", os.strerror(err))
+                self.error = True
+                return False
+            self.connected = True
+
+        try:
+            self._pump(self.upstream, self.backend)
+            self._pump(self.downstream, self.client)
+        except (OSError, IOError, socket.error):
+            # The connection has been reset.
+            return False
+
+        return not (self.upstream.eof and not self.upstream.pending() and \
+                    self.downstream.eof and not self.downstream.pending())
+
+    def interest(self):
+        """ Returns the epoll masks for the (client, backend) sockets. """
+        if not self.connected:
+            return (0, select.EPOLLOUT)
+        client = 0
+        backend = 0
+        if self.upstream.pending():
+            backend |= select.EPOLLOUT
+        elif not self.upstream.eof:
+            client |= select.EPOLLIN
+        if self.downstream.pending():
+            client |= select.EPOLLOUT
+        elif not self.downstream.eof:
+            backend |= select.EPOLLIN
+        return (client, backend)
+
+    def close(self):
+        self.upstream.close()
+        self.downstream.close()
+        self.client.close()
+        self.backend.close()
+
+class ProxyEngine(AtomicRunnable):
+
+    """
+    Proxies accepted connections to their backends in-process.
+
+    Each redirected connection is identified by a session id, which is
+    returned from redirect() and passed to the exit callback when the
+    session finishes (see SocatEngine for the fork-based equivalent).
+    """
+
+    def __init__(self, use_splice=True):
+        super(ProxyEngine, self).__init__()
+        self.daemon = True
+        self.use_splice = use_splice
+        self.epoll = select.epoll()
+        self.sessions = {}
+        self.fdmap = {}
+        self.callbacks = {}
+        self.counters = {}
+        self.next_sid = 1
+
+        # Start the thread.
+        self.start()
+
+    @Atomic.sync
+    def redirect(self, connection, host, port, exited):
+        if connection.fd is None:
+            return None
+
+        # Start connecting before touching the client socket, so
+        # that a failure leaves the connection with the caller.
+        backend = None
+        try:
+            (family, socktype, proto, _, address) = \
+                socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            backend = socket.socket(family, socktype, proto)
+            backend.setblocking(0)
+            err = backend.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS):
+                raise socket.error(err, os.strerror(err))
+        except socket.error, e:
+            # NOTE: This includes socket.gaierror (for bad hosts).
+            logging.warn("Unable to connect to %s:%d: %s", host, port, str(e))
+            if backend is not None:
+                backend.close()
+            return None
+
+        # Take ownership of the client socket.
+        client = socket.fromfd(connection.fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(connection.fd)
+        connection.fd = None
+        client.setblocking(0)
+
+        sid = self.next_sid
+        self.next_sid += 1
+        counter = self.counters.setdefault((host, port), [0, 0, 0])
+        counter[2] += 1
+        session = ProxySession(sid, client, backend,
+                               use_splice=self.use_splice, counter=counter)
+        self.sessions[sid] = session
+        self.callbacks[sid] = exited
+        self.fdmap[client.fileno()] = session
+        self.fdmap[backend.fileno()] = session
+        self._update(session)
+        return sid
+
+    def _update(self, session):
+        # Register or modify our interest in each socket.
+        for (sock, mask) in zip((session.client, session.backend), session.interest()):
+            fd = sock.fileno()
+            if fd in session.hungup:
+                continue
+            old = session.masks.get(fd)
+            if old == mask:
+                continue
+            if old is None:
+                self.epoll.register(fd, mask)
+            else:
+                self.epoll.modify(fd, mask)
+            session.masks[fd] = mask
+
+    def _hangup(self, session, fd):
+        # Nothing more will happen on this socket, but we may still be
+        # flushing data in the other direction. We stop polling it, as
+        # a hung up socket is always reported as ready.
+        session.hungup.add(fd)
+        if fd in session.masks:
+            self.epoll.unregister(fd)
+            del session.masks[fd]
+
+    def _close(self, session):
+        for fd in session.masks.keys():
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError):
+                pass
+        for sock in (session.client, session.backend):
+            if self.fdmap.get(sock.fileno()) is session:
+                del self.fdmap[sock.fileno()]
+        session.masks = {}
+        session.close()
+        session.counter[2] -= 1
+        del self.sessions[session.sid]
+        return (self.callbacks.pop(session.sid), session.sid, session.error)
+
+    @Atomic.sync
+    def _kill(self, sid):
+        session = self.sessions.get(sid)
+        if session is None:
+            return []
+        return [self._close(session)]
+
+    def kill(self, sid):
+        for (exited, sid, error) in self._kill(sid):
+            exited(sid, error)
+
+    @Atomic.sync
+    def stats(self, sid):
+        session = self.sessions.get(sid)
+        if session is None:
+            return None
+        return (session.bytes_in(), session.bytes_out())
+
+    @Atomic.sync
+    def traffic(self):
+        """
+        Returns { (host, port) : (bytes_in, bytes_out) } for each backend,
+        counting the bytes relayed since the last call.
+        """
+        result = {}
+        for (backend, counter) in self.counters.items():
+            result[backend] = (counter[0], counter[1])
+            counter[0] = 0
+            counter[1] = 0
+            if counter[2] == 0:
+                # No sessions left to count.
+                del self.counters[backend]
+        return result
+
+    @Atomic.sync
+    def _process(self, events):
+        closed = []
+        for (fd, event) in events:
+            session = self.fdmap.get(fd)
+            if session is None:
+                # Closed as part of an earlier event.
+                continue
+            ready_backend = (fd == session.backend.fileno())
+            if event & select.EPOLLERR or \
+               (event & select.EPOLLHUP and not session.connected):
+                # Failing to connect is an error with the backend
+                # (but the client giving up while we connect is not).
+                session.error = ready_backend and not session.connected
+                closed.append(self._close(session))
+            elif not session.pump(ready_backend=ready_backend):
+                closed.append(self._close(session))
+            else:
+                if event & select.EPOLLHUP:
+                    self._hangup(session, fd)
+                self._update(session)
+        return closed
+
+    def run(self):
+        while self.is_running():
+            try:
+                events = self.epoll.poll(1)
+            except IOError:
+                # Interrupted system call.
+                continue
+
+            # Notify owners of finished sessions (without our lock).
+            for (exited, sid, error) in self._process(events):
+                exited(sid, error)
+
+    @Atomic.sync
+    def _stop(self):
+        super(ProxyEngine, self).stop()
+        closed = [self._close(session) for session in self.sessions.values()]
+        return closed
+
+    def stop(self):
+        for (exited, sid, error) in self._stop():
+            exited(sid, error)
+        self.join()
+        self.epoll.close()
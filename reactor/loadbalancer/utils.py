@@ -14,8 +14,11 @@
 #    under the License.
 
 import os
+import tempfile
 import subprocess
 
+from reactor.utils import sha_hash
+
 def read_pid(pid_file):
     if os.path.exists(pid_file):
         pid_file = open(pid_file, 'r')
@@ -38,3 +41,51 @@ def binary_exists(binary):
 
     # Return true if successful.
     return which.returncode == 0
+
+def write_atomic(path, data, mode=0644):
+    # Write to a temporary file alongside, and rename it into place,
+    # so that readers only ever see the old or the new contents. The
+    # temporary file is hidden, as programs reading a whole directory
+    # (e.g. dnsmasq) generally skip those.
+    (fd, temp_path) = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".",
+        prefix=".%s." % os.path.basename(path))
+    try:
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.chmod(temp_path, mode)
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+class FragmentCache(object):
+
+    """
+    Rendered configuration fragments (e.g. one per endpoint).
+
+    A fragment is only rendered again when the values it is rendered
+    from change, so the work done for a save depends on the endpoints
+    which have changed rather than on all of the endpoints.
+    """
+
+    def __init__(self):
+        super(FragmentCache, self).__init__()
+        self.fragments = {}
+
+    def render(self, name, render, **kwargs):
+        # NOTE: The values must all have a stable repr().
+        key = sha_hash(repr(sorted(kwargs.items())))
+        cached = self.fragments.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        output = render(**kwargs)
+        self.fragments[name] = (key, output)
+        return output
+
+    def remove(self, name):
+        if name in self.fragments:
+            del self.fragments[name]
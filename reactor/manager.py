@@ -36,7 +36,8 @@ from . objects.root import Reactor
 from . objects.endpoint import EndpointNotFound
 from . threadpool import Threadpool
 from . endpoint import Endpoint
-from . metrics.calculator import calculate_weighted_averages
+from . metrics.calculator import calculate_weighted_averages_batch
+from . metrics.sketch import split_histograms
 from . loadbalancer import connection as lb_connection
 from . cloud import connection as cloud_connection
 
@@ -122,6 +123,10 @@ class ManagerLog(EventLog):
         lambda args: "Skipped endpoint %s." % args[0])
     ENDPOINT_UPDATED = Event(
         lambda args: "Updated endpoint %s." % args[0])
+    LOADBALANCER_RELOADS = Event(
+        lambda args: "Loadbalancer %s: %d reloads, %d unchanged, %d coalesced (last reload %s)." %
+            (args[0], args[1], args[2], args[3],
+             args[4] is None and "never" or "%.3fs" % args[4]))
 
     def __init__(self, *args):
         super(ManagerLog, self).__init__(*args, size=ManagerLog.LOG_SIZE)
@@ -224,6 +229,7 @@ class ScaleManager(AtomicRunnable):
         # some information here that helps us to reduce writes.
         self._url = None
         self._sessions = {}
+        self._reload_stats = {}
 
     @Atomic.sync
     def _reconnect(self):
@@ -477,6 +483,10 @@ class ScaleManager(AtomicRunnable):
         # NOTE: Any old loadbalancer object should be cleaned
         # up automatically (i.e. the objects should implement
         # fairly sensible __del__ methods when necessary).
+        # Their metrics are stopped now, in case they are still
+        # referenced elsewhere for a while.
+        for lb in self._loadbalancers.values():
+            lb.collector.stop()
         self._loadbalancers = {}
         for name in loadbalancers:
 
@@ -768,6 +778,15 @@ class ScaleManager(AtomicRunnable):
                     results[url] += pending_count
         return results
 
+    @Atomic.sync
+    def _log_reloads(self):
+        # Log the loadbalancer reload counters (when they change).
+        for (name, lb) in self._loadbalancers.items():
+            stats = lb.reload_stats()
+            if stats != self._reload_stats.get(name):
+                self._reload_stats[name] = stats
+                self.logging.info(self.logging.LOADBALANCER_RELOADS, name, *stats)
+
     @Atomic.sync
     def update_metrics(self):
         """
@@ -780,6 +799,7 @@ class ScaleManager(AtomicRunnable):
         """
         our_metrics = self._collect_metrics()
         self.logging.info(self.logging.LOCAL_METRICS, our_metrics)
+        self._log_reloads()
 
         # Stuff all the metrics into Zookeeper.
         self._managers_zkobj.set_metrics(self._uuid, our_metrics)
@@ -1010,6 +1030,9 @@ class ScaleManager(AtomicRunnable):
         update_jobs = {}
         total_active = 0
 
+        # List of owned endpoints (and their raw metrics).
+        owned_endpoints = []
+
         # Does a health check on all the endpoints that are being managed.
         for (endpoint_uuid, endpoint) in self._endpoint_data.items():
 
@@ -1032,11 +1055,24 @@ class ScaleManager(AtomicRunnable):
                 self.logging.info(self.logging.ENDPOINT_SKIPPED, endpoint_names)
                 continue
 
-            metrics, metric_ports, active_ports = \
+            raw_metrics, metric_ports, active_ports = \
                 self._load_metrics(endpoint, all_metrics)
 
-            # Compute the globally weighted averages.
-            metrics = calculate_weighted_averages(metrics)
+            # Histograms are only used by the rules (as sketches),
+            # and are kept out of the metrics that are averaged.
+            raw_metrics, sketches = split_histograms(raw_metrics)
+            owned_endpoints.append(
+                (endpoint_uuid, endpoint, endpoint_names,
+                 raw_metrics, sketches, metric_ports, active_ports))
+
+        # Compute the globally weighted averages (for all endpoints).
+        all_averages = calculate_weighted_averages_batch(
+            [raw_metrics for (_, _, _, raw_metrics, _, _, _) in owned_endpoints])
+
+        for ((endpoint_uuid, endpoint, endpoint_names, raw_metrics, sketches,
+              metric_ports, active_ports),
+             metrics) in zip(owned_endpoints, all_averages):
+
             total_active += metrics.get("active", 0)
 
             # Add in a count of pending connections.
@@ -1055,7 +1091,13 @@ class ScaleManager(AtomicRunnable):
                 metrics=metrics,
                 metric_instances=len(metric_ports),
                 active_ports=active_ports,
-                update_interval=elapsed)
+                update_interval=elapsed,
+                sketches=sketches,
+                port_metrics=dict([
+                    (port, split_histograms(all_metrics[port])[0])
+                    for port in metric_ports
+                    if port in all_metrics
+                ]))
             update_jobs[endpoint_uuid] = (endpoint_names, job)
 
         # Wait for all updates to finish.
@@ -18,34 +18,47 @@ This module is used to calculate the ideal number of instances a endpoint
 requires given all the gather metrics and the scaling spec of the endpoint.
 """
 
+import array
 import logging
 import re
 import math
 import sys
 
+from reactor import utils
+from reactor.metrics.sketch import EWMA
+
+def _parse_metric(info):
+    """
+    Returns the (weight, value) for a single metric, or None if the
+    given metric can not be interpreted.
+    """
+    # Try to be generous with our parsing of metrics, but interpret
+    # each element as a float. If the user does not provide a weight we
+    # assign the element a weight of 1.0 as a default value.
+    try:
+        (weight, value) = info
+        return (float(weight), float(value))
+    except TypeError:
+        # info is not a tuple?
+        try:
+            return (1.0, float(info))
+        except ValueError:
+            # info is also not a number?
+            return None
+    except ValueError:
+        # weight / value are not numbers?
+        return None
+
 def calculate_weighted_averages(metrics):
     """ Calculates the weighted average for each metric. """
     totals = {}
     total_weights = {}
     for metric in metrics:
         for key, info in metric.iteritems():
-            # Try to be generous with our parsing of metrics, but interpret
-            # each element as a float. If the user does not provide a weight we
-            # assign the element a weight of 1.0 as a default value.
-            try:
-                (weight, value) = info
-                weight = float(weight)
-                value = float(value)
-            except TypeError:
-                # info is not a tuple?
-                try:
-                    (weight, value) = (1.0, float(info))
-                except ValueError:
-                    # info is also not a number?
-                    continue
-            except ValueError:
-                # weight / value are not numbers?
+            parsed = _parse_metric(info)
+            if parsed is None:
                 continue
+            (weight, value) = parsed
             totals[key] = totals.get(key, 0) + weight * value
             total_weights[key] = total_weights.get(key, 0) + weight
     for key in totals:
@@ -55,6 +68,50 @@ def calculate_weighted_averages(metrics):
             totals[key] = 0.0
     return totals
 
+def calculate_weighted_averages_batch(all_metrics):
+    """
+    Calculates the weighted averages for a collection of endpoints at once.
+
+    all_metrics:
+        A list with one entry per endpoint, each being a list of metrics
+        as accepted by calculate_weighted_averages().
+
+    Returns a list of averages (in the same order as the given metrics).
+    """
+    # This is calculate_weighted_averages() for each endpoint, with the
+    # lookups hoisted out of the loops. Metrics are almost always given
+    # as (weight, value) pairs, so those are unpacked directly and only
+    # anything else goes through _parse_metric() (which interprets them
+    # the same way).
+    results = []
+    append = results.append
+    parse = _parse_metric
+    for metrics in all_metrics:
+        totals = {}
+        total_weights = {}
+        get_total = totals.get
+        get_weight = total_weights.get
+        for metric in metrics:
+            for (key, info) in metric.iteritems():
+                try:
+                    (weight, value) = info
+                    weight = float(weight)
+                    value = float(value)
+                except (TypeError, ValueError):
+                    parsed = parse(info)
+                    if parsed is None:
+                        continue
+                    (weight, value) = parsed
+                totals[key] = get_total(key, 0.0) + weight * value
+                total_weights[key] = get_weight(key, 0.0) + weight
+        for (key, total) in totals.iteritems():
+            if total_weights[key] != 0:
+                totals[key] = total / total_weights[key]
+            else:
+                totals[key] = 0.0
+        append(totals)
+    return results
+
 def calculate_num_servers_uniform(total, bound, bump_up=False, bump_down=False):
     """
     Determines the number of servers required to spread the 'total' load uniformly
@@ -115,6 +172,63 @@ def calculate_server_range(total, lower, upper, lower_exact=True, upper_exact=Tr
 
     return r
 
+def calculate_percentile_range(value, lower, upper, num_instances,
+                               lower_exact=True, upper_exact=True):
+    """
+    Returns the ideal range for a percentile (e.g. p95(response)).
+
+    Unlike the averages, a percentile is not a load that is spread across
+    the instances, so it isn't multiplied by the number of instances. It
+    only says whether there should be more (or fewer) instances than the
+    current num_instances.
+    """
+    if value is None:
+        # No data (e.g. no requests), so no opinion.
+        return (0, sys.maxint)
+    if upper is not None and \
+       (value > upper or (value == upper and not upper_exact)):
+        return (num_instances + 1, sys.maxint)
+    if lower is not None and \
+       (value < lower or (value == lower and not lower_exact)):
+        return (0, max(num_instances - 1, 0))
+    return (0, sys.maxint)
+
+def _is_percentile(c):
+    return c.function is not None and \
+        EndpointCriteria.PERCENTILE_REGEX.match(c.function) is not None
+
+def _instance_range(c):
+    """ Returns the explicit range given by an 'instances' criteria. """
+    if c.lower_exact or c.lower_bound is None:
+        metric_min = c.lower_bound
+    else:
+        metric_min = c.lower_bound + 1
+    if c.upper_exact or c.upper_bound is None:
+        metric_max = c.upper_bound
+    else:
+        metric_max = c.upper_bound - 1
+    return (metric_min, metric_max)
+
+def _intersect_ideal(ideal_instances, metric_min, metric_max):
+    """ Combines the ideal range so far with the range for one metric. """
+    if ideal_instances == (-1, -1):
+        # First time through the loop so we just set it to the first ideal values.
+        return (metric_min, metric_max)
+
+    # We find the intersection of ideal servers between the
+    # existing metrics and this one. If the intersections are
+    # completely disjoint, we disregard the later section.
+    new_min = max(ideal_instances[0], metric_min)
+    new_max = min(ideal_instances[1], metric_max)
+
+    if new_min <= new_max:
+        return (new_min, new_max)
+    elif metric_max < ideal_instances[0]:
+        return (ideal_instances[0], ideal_instances[0])
+    elif metric_min > ideal_instances[1]:
+        return (ideal_instances[1], ideal_instances[1])
+    return ideal_instances
+
 def calculate_ideal_uniform(endpoint_spec, metric_averages, num_instances):
     """
     Returns the ideal number of instances these endpoint spec should have as a
@@ -137,19 +251,20 @@ def calculate_ideal_uniform(endpoint_spec, metric_averages, num_instances):
     ideal_instances = (-1, -1)
     for criteria in endpoint_spec:
         if criteria != '':
-            c = EndpointCriteria(criteria)
+            c = parse_criteria(criteria)
             logging.debug("Endpoint criteria found: (%s, %s, %s)",
                           c.metric_key, c.lower_bound, c.upper_bound)
 
             if c.metric_key == 'instances':
-                if c.lower_exact or c.lower_bound is None:
-                    metric_min = c.lower_bound
-                else:
-                    metric_min = c.lower_bound + 1
-                if c.upper_exact or c.upper_bound is None:
-                    metric_max = c.upper_bound
-                else:
-                    metric_max = c.upper_bound - 1
+                (metric_min, metric_max) = _instance_range(c)
+            elif _is_percentile(c):
+                (metric_min, metric_max) = \
+                    calculate_percentile_range(metric_averages.get(c.metric_key),
+                                               c.lower_bound,
+                                               c.upper_bound,
+                                               num_instances,
+                                               lower_exact=c.lower_exact,
+                                               upper_exact=c.upper_exact)
             else:
                 avg = metric_averages.get(c.metric_key, 0)
                 (metric_min, metric_max) = \
@@ -162,23 +277,8 @@ def calculate_ideal_uniform(endpoint_spec, metric_averages, num_instances):
             logging.debug("Ideal instances for metric %s: [%s,%s]",
                           c.metric_key, metric_min, metric_max)
 
-            if ideal_instances == (-1, -1):
-                # First time through the loop so we just set it to the first ideal values.
-                ideal_instances = (metric_min, metric_max)
-
-            else:
-                # We find the intersection of ideal servers between the
-                # existing metrics and this one. If the intersections are
-                # completely disjoint, we disregard the later section.
-                new_min = max(ideal_instances[0], metric_min)
-                new_max = min(ideal_instances[1], metric_max)
-
-                if new_min <= new_max:
-                    ideal_instances = (new_min, new_max)
-                elif metric_max < ideal_instances[0]:
-                    ideal_instances = (ideal_instances[0], ideal_instances[0])
-                elif metric_min > ideal_instances[1]:
-                    ideal_instances = (ideal_instances[1], ideal_instances[1])
+            ideal_instances = _intersect_ideal(
+                ideal_instances, metric_min, metric_max)
 
             logging.debug("Returning ideal instances: %s", ideal_instances)
 
@@ -188,12 +288,18 @@ class EndpointCriteria(object):
 
     NUMBER_PATTERN = "\s*([0-9]+([.][0-9]+)?)\s*"
     OP_PATTERN = "\s*(<=?)\s*"
-    METRIC_NAME_PATTERN = "\s*(\w+)\s*"
+    METRIC_NAME_PATTERN = "\s*(\w+(?:\(\s*\w+\s*(?:,\s*[0-9]+(?:[.][0-9]+)?\s*)?\))?)\s*"
 
     PATTERN = "^(" + NUMBER_PATTERN + OP_PATTERN + ")?" + \
               METRIC_NAME_PATTERN + \
               "(" + OP_PATTERN + NUMBER_PATTERN + ")?$"
 
+    REGEX = re.compile(PATTERN)
+
+    # Aggregate functions (e.g. p95(response) or ewma(rate,60)).
+    FUNCTION_REGEX = re.compile("^(\w+)\((\w+)(?:,([0-9.]+))?\)$")
+    PERCENTILE_REGEX = re.compile("^p([0-9]+)$")
+
     def __init__(self, criteria_str):
         super(EndpointCriteria, self).__init__()
         self.lower_bound = None
@@ -201,27 +307,50 @@ class EndpointCriteria(object):
         self.metric_key = None
         self.upper_bound = None
         self.upper_exact = None
+        self.function = None
+        self.source = None
+        self.argument = None
         self._parse(criteria_str)
 
     @staticmethod
     def validate(criteria_str):
-        m = re.match(EndpointCriteria.PATTERN, criteria_str)
+        m = EndpointCriteria.REGEX.match(criteria_str)
         if not m:
             raise Exception("Rules must match: %s" % EndpointCriteria.PATTERN)
+        c = parse_criteria(criteria_str)
+        if c.function is None:
+            return
+        m = EndpointCriteria.PERCENTILE_REGEX.match(c.function)
+        if m:
+            if c.argument is not None or not 0 < int(m.group(1)) <= 100:
+                raise Exception("Percentiles must be of the form pNN(metric).")
+        elif c.function == "ewma":
+            if not c.argument:
+                raise Exception("Moving averages must be of the form ewma(metric,seconds).")
+        else:
+            raise Exception("Unknown function: %s" % c.function)
 
     def _parse(self, criteria_str):
         """
         The criteria string is of the form:
         x [<=?] metric_key [<=?] y
         """
-        m = re.match(EndpointCriteria.PATTERN, criteria_str)
+        m = EndpointCriteria.REGEX.match(criteria_str)
         if m != None:
             try:
                 self.lower_bound = float(m.group(2))
             except (TypeError, ValueError):
                 self.lower_bound = None
             self.lower_exact = m.group(4) == "<="
-            self.metric_key = m.group(5)
+            self.metric_key = re.sub("\s", "", m.group(5))
+            f = EndpointCriteria.FUNCTION_REGEX.match(self.metric_key)
+            if f != None:
+                self.function = f.group(1)
+                self.source = f.group(2)
+                try:
+                    self.argument = float(f.group(3))
+                except (TypeError, ValueError):
+                    self.argument = None
             self.upper_exact = m.group(7) == "<="
             try:
                 self.upper_bound = float(m.group(8))
@@ -235,3 +364,128 @@ class EndpointCriteria(object):
             self.lower_bound,
             self.upper_bound,
             self.upper_exact and "]" or ")")
+
+@utils.memoize(size=4096)
+def parse_criteria(criteria_str):
+    """
+    Returns the parsed EndpointCriteria for the given rule string.
+
+    Criteria are cached by rule string, so the returned object is shared
+    and must not be modified by the caller.
+    """
+    return EndpointCriteria(criteria_str)
+
+class RuleSet(object):
+
+    """
+    A compact representation of a list of scaling rules.
+
+    The rules are parsed once (i.e. when the endpoint configuration changes)
+    and kept in flat arrays, so evaluating them on every interval does not
+    require any string parsing.
+    """
+
+    HAS_LOWER = 0x1
+    HAS_UPPER = 0x2
+    LOWER_EXACT = 0x4
+    UPPER_EXACT = 0x8
+    INSTANCES = 0x10
+    PERCENTILE = 0x20
+
+    def __init__(self, rules):
+        super(RuleSet, self).__init__()
+        self.rules = list(rules)
+        self.keys = []
+        self.lower = array.array('d')
+        self.upper = array.array('d')
+        self.flags = array.array('B')
+        self.functions = {}
+        self._ewma = {}
+        for criteria in self.rules:
+            if criteria != '':
+                self._add(parse_criteria(criteria))
+
+    def _add(self, c):
+        flags = 0
+        if c.lower_bound is not None:
+            flags |= self.HAS_LOWER
+        if c.upper_bound is not None:
+            flags |= self.HAS_UPPER
+        if c.lower_exact:
+            flags |= self.LOWER_EXACT
+        if c.upper_exact:
+            flags |= self.UPPER_EXACT
+        if c.metric_key == 'instances':
+            # The explicit bounds are computed upfront.
+            flags |= self.INSTANCES
+            (lower, upper) = _instance_range(c)
+        else:
+            (lower, upper) = (c.lower_bound, c.upper_bound)
+        if c.function is not None:
+            self.functions[c.metric_key] = (c.function, c.source, c.argument)
+        if _is_percentile(c):
+            flags |= self.PERCENTILE
+        self.keys.append(c.metric_key)
+        self.lower.append(lower if lower is not None else 0.0)
+        self.upper.append(upper if upper is not None else 0.0)
+        self.flags.append(flags)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def derive(self, metric_averages, sketches=None, elapsed=None):
+        """
+        Returns a copy of the given averages, with the values for all
+        aggregate functions used by these rules filled in.
+
+        sketches:
+            A dictionary of merged Histograms (see sketch.merge_histograms).
+
+        elapsed:
+            The time since the last call, used for moving averages.
+        """
+        if not self.functions:
+            return metric_averages
+        if sketches is None:
+            sketches = {}
+        result = dict(metric_averages)
+        for (key, (function, source, argument)) in self.functions.items():
+            if function == "ewma":
+                if not key in self._ewma:
+                    self._ewma[key] = EWMA(argument)
+                result[key] = self._ewma[key].update(
+                    metric_averages.get(source, 0.0), elapsed=elapsed)
+            elif source in sketches:
+                value = sketches[source].percentile(float(function[1:]))
+                if value is not None:
+                    result[key] = value
+        return result
+
+    def ideal(self, metric_averages, num_instances):
+        """ See calculate_ideal_uniform(). """
+        ideal_instances = (-1, -1)
+        for i in xrange(len(self.keys)):
+            flags = self.flags[i]
+            lower = self.lower[i] if flags & self.HAS_LOWER else None
+            upper = self.upper[i] if flags & self.HAS_UPPER else None
+            if flags & self.INSTANCES:
+                (metric_min, metric_max) = (lower, upper)
+            elif flags & self.PERCENTILE:
+                (metric_min, metric_max) = \
+                    calculate_percentile_range(metric_averages.get(self.keys[i]),
+                                               lower,
+                                               upper,
+                                               num_instances,
+                                               lower_exact=bool(flags & self.LOWER_EXACT),
+                                               upper_exact=bool(flags & self.UPPER_EXACT))
+            else:
+                avg = metric_averages.get(self.keys[i], 0)
+                (metric_min, metric_max) = \
+                    calculate_server_range(avg * num_instances,
+                                           lower,
+                                           upper,
+                                           lower_exact=bool(flags & self.LOWER_EXACT),
+                                           upper_exact=bool(flags & self.UPPER_EXACT))
+            ideal_instances = _intersect_ideal(
+                ideal_instances, metric_min, metric_max)
+        return ideal_instances
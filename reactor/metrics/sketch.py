@@ -0,0 +1,163 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import math
+
+class Histogram(object):
+
+    """
+    A mergeable log-bucketed histogram (in the spirit of HDR histograms).
+
+    Values are placed in buckets whose width grows geometrically, so any
+    percentile is reported within PRECISION relative error while the
+    sketch stays small regardless of the number of samples. Two histograms
+    are merged by adding their bucket counts, which lets every manager's
+    loadbalancers contribute to a single endpoint-wide distribution.
+
+    Histograms are shipped alongside regular metrics in the form:
+        { "response" : { "hist" : { "<bucket>" : count, ... } } }
+    """
+
+    # Relative error for reported values.
+    PRECISION = 0.01
+
+    # The bucket used for values <= 0.
+    ZERO = "z"
+
+    _BASE = math.log(1.0 + 2 * PRECISION)
+
+    def __init__(self, buckets=None):
+        super(Histogram, self).__init__()
+        self.buckets = {}
+        self.count = 0
+        if buckets:
+            for (bucket, count) in buckets.items():
+                self._add_bucket(str(bucket), int(count))
+
+    def _add_bucket(self, bucket, count):
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += count
+
+    def add(self, value, count=1):
+        """ Record a value (count times). """
+        if value <= 0:
+            self._add_bucket(self.ZERO, count)
+        else:
+            self._add_bucket(
+                str(int(math.floor(math.log(value) / self._BASE))), count)
+
+    def merge(self, other):
+        """ Add all the samples from another histogram. """
+        for (bucket, count) in other.buckets.items():
+            self._add_bucket(bucket, count)
+        return self
+
+    @staticmethod
+    def _value(bucket):
+        if bucket == Histogram.ZERO:
+            return 0.0
+        # Report the midpoint of the bucket.
+        index = int(bucket)
+        return (math.exp(index * Histogram._BASE) + \
+                math.exp((index + 1) * Histogram._BASE)) / 2
+
+    def percentile(self, p):
+        """ The value at the given percentile (0-100), or None if empty. """
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for (value, count) in sorted(
+                [(self._value(bucket), count)
+                 for (bucket, count) in self.buckets.items()]):
+            seen += count
+            if seen >= rank:
+                return value
+        return value
+
+    def dump(self):
+        """ The serialized (JSON-safe) form of the histogram. """
+        return { "hist" : dict(self.buckets) }
+
+    @staticmethod
+    def load(info):
+        """ Returns the histogram for a serialized form, or None. """
+        try:
+            return Histogram(buckets=info["hist"])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return None
+
+class EWMA(object):
+
+    """
+    An exponentially weighted moving average over a time window.
+
+    The average is linear in its inputs, so smoothing the (already merged)
+    endpoint-wide metric is equivalent to merging per-loadbalancer averages.
+    """
+
+    def __init__(self, window):
+        super(EWMA, self).__init__()
+        self.window = float(window)
+        self.value = None
+
+    def update(self, value, elapsed=None):
+        """ Fold in a new sample taken elapsed seconds after the last. """
+        if self.value is None:
+            self.value = float(value)
+        elif elapsed:
+            alpha = 1.0 - math.exp(-float(elapsed) / self.window)
+            self.value += alpha * (float(value) - self.value)
+        return self.value
+
+def merge_histograms(metrics):
+    """
+    Merges all histograms found in a list of metrics (as produced by the
+    loadbalancers), returning a dictionary of metric name to Histogram.
+    """
+    sketches = {}
+    for metric in metrics:
+        for (key, info) in metric.iteritems():
+            if not isinstance(info, dict):
+                continue
+            hist = Histogram.load(info)
+            if hist is None:
+                continue
+            if key in sketches:
+                sketches[key].merge(hist)
+            else:
+                sketches[key] = hist
+    return sketches
+
+def split_histograms(metrics):
+    """
+    Separates the histograms from a list of metrics, returning a tuple
+    (metrics, sketches) where metrics has no histograms left in it, and
+    sketches are merged as by merge_histograms().
+    """
+    plain = []
+    histograms = []
+    for metric in metrics:
+        if any(isinstance(info, dict) for info in metric.itervalues()):
+            histograms.append(metric)
+            metric = dict([
+                (key, info)
+                for (key, info) in metric.iteritems()
+                if not isinstance(info, dict)
+            ])
+            if not metric:
+                continue
+        plain.append(metric)
+    return (plain, merge_histograms(histograms))
@@ -0,0 +1,106 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import mock
+
+from reactor.loadbalancer.backend import Backend
+from reactor.loadbalancer.dnsmasq import connection
+
+FAKE_BACKENDS = [Backend("10.0.0.1", 80), Backend("10.0.0.2", 80)]
+
+class DnsmasqConnectionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.conn = connection.Connection(name="dnsmasq")
+        self.conn._RELOAD_INTERVAL = 0.2
+        config = self.conn._manager_config()
+        config.config_path = self.path
+        config.hosts_path = os.path.join(self.path, "hosts.reactor")
+        self.hosts_dir = os.path.join(self.path, "hosts.d")
+        os.mkdir(self.hosts_dir)
+        self.reloads = []
+        self.read_pid = mock.patch.object(connection, "read_pid", return_value=1)
+        self.kill = mock.patch("os.kill",
+            side_effect=lambda pid, sig: self.reloads.append(time.time()))
+        self.read_pid.start()
+        self.kill.start()
+
+    def tearDown(self):
+        if self.conn.reload_timer is not None:
+            self.conn.reload_timer.cancel()
+        self.kill.stop()
+        self.read_pid.stop()
+        shutil.rmtree(self.path)
+
+    def _save(self, name, backends):
+        self.conn.change("dns://%s" % name, backends)
+        self.conn._flush()
+
+    def _read(self, *parts):
+        return open(os.path.join(self.path, *parts)).read()
+
+    def test_hosts_file(self):
+        self._save("a.example.com", FAKE_BACKENDS)
+        self.assertEquals(self._read("hosts.reactor"),
+            "10.0.0.1 a.example.com\n10.0.0.2 a.example.com\n")
+        self.assertTrue("addn-hosts=%s" % os.path.join(self.path, "hosts.reactor") \
+            in self._read("reactor.conf"))
+        self.assertEquals(sorted(os.listdir(self.path)),
+            ["hosts.d", "hosts.reactor", "reactor.conf"])
+        self.assertEquals(len(self.reloads), 1)
+
+        # The config file is only written when it changes.
+        with mock.patch.object(connection, "write_atomic") as write:
+            self._save("a.example.com", FAKE_BACKENDS[:1])
+        self.assertEquals(write.call_args_list,
+            [mock.call(os.path.join(self.path, "hosts.reactor"),
+                       "10.0.0.1 a.example.com\n")])
+
+    def test_hosts_dir(self):
+        self.conn._manager_config().hosts_dir = self.hosts_dir
+        self._save("a.example.com", FAKE_BACKENDS)
+        self._save("b.example.com", FAKE_BACKENDS[1:])
+        self.assertEquals(self._read("hosts.d", "reactor.b.example.com"),
+            "10.0.0.2 b.example.com\n")
+        self.assertTrue("addn-hosts=%s" % self.hosts_dir in self._read("reactor.conf"))
+
+        # Only the names that change are written.
+        with mock.patch.object(connection, "write_atomic") as write:
+            self._save("a.example.com", FAKE_BACKENDS[:1])
+        self.assertEquals(write.call_args_list,
+            [mock.call(os.path.join(self.hosts_dir, "reactor.a.example.com"),
+                       "10.0.0.1 a.example.com\n")])
+
+        self._save("b.example.com", [])
+        self.assertEquals(os.listdir(self.hosts_dir), ["reactor.a.example.com"])
+
+    def test_reload_interval(self):
+        self._save("a.example.com", FAKE_BACKENDS)
+        self._save("a.example.com", FAKE_BACKENDS[:1])
+        self._save("a.example.com", FAKE_BACKENDS[1:])
+
+        # The reloads after the first are held back (and combined).
+        self.assertEquals(len(self.reloads), 1)
+        self.assertTrue(self.conn.reload_timer is not None)
+        self.conn.reload_timer.join(5.0)
+        self.assertEquals(len(self.reloads), 2)
+        self.assertTrue(self.reloads[1] - self.reloads[0] >= 0.15)
+        self.assertTrue(self.conn.reload_timer is None)
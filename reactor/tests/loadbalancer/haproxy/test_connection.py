@@ -0,0 +1,168 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+from reactor.loadbalancer.backend import Backend
+from reactor.loadbalancer.haproxy import connection
+from reactor.loadbalancer.haproxy.stats import StatsSocket
+
+FAKE_URL = "http://example.com"
+FAKE_URL_2 = "http://"
+FAKE_BACKENDS = [Backend("10.0.0.1", 80), Backend("10.0.0.2", 80, weight=2)]
+FAKE_BACKEND_3 = Backend("10.0.0.3", 8080)
+
+class HaproxyConnectionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = connection.Connection(name="haproxy")
+
+    def test_render(self):
+        self.conn.change(FAKE_URL, FAKE_BACKENDS)
+        self.conn.change(FAKE_URL_2, FAKE_BACKENDS[:1])
+        output = self.conn._render()
+        self.assertEquals(output.count("\nbackend "), 2)
+        self.assertTrue("hdr_dom(host) -i example.com" in output)
+        self.assertTrue("10.0.0.2:80 weight 2 cookie %s" % \
+            connection._cookie("10.0.0.2", 80) in output)
+
+        # The order of changes doesn't matter.
+        other = connection.Connection(name="haproxy")
+        other.change(FAKE_URL_2, FAKE_BACKENDS[:1])
+        other.change(FAKE_URL, FAKE_BACKENDS)
+        self.assertEquals(other._render(), output)
+
+    def test_fragments(self):
+        self.conn.change(FAKE_URL, FAKE_BACKENDS)
+        (uniq_id, fragment) = self.conn.http_backends.items()[0]
+
+        # An unchanged endpoint isn't rendered again.
+        self.conn.change(FAKE_URL, FAKE_BACKENDS)
+        self.assertTrue(self.conn.http_backends[uniq_id] is fragment)
+
+        self.conn.change(FAKE_URL, FAKE_BACKENDS[:1])
+        self.assertFalse("10.0.0.2" in self.conn.http_backends[uniq_id])
+
+        self.conn.change(FAKE_URL, [])
+        self.assertEquals(self.conn.http_backends, {})
+        self.assertEquals(self.conn.fragments.fragments, {})
+        self.assertEquals(self.conn.frontends, {})
+
+class HaproxySlotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.conn = connection.Connection(name="haproxy")
+        config = self.conn._manager_config()
+        config.server_slots = 4
+        config.config_file = os.path.join(self.path, "haproxy.cfg")
+
+        # Don't let metrics (sampled in the background) use the socket.
+        self.conn.collector.stop()
+        for source in self.conn.collector.sources:
+            source.thread.join()
+        self.stats = mock.Mock(spec=StatsSocket)
+        self.stats.command.side_effect = lambda *commands: [""] * len(commands)
+        self.conn._stats_socket = lambda: self.stats
+        self.uniq_id = connection.hashlib.md5(FAKE_URL).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _commit(self):
+        # Returns True if HAProxy was restarted.
+        self.stats.command.reset_mock()
+        with mock.patch.object(connection, "read_pid", return_value=1):
+            with mock.patch("subprocess.call") as call:
+                self.conn._commit(self.conn._render())
+        return call.called
+
+    def _commands(self):
+        if not self.stats.command.called:
+            return []
+        return list(self.stats.command.call_args[0])
+
+    def test_slots(self):
+        self.conn.change(FAKE_URL, FAKE_BACKENDS)
+        output = self.conn._render()
+        self.assertTrue("server s0 10.0.0.1:80 weight 1 cookie %s check\n" % \
+            connection._cookie(self.uniq_id, 0) in output)
+        self.assertTrue("server s1 10.0.0.2:80 weight 2" in output)
+        self.assertTrue("server s3 %s weight 0" % connection.EMPTY_SLOT in output)
+        self.assertTrue("level admin" in output)
+
+        # Servers stay in their slots.
+        self.conn.change(FAKE_URL, FAKE_BACKENDS[1:] + [FAKE_BACKEND_3])
+        self.assertEquals(self.conn.slots[self.uniq_id], [
+            ("10.0.0.3:8080", 1), ("10.0.0.2:80", 2), None, None])
+
+        # Slots are added in blocks.
+        self.conn.change(FAKE_URL, [Backend("10.0.1.%d" % i, 80) for i in range(5)])
+        self.assertEquals(len(self.conn.slots[self.uniq_id]), 8)
+
+    def test_commit(self):
+        self.conn.change(FAKE_URL, FAKE_BACKENDS)
+        self.assertTrue(self._commit())
+        self.assertEquals(self._commands(), [])
+
+        # Membership changes go through the stats socket.
+        self.conn.change(FAKE_URL, FAKE_BACKENDS[:1])
+        self.assertFalse(self._commit())
+        self.assertEquals(self._commands(), ["disable server %s/s1" % self.uniq_id])
+
+        self.conn.change(FAKE_URL, [Backend("10.0.0.1", 80, weight=3), FAKE_BACKEND_3])
+        self.assertFalse(self._commit())
+        self.assertEquals(self._commands(), [
+            "set weight %s/s0 3" % self.uniq_id,
+            "set server %s/s1 addr 10.0.0.3 port 8080" % self.uniq_id,
+            "set weight %s/s1 1" % self.uniq_id,
+            "enable server %s/s1" % self.uniq_id])
+
+        # But new frontends still need a restart.
+        self.conn.change(FAKE_URL_2, FAKE_BACKENDS)
+        self.assertTrue(self._commit())
+        self.assertEquals(self._commands(), [])
+
+    def test_commit_rejected(self):
+        self.conn.change(FAKE_URL, FAKE_BACKENDS)
+        self._commit()
+        self.conn.change(FAKE_URL, FAKE_BACKENDS[:1])
+        self.stats.command.side_effect = lambda *commands: ["No such server.\n"]
+        self.assertTrue(self._commit())
+
+        # The restart brought everything in line.
+        self.stats.command.side_effect = lambda *commands: [""] * len(commands)
+        self.assertFalse(self._commit())
+        self.assertEquals(self._commands(), [])
+
+    def test_slot_names(self):
+        self.conn.change(FAKE_URL, FAKE_BACKENDS[:1])
+        self.assertEquals(self.conn._slot_names(), None)
+        self._commit()
+        names = self.conn._slot_names()
+        self.assertEquals(names[(self.uniq_id, "s0")], "10.0.0.1:80")
+        self.assertEquals(names[(self.uniq_id, "s1")], None)
+
+        # Names are for what HAProxy is running, until a change is applied.
+        self.conn.change(FAKE_URL, [FAKE_BACKEND_3])
+        names = self.conn._slot_names()
+        self.assertEquals(names[(self.uniq_id, "s0")], "10.0.0.1:80")
+        self._commit()
+        names = self.conn._slot_names()
+        self.assertEquals(names[(self.uniq_id, "s0")], "10.0.0.3:8080")
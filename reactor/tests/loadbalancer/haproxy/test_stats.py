@@ -0,0 +1,131 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from reactor.loadbalancer.haproxy import stats
+
+FAKE_STATS = "\n".join([
+    "# pxname,svname,qcur,scur,status,weight,check_duration,",
+    "backend1,10.0.0.1:80,0,3,UP,1,-1,",
+    "backend1,10.0.0.2:80,,0,DOWN,2,,",
+    "",
+    ""])
+
+class FakeStatsServer(object):
+
+    """ Answers commands in interactive mode, like HAProxy. """
+
+    def __init__(self, path, responses):
+        self.path = path
+        self.responses = responses
+        self.commands = []
+        self.connections = 0
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                (conn, _) = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            data = ""
+            prompt = False
+            while True:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+                while "\n" in data:
+                    (command, data) = data.split("\n", 1)
+                    self.commands.append(command)
+                    if command == "prompt":
+                        prompt = True
+                    else:
+                        conn.sendall(self.responses.get(command, "Unknown command.\n\n"))
+                    if prompt:
+                        conn.sendall("> ")
+            conn.close()
+
+    def stop(self):
+        self.sock.close()
+
+class StatsSocketTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = FakeStatsServer(os.path.join(self.path, "haproxy.sock"),
+            { "show stat -1 4 -1" : FAKE_STATS, "clear counters all" : "" })
+        self.client = stats.StatsSocket(self.server.path)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.path)
+
+    def test_command(self):
+        for _ in range(2):
+            output = self.client.command("show stat -1 4 -1", "clear counters all")
+            self.assertEquals(output, [FAKE_STATS, ""])
+        self.assertEquals(self.server.connections, 1)
+        self.assertEquals(self.server.commands, ["prompt"] + \
+            ["show stat -1 4 -1", "clear counters all"] * 2)
+
+    def test_reconnect(self):
+        self.client.command("clear counters all")
+        self.client.sock.close()
+        self.assertEquals(self.client.command("clear counters all"), [""])
+
+    def test_unavailable(self):
+        client = stats.StatsSocket(os.path.join(self.path, "missing.sock"))
+        self.assertIsNone(client.command("show stat -1 4 -1"))
+
+    def test_split(self):
+        self.assertEquals(stats.StatsSocket._split("> a\n\n> b"), (["", "a\n\n"], "b"))
+        self.assertEquals(stats.StatsSocket._split("a\n> \n> "), (["a\n", "\n"], ""))
+
+class StatsParserTests(unittest.TestCase):
+
+    def test_parse(self):
+        parser = stats.StatsParser()
+        (results, down) = parser.parse(FAKE_STATS)
+        self.assertEquals(results, {
+            "10.0.0.1:80" : [{ "qcur" : 0, "scur" : 3, "weight" : 1, "check_duration" : -1 }],
+            "10.0.0.2:80" : [{ "scur" : 0, "weight" : 2 }],
+        })
+        self.assertEquals(down, ["10.0.0.2:80"])
+
+    def test_parse_names(self):
+        (results, down) = stats.StatsParser().parse(FAKE_STATS.replace("10.0.0.", "s"), {
+            ("backend1", "s1:80") : "10.0.0.1:80",
+            ("backend1", "s2:80") : None,
+        })
+        self.assertEquals(results.keys(), ["10.0.0.1:80"])
+        self.assertEquals(down, [])
+
+    def test_parse_empty(self):
+        self.assertEquals(stats.StatsParser().parse(""), ({}, []))
+        self.assertEquals(stats.StatsParser().parse("Unknown command.\n"), ({}, []))
@@ -0,0 +1,227 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import time
+import socket
+import shutil
+import logging
+import tempfile
+import unittest
+
+from reactor.loadbalancer.nginx import accesslog
+
+FAKE_HOSTS = ["10.0.0.%d:8080" % i for i in range(1, 9)]
+
+def _delimited(host, body, response):
+    return "reactor|%s|%d|%.3f" % (host, body, response)
+
+def _json(host, body, response):
+    return '{"upstream":"%s","bytes":"%d","response":"%.3f"}' % (host, body, response)
+
+def _legacy(host, body, response):
+    return "reactor> [19/Oct/2013:10:00:00 +0000] 1.2.3.4 <%s> <%d> <%.3f>" % \
+        (host, body, response)
+
+def _lines(fn, n):
+    return [fn(FAKE_HOSTS[i % len(FAKE_HOSTS)], 100 + i % 7, 0.001 * (i % 50 + 1))
+            for i in range(n)]
+
+def _summary(record):
+    return dict([(host, (r.hits, r.bytes, round(r.response, 6), r.histogram().buckets))
+                 for (host, r) in record.items()])
+
+def _legacy_accumulate(lines):
+    # The reference (per-line regex) implementation.
+    record = {}
+    for line in lines:
+        m = accesslog.LEGACY_FILTER.match(line)
+        if m is None:
+            continue
+        (_, host, body, response) = m.groups()
+        try:
+            body = int(body)
+            response = float(response)
+        except ValueError:
+            continue
+        if not host in record:
+            record[host] = accesslog.HostRecord()
+        record[host].add(body, response)
+    return record
+
+class AccumulateTests(unittest.TestCase):
+
+    def test_formats(self):
+        for fn in (_delimited, _json, _legacy):
+            record = accesslog.accumulate([fn("10.0.0.1:80", 100, 0.5),
+                                           fn("10.0.0.1:80", 50, 1.5)])
+            self.assertEquals(record.keys(), ["10.0.0.1:80"])
+            self.assertEquals(record["10.0.0.1:80"].hits, 2)
+            self.assertEquals(record["10.0.0.1:80"].bytes, 150)
+            self.assertEquals(record["10.0.0.1:80"].response, 2.0)
+
+    def test_skipped(self):
+        record = accesslog.accumulate([
+            "",
+            "GET / HTTP/1.1",
+            "reactor|-|0|-",
+            "reactor|10.0.0.1:80, 10.0.0.2:80|10|0.1, 0.2",
+            "reactor|10.0.0.1:80",
+            '{"upstream":"-","bytes":"0","response":"-"}',
+            '{"upstream":',
+        ])
+        self.assertEquals(record, {})
+
+    def test_pull(self):
+        watcher = accesslog.NginxLogWatcher("/nonexistent")
+        watcher.merge(accesslog.accumulate(_lines(_delimited, 4)[:1]))
+        watcher.merge(accesslog.accumulate(_lines(_delimited, 1)))
+        records = watcher.pull()
+        self.assertEquals(records.keys(), [FAKE_HOSTS[0]])
+        (metrics, extra) = records[FAKE_HOSTS[0]]
+        self.assertEquals(metrics["rate"][0], 2)
+        self.assertEquals(metrics["response"], (2, 0.001))
+        self.assertEquals(extra["response"]["hist"].values(), [2])
+        self.assertEquals(watcher.pull(), {})
+
+    def test_accumulate_benchmark(self):
+        # Compare against the per-line regex at 100k lines.
+        legacy = _lines(_legacy, 100000)
+        lines = _lines(_delimited, 100000)
+
+        start = time.time()
+        expected = _legacy_accumulate(legacy)
+        legacy_time = time.time() - start
+
+        start = time.time()
+        record = accesslog.accumulate(lines)
+        split_time = time.time() - start
+
+        start = time.time()
+        json_record = accesslog.accumulate(_lines(_json, 100000))
+        json_time = time.time() - start
+
+        logging.info("Access log parsing (%d lines): regex %d lines/s, "
+                     "delimited %d lines/s, json %d lines/s",
+                     len(lines), len(lines) / legacy_time,
+                     len(lines) / split_time, len(lines) / json_time)
+        self.assertEquals(_summary(record), _summary(expected))
+        self.assertEquals(_summary(json_record), _summary(expected))
+
+class NginxLogReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, "access.log")
+        open(self.filename, "w").close()
+        self.reader = accesslog.NginxLogReader(self.filename)
+
+    def tearDown(self):
+        self.reader.close()
+        shutil.rmtree(self.path)
+
+    def _write(self, data):
+        logfile = open(self.filename, "a")
+        logfile.write(data)
+        logfile.close()
+
+    def _write_rotated(self, data):
+        logfile = open(self.filename + ".1", "a")
+        logfile.write(data)
+        logfile.close()
+
+    def test_read(self):
+        self._write("before\n")
+        self.assertEquals(self.reader.read(), [])
+        self._write("one\ntwo\nthr")
+        self.assertEquals(self.reader.read(), ["one", "two"])
+        self._write("ee\n")
+        self.assertEquals(self.reader.read(), ["three"])
+        self.assertEquals(self.reader.read(), [])
+
+    def test_rotate(self):
+        self.assertEquals(self.reader.read(), [])
+        self._write("one\n")
+        os.rename(self.filename, self.filename + ".1")
+        self.assertEquals(self.reader.read(), ["one"])
+
+        # Not recreated yet.
+        self.assertEquals(self.reader.read(), [])
+
+        # The new file is noticed once the old one is drained.
+        self._write("two\n")
+        self._write_rotated("three\n")
+        self.assertEquals(self.reader.read(), ["three"])
+        self.assertEquals(self.reader.read(), [])
+        self.assertEquals(self.reader.read(), ["two"])
+
+        # Still written to the old file, until nginx reopens it.
+        self._write_rotated("four\n")
+        self.assertEquals(self.reader.read(), ["four"])
+        self.assertEquals(self.reader.rotated.ident[1],
+                          os.stat(self.filename + ".1").st_ino)
+
+        # The old file is closed once it has been quiet for long enough.
+        self.reader.rotated_at -= self.reader.ROTATE_GRACE + 1
+        self.assertEquals(self.reader.read(), [])
+        self.assertIsNone(self.reader.rotated)
+
+    def test_truncate(self):
+        self._write("one\n")
+        self.assertEquals(self.reader.read(), [])
+        self._write("two\n")
+        self.assertEquals(self.reader.read(), ["two"])
+        open(self.filename, "w").close()
+        self._write("x\n")
+        self.assertEquals(self.reader.read(), ["x"])
+
+    def test_missing(self):
+        reader = accesslog.NginxLogReader(os.path.join(self.path, "other.log"))
+        try:
+            self.assertEquals(reader.read(), [])
+            logfile = open(os.path.join(self.path, "other.log"), "w")
+            logfile.write("one\n")
+            logfile.close()
+            self.assertEquals(reader.read(), ["one"])
+        finally:
+            reader.close()
+
+    def test_wait(self):
+        if self.reader.inotify is None:
+            return
+        start = time.time()
+        self.assertTrue(self.reader.wait(0.1))
+        self.assertTrue(time.time() - start >= 0.1)
+        self._write("one\n")
+        start = time.time()
+        self.reader.wait(5.0)
+        self.assertTrue(time.time() - start < 1.0)
+
+class NginxSyslogReaderTests(unittest.TestCase):
+
+    def test_read(self):
+        reader = accesslog.NginxSyslogReader("127.0.0.1:0")
+        try:
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for line in _lines(_delimited, 2):
+                sender.sendto("<190>Oct 19 10:00:00 host reactor: %s" % line,
+                              reader.sock.getsockname())
+            sender.close()
+            lines = []
+            while len(lines) < 2:
+                lines.extend(reader.read())
+            self.assertEquals(lines, _lines(_delimited, 2))
+        finally:
+            reader.close()
@@ -0,0 +1,146 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import socket
+import httplib
+import tempfile
+import unittest
+import mock
+
+from mako.template import Template
+
+from reactor.loadbalancer.backend import Backend
+from reactor.loadbalancer.nginx import connection
+from reactor.loadbalancer.nginx.upstream import UpstreamApi
+from reactor.loadbalancer.utils import FragmentCache
+
+FAKE_URL = "http://example.com/"
+FAKE_BACKENDS = [Backend("10.0.0.1", 80), Backend("10.0.0.2", 80, weight=2)]
+
+class NginxConnectionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.site_path = tempfile.mkdtemp()
+        self.conn = mock.Mock(spec=connection.Connection)
+        self.conn._SUPPORTED_URLS = connection.Connection._SUPPORTED_URLS
+        self.conn._cond = mock.Mock()
+        self.conn.tracked = {}
+        self.conn.servers = {}
+        self.conn.sites = {}
+        self.conn.written = {}
+        self.conn.fragments = FragmentCache()
+        self.conn.reload = False
+        self.conn.upstream_api = mock.Mock(spec=UpstreamApi)
+        self.conn.template = Template(filename=os.path.join(
+            os.path.dirname(connection.__file__), "nginx.template"))
+        manager_config = connection.NginxManagerConfig()
+        manager_config.site_path = self.site_path
+        self.conn._endpoint_config.side_effect = \
+            lambda config: config or connection.NginxEndpointConfig()
+        self.conn._manager_config.return_value = manager_config
+        self.conn.url_info.side_effect = \
+            lambda url: connection.Connection.url_info(self.conn, url)
+
+    def tearDown(self):
+        shutil.rmtree(self.site_path)
+
+    def _change(self, backends, config=None):
+        self.conn.reload = False
+        connection.Connection.change(self.conn, FAKE_URL, backends, config=config)
+
+    def _commit(self):
+        # Returns the base configuration, if it was written.
+        with mock.patch.object(connection, "write_atomic") as write:
+            with mock.patch("os.kill"):
+                with mock.patch("subprocess.call"):
+                    connection.Connection._commit(self.conn, "")
+        return write.called and write.call_args[0][1]
+
+    def _site_file(self):
+        return os.path.join(self.site_path,
+            "reactor.%s.conf" % connection.sha_hash(FAKE_URL))
+
+    def test_change_upstream(self):
+        # The first time, the server must be loaded.
+        self._change(FAKE_BACKENDS)
+        self.assertTrue(self.conn.reload)
+        self.assertFalse(self.conn.upstream_api.update.called)
+
+        # Afterwards, only the upstream changes.
+        self._change(FAKE_BACKENDS[:1])
+        self.assertFalse(self.conn.reload)
+        self.conn.upstream_api.update.assert_called_once_with(
+            connection.sha_hash(FAKE_URL), { "10.0.0.1:80" : 1 })
+        conf = self.conn.sites[connection.sha_hash(FAKE_URL)]
+        self.assertTrue("zone " in conf)
+        self.assertFalse("10.0.0.2" in conf)
+
+    def test_change_server(self):
+        self._change(FAKE_BACKENDS)
+        config = connection.NginxEndpointConfig()
+        config.keepalive = 8
+        self._change(FAKE_BACKENDS, config=config)
+        self.assertTrue(self.conn.reload)
+        self.assertFalse(self.conn.upstream_api.update.called)
+
+    def test_change_api_error(self):
+        for error in (IOError("refused"),
+                      httplib.BadStatusLine(""),
+                      socket.timeout("timed out")):
+            self._change(FAKE_BACKENDS)
+            self.conn.upstream_api.update.side_effect = error
+            self._change(FAKE_BACKENDS[:1])
+            self.assertTrue(self.conn.reload)
+            self.conn.upstream_api.update.side_effect = None
+
+    def test_change_remove(self):
+        self._change(FAKE_BACKENDS)
+        self._change([])
+        self.assertTrue(self.conn.reload)
+        self.assertEquals(self.conn.servers, {})
+        self.assertEquals(self.conn.sites, {})
+
+    def test_commit(self):
+        self._change(FAKE_BACKENDS)
+        self.assertTrue(self._commit())
+        self.assertEquals(open(self._site_file()).read(),
+                          self.conn.sites[connection.sha_hash(FAKE_URL)])
+
+        # Only the upstream changed, so the file is written without a reload.
+        self._change(FAKE_BACKENDS[:1])
+        self.assertFalse(self._commit())
+        self.assertFalse("10.0.0.2" in open(self._site_file()).read())
+
+        self._change([])
+        self.assertTrue(self._commit())
+        self.assertEquals(os.listdir(self.site_path), [])
+
+    def test_commit_log_format(self):
+        self._change(FAKE_BACKENDS)
+        self.assertFalse("reactor_json" in self._commit())
+
+        self.conn._manager_config().log_format = "json"
+        self.conn.reload = True
+        self.assertTrue("log_format reactor_json escape=json" in self._commit())
+
+    def test_render(self):
+        self._change(FAKE_BACKENDS)
+        output = connection.Connection._render(self.conn)
+        self._change(FAKE_BACKENDS)
+        self.assertEquals(connection.Connection._render(self.conn), output)
+        self._change(FAKE_BACKENDS[:1])
+        self.assertNotEquals(connection.Connection._render(self.conn), output)
@@ -0,0 +1,130 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import threading
+import unittest
+import BaseHTTPServer
+
+from reactor.loadbalancer.nginx.upstream import UpstreamApi
+
+class FakeApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _reply(self, code, body=None):
+        data = body is not None and json.dumps(body) or ""
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length))
+
+    def _handle(self, method):
+        api = self.server.api
+        api.requests.append((method, self.path))
+        parts = self.path.split("/")
+        if parts[1:4] != ["api", "http", "upstreams"] or parts[5] != "servers":
+            return self._reply(404)
+        servers = api.upstreams.setdefault(parts[4], {})
+        if method == "GET":
+            return self._reply(200, servers.values())
+        if method == "POST":
+            server = self._body()
+            server["id"] = api.next_id
+            api.next_id += 1
+            servers[server["id"]] = server
+            return self._reply(201, server)
+        server_id = int(parts[6])
+        if method == "PATCH":
+            servers[server_id].update(self._body())
+            return self._reply(200, servers[server_id])
+        if method == "DELETE":
+            del servers[server_id]
+            return self._reply(204)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def log_message(self, *args):
+        pass
+
+class FakeApi(object):
+
+    def __init__(self):
+        self.upstreams = {}
+        self.requests = []
+        self.next_id = 0
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), FakeApiHandler)
+        self.server.api = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self):
+        return "http://127.0.0.1:%d/api/" % self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class UpstreamApiTests(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeApi()
+        self.api = UpstreamApi(self.fake.url())
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def _weights(self):
+        return dict([(server, weight) for (server, (_, weight))
+                     in self.api.servers("up").items()])
+
+    def test_update(self):
+        self.api.update("up", { "10.0.0.1:80" : 1, "10.0.0.2:80" : 2 })
+        self.assertEquals(self._weights(), { "10.0.0.1:80" : 1, "10.0.0.2:80" : 2 })
+        removed = self.api.servers("up")["10.0.0.1:80"][0]
+
+        self.fake.requests = []
+        self.api.update("up", { "10.0.0.2:80" : 3, "10.0.0.3:80" : 1 })
+        self.assertEquals(self._weights(), { "10.0.0.2:80" : 3, "10.0.0.3:80" : 1 })
+
+        # Servers are added before any are removed.
+        methods = [method for (method, _) in self.fake.requests]
+        self.assertEquals(methods[0], "GET")
+        self.assertEquals(sorted(methods[1:3]), ["PATCH", "POST"])
+        self.assertEquals(self.fake.requests[3],
+            ("DELETE", "/api/http/upstreams/up/servers/%d" % removed))
+
+    def test_update_unchanged(self):
+        self.api.update("up", { "10.0.0.1:80" : 1 })
+        self.fake.requests = []
+        self.api.update("up", { "10.0.0.1:80" : 1 })
+        self.assertEquals(self.fake.requests, [("GET", "/api/http/upstreams/up/servers")])
+
+    def test_unavailable(self):
+        self.fake.stop()
+        self.assertRaises(IOError, self.api.update, "up", { "10.0.0.1:80" : 1 })
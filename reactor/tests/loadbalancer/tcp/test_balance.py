@@ -0,0 +1,124 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+import reactor.loadbalancer.tcp.balance as balance
+
+BACKEND_A = ("10.0.0.1", 80)
+BACKEND_B = ("10.0.0.2", 80)
+BACKEND_C = ("10.0.0.3", 80)
+BACKENDS = [BACKEND_A, BACKEND_B, BACKEND_C]
+
+def _counts(balancer, n, active=None, clients=None):
+    counts = {}
+    for i in range(n):
+        client = clients and clients[i % len(clients)] or "1.2.3.4"
+        backend = balancer.select(active or {}, client)
+        counts[backend] = counts.get(backend, 0) + 1
+    return counts
+
+class BalancerTests(unittest.TestCase):
+
+    def test_create(self):
+        self.assertIsInstance(balance.create("leastconn", BACKENDS), balance.LeastConnBalancer)
+        self.assertIsInstance(balance.create("bogus", BACKENDS), balance.RandomBalancer)
+
+    def test_zero_weights(self):
+        balancer = balance.create("random", BACKENDS, weights=[0, 0, 0])
+        self.assertEquals(balancer.weights, [1.0, 1.0, 1.0])
+
+    def test_random(self):
+        # The default ignores the weights (as it always has).
+        balancer = balance.create("random", BACKENDS, weights=[1, 0, 3])
+        counts = _counts(balancer, 3000)
+        for backend in BACKENDS:
+            self.assertTrue(800 < counts[backend] < 1200)
+
+    def test_random_weighted(self):
+        balancer = balance.create("weighted", BACKENDS, weights=[1, 0, 3])
+        counts = _counts(balancer, 4000)
+        self.assertNotIn(BACKEND_B, counts)
+        self.assertTrue(2.0 < float(counts[BACKEND_C]) / counts[BACKEND_A] < 4.5)
+
+    def test_create_existing(self):
+        balancer = balance.create("leastconn", BACKENDS)
+        self.assertIs(balance.create("leastconn", BACKENDS[:2],
+            weights=[1, 2], balancer=balancer), balancer)
+        self.assertEquals(balancer.backends, BACKENDS[:2])
+        self.assertEquals(balancer.weights, [1.0, 2.0])
+        other = balance.create("p2c", BACKENDS, balancer=balancer)
+        self.assertIsInstance(other, balance.TwoChoiceBalancer)
+        self.assertEquals(balancer.backends, BACKENDS[:2])
+
+    def test_roundrobin(self):
+        balancer = balance.create("roundrobin", BACKENDS, weights=[1, 2, 1])
+        picks = [balancer.select({}, None) for _ in range(8)]
+        self.assertEquals(picks.count(BACKEND_A), 2)
+        self.assertEquals(picks.count(BACKEND_B), 4)
+        self.assertEquals(picks.count(BACKEND_C), 2)
+        # The heavier backend is interleaved, not picked in a burst.
+        self.assertNotEquals(picks[0], picks[1])
+
+    def test_roundrobin_update(self):
+        balancer = balance.create("roundrobin", BACKENDS, weights=[1, 2, 1])
+        picks = [balancer.select({}, None) for _ in range(3)]
+
+        # Nothing changed, so the rotation just carries on.
+        balancer.update(BACKENDS, weights=[1, 2, 1])
+        picks.extend([balancer.select({}, None) for _ in range(5)])
+        self.assertEquals(picks.count(BACKEND_A), 2)
+        self.assertEquals(picks.count(BACKEND_B), 4)
+        self.assertEquals(picks.count(BACKEND_C), 2)
+
+        # The remaining backends keep their place.
+        current = dict(zip(balancer.backends, balancer.current))
+        balancer.update([BACKEND_C, BACKEND_A], weights=[1, 1])
+        self.assertEquals(balancer.current, [current[BACKEND_C], current[BACKEND_A]])
+
+    def test_leastconn(self):
+        balancer = balance.create("leastconn", BACKENDS)
+        active = { BACKEND_A : 3, BACKEND_B : 1, BACKEND_C : 2 }
+        self.assertEquals(balancer.select(active, None), BACKEND_B)
+
+    def test_leastconn_weighted(self):
+        balancer = balance.create("leastconn", BACKENDS, weights=[1, 1, 4])
+        active = { BACKEND_A : 1, BACKEND_B : 1, BACKEND_C : 3 }
+        self.assertEquals(balancer.select(active, None), BACKEND_C)
+
+    def test_p2c(self):
+        balancer = balance.create("p2c", BACKENDS)
+        active = { BACKEND_A : 100, BACKEND_B : 100, BACKEND_C : 0 }
+        counts = _counts(balancer, 900, active=active)
+        # The idle backend wins whenever it's one of the choices.
+        self.assertTrue(counts[BACKEND_C] > 450)
+
+    def test_hash(self):
+        balancer = balance.create("hash", BACKENDS)
+        clients = ["192.168.0.%d" % i for i in range(200)]
+        picks = [balancer.select({}, client) for client in clients]
+        self.assertEquals(picks, [balancer.select({}, client) for client in clients])
+        self.assertEquals(set(picks), set(BACKENDS))
+
+        # Removing a backend only moves the clients that were on it.
+        smaller = balance.create("hash", [BACKEND_A, BACKEND_B])
+        for (client, pick) in zip(clients, picks):
+            if pick != BACKEND_C:
+                self.assertEquals(smaller.select({}, client), pick)
+
+        # Updating is the same as starting over.
+        balancer.update([BACKEND_A, BACKEND_B])
+        self.assertEquals([balancer.select({}, client) for client in clients],
+                          [smaller.select({}, client) for client in clients])
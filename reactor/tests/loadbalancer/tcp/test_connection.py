@@ -16,7 +16,12 @@
 import unittest
 import mock
 import os
+import errno
+import socket
+import select
 import Queue
+import collections
+import time
 
 # Fake data
 FAKE_CMD = ["ls"]
@@ -53,6 +58,9 @@ class OsExit(Exception):
     pass
 
 import reactor.loadbalancer.tcp.connection as connection
+import reactor.loadbalancer.tcp.balance as balance
+
+FAKE_BALANCER = balance.create("random", [FAKE_BACKEND])
 
 class GlobalTests(unittest.TestCase):
     def test_close_fd_all_excepted(self):
@@ -112,6 +120,53 @@ class GlobalTests(unittest.TestCase):
             self.assertEquals(mock_setsid.call_count, 1)
             self.assertEquals(mock_execvp.call_count, 1)
 
+    def test_fork_and_exec_child_pgid(self):
+        with mock.patch('os.fork') as mock_fork,\
+                mock.patch('os.setsid') as mock_setsid,\
+                mock.patch('os.setpgid') as mock_setpgid,\
+                mock.patch('os.execvp') as mock_execvp,\
+                mock.patch(connection.__name__ + '.close_fds') as mock_close_fds:
+            mock_fork.side_effect = [ 0 ]
+            mock_setpgid.side_effect = [ OSError(), None ]
+            connection.fork_and_exec(FAKE_CMD, FAKE_CHILD_FDS, pgid=FAKE_CHILD_PID)
+            self.assertEquals(mock_setsid.call_count, 0)
+            self.assertEquals(mock_setpgid.call_args_list,
+                [mock.call(0, FAKE_CHILD_PID), mock.call(0, 0)])
+            self.assertEquals(mock_execvp.call_count, 1)
+
+class ChildReaperTests(unittest.TestCase):
+    def test_reap(self):
+        reaper = connection.ChildReaper()
+        exited = Queue.Queue()
+        try:
+            children = [
+                reaper.spawn(lambda pgid: connection.fork_and_exec(
+                    ["sh", "-c", "sleep 0.2; exit %d" % code], pgid=pgid),
+                    lambda pid, error: exited.put((pid, error)))
+                for code in (0, 3, 0)
+            ]
+            self.assertEquals(len(set(os.getpgid(child) for child in children)), 1)
+            results = dict(exited.get(timeout=10) for _ in children)
+            self.assertEquals(results, dict(zip(children, [False, True, False])))
+            self.assertEquals(reaper.children, {})
+
+            # A new group is created once the old one is gone.
+            child = reaper.spawn(lambda pgid: connection.fork_and_exec(
+                ["true"], pgid=pgid), lambda pid, error: exited.put((pid, error)))
+            self.assertEquals(exited.get(timeout=10), (child, False))
+        finally:
+            reaper.stop()
+            reaper.join()
+
+    def test_spawn_failed(self):
+        reaper = connection.ChildReaper()
+        try:
+            self.assertIsNone(reaper.spawn(lambda pgid: None, None))
+            self.assertEquals(reaper.children, {})
+        finally:
+            reaper.stop()
+            reaper.join()
+
 class AcceptTests(unittest.TestCase):
     def test_constructor_bad_socket(self):
         with mock.patch('os.dup') as mock_dup:
@@ -192,27 +247,42 @@ class ConnectionConsumerTests(unittest.TestCase):
     def test_set(self):
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
         mock_consumer._cond = mock.Mock()
-        connection.ConnectionConsumer.set(mock_consumer, FAKE_PORTS)
-        self.assertEquals(mock_consumer.portmap, FAKE_PORTS)
+        mock_consumer.waiting = {}
+        mock_consumer.ready = set()
+        mock_consumer.counts = {}
+        mock_consumer.accounting = { FAKE_BACKEND_ID : [1, 1, 1.0], "1.1.1.1:1" : [1, 1, 1.0] }
+        portmap = { FAKE_PORT : (FAKE_URL, False, None, 0, [FAKE_BACKEND], [], FAKE_BALANCER) }
+        connection.ConnectionConsumer.set(mock_consumer, portmap)
+        self.assertEquals(mock_consumer.portmap, portmap)
+        self.assertEquals(mock_consumer.backend_ports, { FAKE_BACKEND : set([FAKE_PORT]) })
+        self.assertEquals(mock_consumer.backend_keys, [FAKE_BACKEND_ID])
+        self.assertEquals(mock_consumer.accounting.keys(), [FAKE_BACKEND_ID])
 
     def test_handle_exclusive_locked(self):
         mock_accept = mock.Mock(spec=connection.Accept)
         mock_accept.fd = FAKE_CLIENT_FD
         mock_accept.src = FAKE_CLIENT_SOCKNAME
         mock_accept.dst = FAKE_SOCKNAME
-        mock_accept.redirect.return_value = FAKE_GRANDCHILD_PID
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
+        mock_consumer.engine.redirect.return_value = FAKE_GRANDCHILD_PID
         mock_consumer._cond = mock.Mock()
         mock_consumer.locks = mock.Mock()
         mock_consumer.locks.find.return_value = ["%s:%d" % (FAKE_BACKEND_IP, FAKE_PORT)]
         mock_consumer.error_notify = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], [])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], [], FAKE_BALANCER)
         mock_consumer.children = {}
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertTrue(handled)
-        self.assertEquals(mock_accept.redirect.call_count, 1)
+        self.assertEquals(mock_consumer.engine.redirect.call_count, 1)
         self.assertIn(FAKE_GRANDCHILD_PID, mock_consumer.children)
         self.assertEquals(mock_consumer.children[FAKE_GRANDCHILD_PID], (FAKE_BACKEND_IP, FAKE_PORT, mock_accept, FAKE_RECONNECT, False))
 
@@ -221,57 +291,107 @@ class ConnectionConsumerTests(unittest.TestCase):
         mock_accept.fd = FAKE_CLIENT_FD
         mock_accept.src = FAKE_CLIENT_SOCKNAME
         mock_accept.dst = FAKE_SOCKNAME
-        mock_accept.redirect.return_value = FAKE_GRANDCHILD_PID
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
+        mock_consumer.engine.redirect.return_value = FAKE_GRANDCHILD_PID
         mock_consumer._cond = mock.Mock()
         mock_consumer.locks = mock.Mock()
         mock_consumer.locks.find.return_value = []
         mock_consumer.locks.lock.return_value = FAKE_BACKEND_ID
         mock_consumer.error_notify = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], [])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], [], FAKE_BALANCER)
         mock_consumer.children = {}
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertTrue(handled)
-        self.assertEquals(mock_accept.redirect.call_count, 1)
+        self.assertEquals(mock_consumer.engine.redirect.call_count, 1)
         self.assertIn(FAKE_GRANDCHILD_PID, mock_consumer.children)
         self.assertEquals(mock_consumer.children[FAKE_GRANDCHILD_PID], (FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, FAKE_RECONNECT, False))
 
+    def test_handle_exclusive_redirect_failed(self):
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_accept.fd = FAKE_CLIENT_FD
+        mock_accept.src = FAKE_CLIENT_SOCKNAME
+        mock_accept.dst = FAKE_SOCKNAME
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
+        mock_consumer.engine.redirect.return_value = None
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.locks = mock.Mock()
+        mock_consumer.locks.find.return_value = []
+        mock_consumer.locks.lock.return_value = FAKE_BACKEND_ID
+        mock_consumer.error_notify = mock.Mock()
+        mock_consumer.portmap = {}
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], [], FAKE_BALANCER)
+        mock_consumer.children = {}
+        handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
+        self.assertTrue(handled)
+        self.assertEquals(mock_consumer.children, {})
+        self.assertEquals(mock_accept.drop.call_count, 1)
+        mock_consumer.locks.remove.assert_called_once_with(FAKE_BACKEND_ID)
+        mock_consumer._released.assert_called_once_with(FAKE_BACKEND_IP, FAKE_BACKEND_PORT)
+
     def test_handle_exclusive_no_hosts(self):
         mock_accept = mock.Mock(spec=connection.Accept)
         mock_accept.fd = FAKE_CLIENT_FD
         mock_accept.src = FAKE_CLIENT_SOCKNAME
         mock_accept.dst = FAKE_SOCKNAME
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
         mock_consumer._cond = mock.Mock()
         mock_consumer.locks = mock.Mock()
         mock_consumer.locks.find.return_value = []
         mock_consumer.locks.lock.return_value = None
         mock_consumer.error_notify = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], [])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], [], FAKE_BALANCER)
         mock_consumer.children = {}
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertFalse(handled)
-        self.assertEquals(mock_accept.redirect.call_count, 0)
+        self.assertEquals(mock_consumer.engine.redirect.call_count, 0)
 
     def test_handle_unexclusive(self):
         mock_accept = mock.Mock(spec=connection.Accept)
         mock_accept.fd = FAKE_CLIENT_FD
         mock_accept.src = FAKE_CLIENT_SOCKNAME
         mock_accept.dst = FAKE_SOCKNAME
-        mock_accept.redirect.return_value = FAKE_GRANDCHILD_PID
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
+        mock_consumer.engine.redirect.return_value = FAKE_GRANDCHILD_PID
         mock_consumer._cond = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, False, None, 0, [FAKE_BACKEND], [])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, False, None, 0, [FAKE_BACKEND], [], FAKE_BALANCER)
         mock_consumer.children = {}
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
         mock_consumer.error_notify = mock.Mock()
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertTrue(handled)
-        self.assertEquals(mock_accept.redirect.call_count, 1)
+        self.assertEquals(mock_consumer.engine.redirect.call_count, 1)
         self.assertIn(FAKE_GRANDCHILD_PID, mock_consumer.children)
         self.assertEquals(mock_consumer.children[FAKE_GRANDCHILD_PID], (FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, 0, False))
+        self.assertEquals(mock_consumer.active, { FAKE_BACKEND : 1 })
+        self.assertIn(FAKE_GRANDCHILD_PID, mock_consumer.started)
+        self.assertEquals(mock_consumer.accounting, { FAKE_BACKEND_ID : [1, 0, 0.0] })
+        self.assertEquals(mock_consumer.clients, { FAKE_BACKEND_ID : { FAKE_GRANDCHILD_PID : FAKE_CLIENT_SESSION } })
+        self.assertEquals(mock_consumer.changed, set([FAKE_BACKEND_ID]))
+        mock_consumer._count.assert_called_once_with(FAKE_BACKEND_ID, 1)
 
     def test_handle_unexclusive_no_hosts(self):
         mock_accept = mock.Mock(spec=connection.Accept)
@@ -279,12 +399,19 @@ class ConnectionConsumerTests(unittest.TestCase):
         mock_accept.src = FAKE_CLIENT_SOCKNAME
         mock_accept.dst = FAKE_SOCKNAME
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
         mock_consumer._cond = mock.Mock()
         mock_consumer.portmap = {}
         mock_consumer.children = {}
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertTrue(handled)
-        self.assertEquals(mock_accept.redirect.call_count, 0)
+        self.assertEquals(mock_consumer.engine.redirect.call_count, 0)
         self.assertEquals(mock_accept.drop.call_count, 1)
 
     def test_handle_unexclusive_redirect_failed(self):
@@ -292,16 +419,28 @@ class ConnectionConsumerTests(unittest.TestCase):
         mock_accept.fd = FAKE_CLIENT_FD
         mock_accept.src = FAKE_CLIENT_SOCKNAME
         mock_accept.dst = FAKE_SOCKNAME
-        mock_accept.redirect.return_value = None
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
+        mock_consumer.engine.redirect.return_value = None
         mock_consumer._cond = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, False, None, 0, [FAKE_BACKEND], [])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, False, None, 0, [FAKE_BACKEND], [], FAKE_BALANCER)
         mock_consumer.children = {}
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
+        mock_consumer.error_notify = mock.Mock()
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
-        self.assertFalse(handled)
-        self.assertEquals(mock_accept.redirect.call_count, 1)
+
+        # The client is dropped, rather than left to be retried.
+        self.assertTrue(handled)
+        self.assertEquals(mock_consumer.engine.redirect.call_count, 1)
         self.assertNotIn(FAKE_GRANDCHILD_PID, mock_consumer.children)
+        self.assertEquals(mock_accept.drop.call_count, 1)
+        mock_consumer.error_notify.assert_called_once_with(FAKE_BACKEND_ID)
 
     def test_wait(self):
         # No logic in wait
@@ -312,46 +451,135 @@ class ConnectionConsumerTests(unittest.TestCase):
         pass
 
     def test_run_handle_one(self):
-        with mock.patch('os.kill') as mock_kill:
-            mock_accept = mock.Mock(spec=connection.Accept)
-            mock_accept.fd = FAKE_CLIENT_FD
-            mock_accept.src = FAKE_CLIENT_SOCKNAME
-            mock_accept.dst = FAKE_SOCKNAME
-            mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
-            mock_consumer.is_running.side_effect = True
-            mock_consumer.handle.return_value = True
-            mock_consumer.producer = mock.Mock()
-            mock_consumer.producer.next.side_effect = [ mock_accept, None ]
-            mock_consumer.postponed = []
-            mock_consumer._cond = mock.Mock()
-            mock_consumer.locks = mock.Mock()
-            mock_consumer.error_notify = mock.Mock()
-            mock_consumer.is_running.side_effect = [True, True, False]
-            mock_consumer.children = {}
-            connection.ConnectionConsumer.run(mock_consumer)
-            self.assertEquals(mock_consumer.handle.call_count, 1)
-            self.assertEquals(mock_consumer.reap_children.call_count, 0)
-            self.assertEquals(mock_consumer.producer.next.call_count, 2)
-            self.assertEquals(len(mock_consumer.postponed), 0)
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.producer = mock.Mock()
+        mock_consumer.producer.next.side_effect = [ mock_accept, None ]
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.is_running.side_effect = [True, True, False]
+        mock_consumer.waiting = {}
+        mock_consumer._timeout.return_value = None
+        connection.ConnectionConsumer.run(mock_consumer)
+        mock_consumer.enqueue.assert_called_once_with(mock_accept)
+        self.assertEquals(mock_consumer.producer.next.call_count, 2)
+        self.assertEquals(mock_consumer.reap_children.call_count, 1)
+        self.assertEquals(mock_consumer.clear_standby.call_count, 1)
+        self.assertEquals(mock_consumer.serve.call_count, 1)
+        mock_consumer._wait.assert_called_once_with(None)
 
-    def test_run_push_one(self):
-        with mock.patch('os.kill') as mock_kill:
-            mock_accept = mock.Mock(spec=connection.Accept)
-            mock_accept.fd = FAKE_CLIENT_FD
-            mock_accept.src = FAKE_CLIENT_SOCKNAME
-            mock_accept.dst = FAKE_SOCKNAME
-            mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
-            mock_consumer.is_running.side_effect = [True, False]
-            mock_consumer.handle.return_value = False
-            mock_consumer.producer = mock.Mock()
-            mock_consumer.producer.next.side_effect = [ mock_accept, None ]
-            mock_consumer.children = {}
-            mock_consumer.postponed = []
-            mock_consumer._cond = mock.Mock()
+    def test_run_publish_busy(self):
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.producer = mock.Mock()
+        mock_consumer.producer.next.return_value = mock_accept
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.is_running.side_effect = [True] * 4 + [False]
+        interval = connection.PUBLISH_INTERVAL
+        times = [0.0, 0.0, interval / 2, interval, interval * 1.5]
+        with mock.patch('time.time', side_effect=times):
             connection.ConnectionConsumer.run(mock_consumer)
-            self.assertEquals(mock_consumer.handle.call_count, 1)
-            self.assertEquals(mock_consumer.producer.next.call_count, 1)
-            self.assertEquals(len(mock_consumer.postponed), 1)
+
+        # The producer never ran dry, but the state was still published.
+        self.assertEquals(mock_consumer.enqueue.call_count, 4)
+        self.assertEquals(mock_consumer.serve.call_count, 0)
+        self.assertEquals(mock_consumer._publish.call_count, 1)
+
+    def test_enqueue_handled(self):
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_accept.dst = FAKE_SOCKNAME
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.waiting = {}
+        mock_consumer.handle.return_value = True
+        connection.ConnectionConsumer.enqueue(mock_consumer, mock_accept)
+        mock_consumer.handle.assert_called_once_with(mock_accept)
+        self.assertEquals(mock_consumer.waiting, {})
+
+    def test_enqueue_postponed(self):
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_accept.dst = FAKE_SOCKNAME
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.waiting = {}
+        mock_consumer.handle.return_value = False
+        connection.ConnectionConsumer.enqueue(mock_consumer, mock_accept)
+        self.assertEquals(list(mock_consumer.waiting[FAKE_PORT]), [mock_accept])
+
+    def test_enqueue_behind_waiting(self):
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_accept.dst = FAKE_SOCKNAME
+        mock_waiting = mock.Mock(spec=connection.Accept)
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.waiting = { FAKE_PORT : collections.deque([mock_waiting]) }
+        connection.ConnectionConsumer.enqueue(mock_consumer, mock_accept)
+        self.assertEquals(mock_consumer.handle.call_count, 0)
+        self.assertEquals(list(mock_consumer.waiting[FAKE_PORT]),
+            [mock_waiting, mock_accept])
+
+    def test_serve(self):
+        clients = [mock.Mock(spec=connection.Accept) for _ in range(3)]
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.waiting = {
+            FAKE_PORT : collections.deque(clients),
+            FAKE_PORT_2 : collections.deque([mock.Mock()]),
+        }
+        mock_consumer.ready = set([FAKE_PORT])
+        mock_consumer.handle.side_effect = [True, False]
+        self.assertEquals(connection.ConnectionConsumer.serve(mock_consumer), 1)
+
+        # Only the ready port is served, in order, and
+        # we stop at the first client that can't be handled.
+        self.assertEquals(mock_consumer.handle.call_args_list,
+            [mock.call(clients[0]), mock.call(clients[1])])
+        self.assertEquals(list(mock_consumer.waiting[FAKE_PORT]), clients[1:])
+        self.assertIn(FAKE_PORT_2, mock_consumer.waiting)
+        self.assertEquals(mock_consumer.ready, set())
+
+    def test_serve_all(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.waiting = { FAKE_PORT : collections.deque([mock.Mock()]) }
+        mock_consumer.ready = set([FAKE_PORT, FAKE_PORT_2])
+        mock_consumer.handle.return_value = True
+        self.assertEquals(connection.ConnectionConsumer.serve(mock_consumer), 1)
+        self.assertEquals(mock_consumer.waiting, {})
+
+    def test_released(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.ready = set()
+        mock_consumer.waiting = { FAKE_PORT : collections.deque([mock.Mock()]) }
+        mock_consumer.counts = {}
+        mock_consumer.accounting = {}
+        connection.ConnectionConsumer.set(mock_consumer,
+            { FAKE_PORT : (FAKE_URL, True, None, 0, [FAKE_BACKEND], [], FAKE_BALANCER),
+              FAKE_PORT_2 : (FAKE_URL, True, None, 0, [], [], FAKE_BALANCER) })
+        # Changing the portmap marks all waiting ports.
+        self.assertEquals(mock_consumer.ready, set([FAKE_PORT]))
+        mock_consumer.ready = set()
+        connection.ConnectionConsumer._released(mock_consumer, *FAKE_BACKEND)
+        self.assertEquals(mock_consumer.ready, set([FAKE_PORT]))
+        connection.ConnectionConsumer._released(mock_consumer, "1.1.1.1", 1)
+        self.assertEquals(mock_consumer.ready, set([FAKE_PORT]))
+
+    def test_locks_changed(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.ready = set()
+        mock_consumer.waiting = { FAKE_PORT : collections.deque([mock.Mock()]) }
+        connection.ConnectionConsumer.locks_changed(mock_consumer)
+        self.assertEquals(mock_consumer.ready, set([FAKE_PORT]))
+        self.assertEquals(mock_consumer._notify.call_count, 1)
+
+    def test_timeout(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.standby = {}
+        self.assertIsNone(connection.ConnectionConsumer._timeout(mock_consumer, 100.0))
+        mock_consumer.standby = { FAKE_BACKEND : (110.0, False) }
+        self.assertEquals(connection.ConnectionConsumer._timeout(mock_consumer, 100.0), 10.0)
+        self.assertEquals(connection.ConnectionConsumer._timeout(mock_consumer, 120.0), 0)
 
     def test_reap_children(self):
         with mock.patch('os.kill') as mock_kill:
@@ -365,10 +593,25 @@ class ConnectionConsumerTests(unittest.TestCase):
             mock_consumer.error_notify = mock.Mock()
             mock_consumer.discard_notify = mock.Mock()
             mock_consumer.children = { FAKE_GRANDCHILD_PID : ( FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, 0, False ) }
-            mock_kill.side_effect = OSError()
-            connection.ConnectionConsumer.reap_children(mock_consumer)
+            mock_consumer.active = { FAKE_BACKEND : 2 }
+            mock_consumer.started = { FAKE_GRANDCHILD_PID : FAKE_NOW - 10 }
+            mock_consumer.accounting = {}
+            mock_consumer.counts = {}
+            mock_consumer.clients = {}
+            mock_consumer.changed = set()
+            mock_consumer.exits = Queue.Queue()
+            mock_consumer.exits.put((FAKE_GRANDCHILD_PID, False))
+            with mock.patch('time.time') as mock_time:
+                mock_time.return_value = FAKE_NOW
+                connection.ConnectionConsumer.reap_children(mock_consumer)
             self.assertNotIn(FAKE_GRANDCHILD_PID, mock_consumer.children)
             self.assertEquals(mock_consumer.discard_notify.call_count, 0)
+            self.assertEquals(mock_consumer.active, { FAKE_BACKEND : 1 })
+            self.assertEquals(mock_consumer.started, {})
+            self.assertEquals(mock_consumer.accounting, { FAKE_BACKEND_ID : [0, 1, 10] })
+            mock_consumer._count.assert_called_once_with(FAKE_BACKEND_ID, -1)
+            mock_consumer._released.assert_called_once_with(
+                FAKE_BACKEND_IP, FAKE_BACKEND_PORT)
 
     def test_reap_children_disposable(self):
         with mock.patch('os.kill') as mock_kill:
@@ -382,12 +625,41 @@ class ConnectionConsumerTests(unittest.TestCase):
             mock_consumer.error_notify = mock.Mock()
             mock_consumer.discard_notify = mock.Mock()
             mock_consumer.children = { FAKE_GRANDCHILD_PID : ( FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, 0, True ) }
-            mock_kill.side_effect = OSError()
+            mock_consumer.active = {}
+            mock_consumer.started = {}
+            mock_consumer.accounting = {}
+            mock_consumer.counts = {}
+            mock_consumer.clients = {}
+            mock_consumer.changed = set()
+            mock_consumer.exits = Queue.Queue()
+            mock_consumer.exits.put((FAKE_GRANDCHILD_PID, False))
             connection.ConnectionConsumer.reap_children(mock_consumer)
             self.assertNotIn(FAKE_GRANDCHILD_PID, mock_consumer.children)
             self.assertEquals(mock_consumer.discard_notify.call_count, 1)
             self.assertEquals(mock_consumer.discard_notify.call_args_list[0][0][0], FAKE_BACKEND_IP)
 
+    def test_reap_children_error(self):
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.locks = mock.Mock()
+        mock_consumer.error_notify = mock.Mock()
+        mock_consumer.discard_notify = mock.Mock()
+        mock_consumer.children = { FAKE_GRANDCHILD_PID : ( FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, 0, False ) }
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
+        mock_consumer.standby = {}
+        mock_consumer.exits = Queue.Queue()
+        mock_consumer.exits.put((FAKE_CHILD_PID, False))
+        mock_consumer.exits.put((FAKE_GRANDCHILD_PID, True))
+        self.assertEquals(connection.ConnectionConsumer.reap_children(mock_consumer), 1)
+        self.assertEquals(mock_consumer.error_notify.call_args_list[0][0][0], FAKE_BACKEND_ID)
+        self.assertEquals(mock_consumer.locks.remove.call_args_list[0][0][0], FAKE_BACKEND_ID)
+
     def test_reap_children_no_children(self):
         with mock.patch('os.kill') as mock_kill:
             mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
@@ -395,30 +667,104 @@ class ConnectionConsumerTests(unittest.TestCase):
             mock_consumer.locks = mock.Mock()
             mock_consumer.error_notify = mock.Mock()
             mock_consumer.children = {}
+            mock_consumer.active = {}
+            mock_consumer.started = {}
+            mock_consumer.accounting = {}
+            mock_consumer.counts = {}
+            mock_consumer.clients = {}
+            mock_consumer.changed = set()
+            mock_consumer.exits = Queue.Queue()
             connection.ConnectionConsumer.reap_children(mock_consumer)
             self.assertEquals(mock_kill.call_count, 0)
 
+    def test_metrics(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.snapshot = ({ FAKE_BACKEND_ID : 1 }, {}, {})
+        mock_consumer.accounting = { FAKE_BACKEND_ID : [5, 3, 40.0] }
+        mock_consumer.reported = { FAKE_BACKEND_ID : (1, 1, 10.0), "1.1.1.1:1" : (1, 1, 1.0) }
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
+        mock_consumer.last_metrics = FAKE_NOW - 2
+        mock_consumer.engine = mock.Mock()
+        mock_consumer.engine.traffic.return_value = { FAKE_BACKEND : (1000, 2000) }
+        with mock.patch('time.time') as mock_time:
+            mock_time.return_value = FAKE_NOW
+            metrics = connection.ConnectionConsumer.metrics(mock_consumer)
+        self.assertEquals(metrics, { FAKE_BACKEND_ID : [{
+            "active" : (1, 1),
+            "rate" : (1, 2.0),
+            "session_seconds" : (2, 15.0),
+            "bytes_in" : (1, 500.0),
+            "bytes_out" : (1, 1000.0),
+        }] })
+        self.assertEquals(mock_consumer.reported, { FAKE_BACKEND_ID : (5, 3, 40.0) })
+        self.assertEquals(mock_consumer.last_metrics, FAKE_NOW)
+
+    def test_metrics_no_traffic(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.snapshot = ({ FAKE_BACKEND_ID : 0 }, {}, {})
+        mock_consumer.accounting = {}
+        mock_consumer.reported = {}
+        mock_consumer.last_metrics = FAKE_NOW
+        mock_consumer.engine = mock.Mock()
+        mock_consumer.engine.traffic.return_value = None
+        with mock.patch('time.time') as mock_time:
+            mock_time.return_value = FAKE_NOW
+            metrics = connection.ConnectionConsumer.metrics(mock_consumer)
+        self.assertEquals(metrics, { FAKE_BACKEND_ID : [{
+            "active" : (1, 0),
+            "rate" : (1, 0.0),
+        }] })
+
     def test_sessions(self):
-        with mock.patch(connection.__name__ + '._as_client') as mock_ac:
-            mock_accept = mock.Mock(spec=connection.Accept)
-            mock_accept.fd = FAKE_CLIENT_FD
-            mock_accept.src = FAKE_CLIENT_SOCKNAME
-            mock_accept.dst = FAKE_SOCKNAME
-            mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
-            mock_consumer._cond = mock.Mock()
-            mock_consumer.children = { FAKE_GRANDCHILD_PID : ( FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, 0, False ) }
-            mock_ac.return_value = FAKE_CLIENT_SESSION
-            sessions = connection.ConnectionConsumer.sessions(mock_consumer)
-            self.assertIn(FAKE_BACKEND_ID, sessions)
-            self.assertEquals(sessions[FAKE_BACKEND_ID], [FAKE_CLIENT_SESSION])
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.snapshot = ({}, { FAKE_BACKEND_ID : [FAKE_CLIENT_SESSION] }, {})
+        sessions = connection.ConnectionConsumer.sessions(mock_consumer)
+        self.assertEquals(sessions, { FAKE_BACKEND_ID : [FAKE_CLIENT_SESSION] })
 
     def test_sessions_no_clients(self):
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
-        mock_consumer._cond = mock.Mock()
-        mock_consumer.children = {}
+        mock_consumer.snapshot = ({}, {}, {})
         sessions = connection.ConnectionConsumer.sessions(mock_consumer)
         self.assertEquals(sessions, {})
 
+    def test_count(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.counts = {}
+        connection.ConnectionConsumer._count(mock_consumer, FAKE_BACKEND_ID, 1)
+        connection.ConnectionConsumer._count(mock_consumer, FAKE_BACKEND_ID, 1)
+        self.assertEquals(mock_consumer.counts, { FAKE_BACKEND_ID : 2 })
+        connection.ConnectionConsumer._count(mock_consumer, FAKE_BACKEND_ID, -2)
+        self.assertEquals(mock_consumer.counts, {})
+
+    def test_publish(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.portmap = { FAKE_PORT : (FAKE_URL, True, None, 0, [FAKE_BACKEND], [], FAKE_BALANCER) }
+        mock_consumer.backend_keys = [FAKE_BACKEND_ID]
+        mock_consumer.counts = { "1.1.1.1:1" : 1 }
+        mock_consumer.clients = {
+            FAKE_BACKEND_ID : { FAKE_GRANDCHILD_PID : FAKE_CLIENT_SESSION },
+            "1.1.1.1:1" : { FAKE_CHILD_PID : FAKE_CLIENT_SESSION_BOGUS },
+        }
+        mock_consumer.changed = set([FAKE_BACKEND_ID])
+        mock_consumer.waiting = { FAKE_PORT : collections.deque([mock.Mock(), mock.Mock()]) }
+        old_sessions = { "1.1.1.1:1" : [FAKE_CLIENT_SESSION_BOGUS], "2.2.2.2:2" : ["gone"] }
+        mock_consumer.snapshot = ({}, old_sessions, {})
+        mock_consumer.changed.add("2.2.2.2:2")
+        connection.ConnectionConsumer._publish(mock_consumer)
+        (active, sessions, pending) = mock_consumer.snapshot
+        self.assertEquals(active, { FAKE_BACKEND_ID : 0, "1.1.1.1:1" : 1 })
+        self.assertEquals(sessions, {
+            FAKE_BACKEND_ID : [FAKE_CLIENT_SESSION],
+            "1.1.1.1:1" : [FAKE_CLIENT_SESSION_BOGUS] })
+        self.assertEquals(pending, { FAKE_URL : 2 })
+        self.assertEquals(mock_consumer.changed, set())
+        # The previous snapshot is never modified.
+        self.assertIn("2.2.2.2:2", old_sessions)
+
     def test_drop_session(self):
         with mock.patch('os.kill') as mock_kill,\
                 mock.patch(connection.__name__ + '._as_client') as mock_ac:
@@ -427,12 +773,19 @@ class ConnectionConsumerTests(unittest.TestCase):
             mock_accept.src = FAKE_CLIENT_SOCKNAME
             mock_accept.dst = FAKE_SOCKNAME
             mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+            mock_consumer.engine = mock.Mock()
             mock_consumer._cond = mock.Mock()
             mock_consumer.children = { FAKE_GRANDCHILD_PID : ( FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, 0, False ) }
+            mock_consumer.active = {}
+            mock_consumer.started = {}
+            mock_consumer.accounting = {}
+            mock_consumer.counts = {}
+            mock_consumer.clients = {}
+            mock_consumer.changed = set()
             mock_ac.return_value = FAKE_CLIENT_SESSION
             connection.ConnectionConsumer.drop_session(mock_consumer, FAKE_CLIENT_SESSION, FAKE_BACKEND_ID)
-            self.assertEquals(mock_kill.call_count, 1)
-            self.assertEquals(mock_kill.call_args_list[0][0][0], FAKE_GRANDCHILD_PID)
+            self.assertEquals(mock_consumer.engine.kill.call_count, 1)
+            self.assertEquals(mock_consumer.engine.kill.call_args_list[0][0][0], FAKE_GRANDCHILD_PID)
 
     def test_drop_session_nonexistant(self):
         with mock.patch('os.kill') as mock_kill,\
@@ -442,11 +795,18 @@ class ConnectionConsumerTests(unittest.TestCase):
             mock_accept.src = FAKE_CLIENT_SOCKNAME
             mock_accept.dst = FAKE_SOCKNAME
             mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+            mock_consumer.engine = mock.Mock()
             mock_consumer._cond = mock.Mock()
             mock_consumer.children = { FAKE_GRANDCHILD_PID : ( FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, 0, False ) }
+            mock_consumer.active = {}
+            mock_consumer.started = {}
+            mock_consumer.accounting = {}
+            mock_consumer.counts = {}
+            mock_consumer.clients = {}
+            mock_consumer.changed = set()
             mock_ac.return_value = FAKE_CLIENT_SESSION
             connection.ConnectionConsumer.drop_session(mock_consumer, FAKE_CLIENT_SESSION_BOGUS, FAKE_BACKEND_ID)
-            self.assertEquals(mock_kill.call_count, 0)
+            self.assertEquals(mock_consumer.engine.kill.call_count, 0)
             self.assertIn(FAKE_GRANDCHILD_PID, mock_consumer.children)
 
 class ConnectionProducerTests(unittest.TestCase):
@@ -457,6 +817,9 @@ class ConnectionProducerTests(unittest.TestCase):
     def test_set_add_one(self):
         with mock.patch('socket.socket') as mock_socket:
             mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+            mock_producer.backlog = connection.DEFAULT_BACKLOG
+            mock_producer.reuseport = False
+            mock_producer.epoll = mock.Mock()
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = {}
             mock_producer.filemap = {}
@@ -474,6 +837,9 @@ class ConnectionProducerTests(unittest.TestCase):
     def test_set_add_one_cant_bind(self):
         with mock.patch('socket.socket') as mock_socket:
             mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+            mock_producer.backlog = connection.DEFAULT_BACKLOG
+            mock_producer.reuseport = False
+            mock_producer.epoll = mock.Mock()
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = {}
             mock_producer.filemap = {}
@@ -489,6 +855,9 @@ class ConnectionProducerTests(unittest.TestCase):
     def test_set_add_two_cant_bind(self):
         with mock.patch('socket.socket') as mock_socket:
             mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+            mock_producer.backlog = connection.DEFAULT_BACKLOG
+            mock_producer.reuseport = False
+            mock_producer.epoll = mock.Mock()
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = {}
             mock_producer.filemap = {}
@@ -510,6 +879,9 @@ class ConnectionProducerTests(unittest.TestCase):
             mock_socket_obj.fileno.return_value = FAKE_SOCK_FD
             mock_socket.return_value = mock_socket_obj
             mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+            mock_producer.backlog = connection.DEFAULT_BACKLOG
+            mock_producer.reuseport = False
+            mock_producer.epoll = mock.Mock()
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = { FAKE_PORT : mock_socket_obj }
             mock_producer.filemap = { FAKE_SOCK_FD : mock_socket_obj }
@@ -528,6 +900,9 @@ class ConnectionProducerTests(unittest.TestCase):
             mock_socket_obj_2.fileno.return_value = FAKE_SOCK_FD_2
             mock_socket.return_value = mock_socket_obj_2
             mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+            mock_producer.backlog = connection.DEFAULT_BACKLOG
+            mock_producer.reuseport = False
+            mock_producer.epoll = mock.Mock()
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = { FAKE_PORT : mock_socket_obj }
             mock_producer.filemap = { FAKE_SOCK_FD : mock_socket_obj }
@@ -553,6 +928,9 @@ class ConnectionProducerTests(unittest.TestCase):
             mock_socket_obj_2.bind.side_effect = IOError()
             mock_socket.return_value = mock_socket_obj_2
             mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+            mock_producer.backlog = connection.DEFAULT_BACKLOG
+            mock_producer.reuseport = False
+            mock_producer.epoll = mock.Mock()
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = { FAKE_PORT : mock_socket_obj }
             mock_producer.filemap = { FAKE_SOCK_FD : mock_socket_obj }
@@ -568,26 +946,43 @@ class ConnectionProducerTests(unittest.TestCase):
             self.assertEquals(mock_socket_obj_2.listen.call_count, 0)
             self.assertEquals(mock_socket_obj_2.close.call_count, 0)
 
-    def test__update_epoll(self):
-        # Some systems, e.g. OS X, don't have epoll, hence create=True
-        # for select.epoll, and we need to mock the select.EPOLLIN
-        # constant as well.
-        with mock.patch('select.epoll', create=True) as mock_epoll,\
-                mock.patch('select.EPOLLIN', create=True) as mock_epollin:
+    def test_set_epoll_incremental(self):
+        with mock.patch('socket.socket') as mock_socket:
             mock_socket_obj = mock.Mock()
             mock_socket_obj.fileno.return_value = FAKE_SOCK_FD
+            mock_socket_obj_2 = mock.Mock()
+            mock_socket_obj_2.fileno.return_value = FAKE_SOCK_FD_2
+            mock_socket.return_value = mock_socket_obj_2
             mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+            mock_producer.backlog = connection.DEFAULT_BACKLOG
+            mock_producer.reuseport = False
+            mock_producer.epoll = mock.Mock()
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = { FAKE_PORT : mock_socket_obj }
             mock_producer.filemap = { FAKE_SOCK_FD : mock_socket_obj }
-            connection.ConnectionProducer._update_epoll(mock_producer)
-            self.assertEquals(mock_epoll.call_count, 1)
+
+            # Adding a port only registers the new socket.
+            connection.ConnectionProducer.set(mock_producer, FAKE_PORTS_MULT)
+            mock_producer.epoll.register.assert_called_once_with(
+                FAKE_SOCK_FD_2, select.EPOLLIN)
+            self.assertEquals(mock_producer.epoll.unregister.call_count, 0)
+
+            # Removing a port unregisters it before it is closed.
+            mock_socket_obj.close.side_effect = lambda: \
+                self.assertEquals(mock_producer.epoll.unregister.call_count, 1)
+            connection.ConnectionProducer.set(mock_producer, [FAKE_PORT_2])
+            mock_producer.epoll.unregister.assert_called_once_with(FAKE_SOCK_FD)
             self.assertEquals(mock_producer.epoll.register.call_count, 1)
+            self.assertEquals(mock_socket_obj.close.call_count, 1)
+            self.assertEquals(mock_producer.epoll.close.call_count, 0)
 
     def test_run_epoll_accept_one(self):
         with mock.patch(connection.__name__ + ".Accept") as mock_accept:
             mock_socket_obj = mock.Mock()
             mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+            mock_producer.backlog = connection.DEFAULT_BACKLOG
+            mock_producer.reuseport = False
+            mock_producer.epoll = mock.Mock()
             mock_producer._cond = mock.Mock()
             mock_producer.queue = Queue.Queue()
             mock_producer.notifiers = []
@@ -596,9 +991,50 @@ class ConnectionProducerTests(unittest.TestCase):
             mock_producer.is_running.side_effect = [True, False]
             mock_producer.epoll = mock.Mock()
             mock_producer.epoll.poll.return_value = [(FAKE_SOCK_FD, GARBAGE)]
+            mock_producer.accepted = {}
+            mock_producer.errors = {}
+            mock_producer.accept.side_effect = lambda sock: \
+                connection.ConnectionProducer.accept(mock_producer, sock)
+            mock_accept.side_effect = [
+                mock.Mock(), mock.Mock(),
+                socket.error(errno.EAGAIN, "would block")]
             connection.ConnectionProducer.run(mock_producer)
             self.assertEquals(mock_producer.epoll.poll.call_count, 1)
-            self.assertEquals(mock_accept.call_count, 1)
+            self.assertEquals(mock_accept.call_count, 3)
+            self.assertEquals(mock_producer.queue.qsize(), 2)
+            mock_producer._count.assert_called_once_with(
+                mock_producer.accepted, mock_socket_obj, 2)
+            self.assertEquals(mock_producer.notify.call_count, 1)
+
+    def test_accept_error(self):
+        with mock.patch(connection.__name__ + ".Accept") as mock_accept:
+            mock_socket_obj = mock.Mock()
+            mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+            mock_producer.queue = Queue.Queue()
+            mock_producer.accepted = {}
+            mock_producer.errors = {}
+            mock_accept.side_effect = [
+                socket.error(errno.EINTR, "interrupted"),
+                mock.Mock(),
+                socket.error(errno.EMFILE, "too many open files")]
+            self.assertEquals(
+                connection.ConnectionProducer.accept(mock_producer, mock_socket_obj), 1)
+            self.assertEquals(mock_producer.queue.qsize(), 1)
+            self.assertEquals(mock_producer._count.call_args_list, [
+                mock.call(mock_producer.errors, mock_socket_obj, 1),
+                mock.call(mock_producer.accepted, mock_socket_obj, 1)])
+
+    def test_stats(self):
+        mock_socket_obj = mock.Mock()
+        mock_socket_obj.getsockopt.side_effect = socket.error(errno.ENOPROTOOPT, "")
+        mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+        mock_producer._cond = mock.Mock()
+        mock_producer.sockets = { FAKE_PORT : mock_socket_obj }
+        mock_producer.accepted = { FAKE_PORT : 3 }
+        mock_producer.errors = {}
+        self.assertEquals(connection.ConnectionProducer.stats(mock_producer),
+            { FAKE_PORT : (3, 0, None) })
+        self.assertEquals(mock_producer.accepted, {})
 
     def test_run_epoll_stale_sock(self):
         mock_producer = mock.Mock(spec=connection.ConnectionProducer)
@@ -610,7 +1046,18 @@ class ConnectionProducerTests(unittest.TestCase):
         mock_producer.epoll.poll.return_value = [(FAKE_SOCK_FD, GARBAGE)]
         connection.ConnectionProducer.run(mock_producer)
         self.assertEquals(mock_producer.epoll.poll.call_count, 1)
-        self.assertEquals(mock_producer._update_epoll.call_count, 1)
+        self.assertEquals(mock_producer.accept.call_count, 0)
+        self.assertEquals(mock_producer.notify.call_count, 0)
+
+    def test_stop_closes_epoll(self):
+        mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+        mock_producer._cond = mock.Mock()
+        mock_producer.epoll = mock.Mock()
+        mock_producer.join.side_effect = lambda: \
+            self.assertEquals(mock_producer.epoll.close.call_count, 0)
+        connection.ConnectionProducer.stop(mock_producer)
+        self.assertEquals(mock_producer.join.call_count, 1)
+        self.assertEquals(mock_producer.epoll.close.call_count, 1)
 
 class ConnectionTests(unittest.TestCase):
     def test_constructor(self):
@@ -626,14 +1073,42 @@ class ConnectionTests(unittest.TestCase):
         mock_conn.producer = mock.Mock()
         mock_conn.consumer = mock.Mock()
         mock_conn.locks = mock.Mock()
+        mock_conn.workers = [mock.Mock()]
         connection.Connection.__del__(mock_conn)
+        self.assertEquals(mock_conn.workers[0].set.call_count, 1)
+        self.assertEquals(mock_conn.workers[0].stop.call_count, 1)
         self.assertEquals(mock_conn.producer.set.call_count, 1)
         self.assertEquals(mock_conn.producer.stop.call_count, 1)
-        self.assertEquals(mock_conn.consumer.set.call_count, 1)
+        mock_conn.consumer.set.assert_called_once_with({})
         self.assertEquals(mock_conn.consumer.stop.call_count, 1)
 
+    def test_dropped_serves_waiting(self):
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.waiting = { FAKE_PORT : collections.deque([mock_accept]) }
+        mock_consumer.ready = set()
+        mock_consumer.handle.return_value = True
+        mock_consumer.locks_changed.side_effect = \
+            lambda: connection.ConnectionConsumer.locks_changed(mock_consumer)
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn.consumer = mock_consumer
+        hook = lambda: connection.Connection._locks_changed(mock_conn)
+        mock_zkobj = mock.Mock()
+        mock_zkobj._list_children.return_value = [FAKE_BACKEND_IP]
+        mock_conn.locks = connection.LockCache(mock_zkobj, update=hook)
+
+        # The lock is released here, so no watch will fire.
+        connection.Connection.dropped(mock_conn, FAKE_BACKEND_IP)
+        mock_zkobj.remove.assert_called_once_with(FAKE_BACKEND_IP)
+        self.assertEquals(mock_consumer._notify.call_count, 1)
+        self.assertEquals(connection.ConnectionConsumer.serve(mock_consumer), 1)
+        mock_consumer.handle.assert_called_once_with(mock_accept)
+        self.assertEquals(mock_consumer.waiting, {})
+
     def test_change_no_ips(self):
         mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn._cond = mock.Mock()
         mock_conn.portmap = {}
         mock_conn.url_info.return_value = FAKE_PORT
         connection.Connection.change(mock_conn, FAKE_URL, [])
@@ -641,8 +1116,9 @@ class ConnectionTests(unittest.TestCase):
 
     def test_change_remove_ip(self):
         mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn._cond = mock.Mock()
         mock_conn.url_info.return_value = FAKE_PORT
-        mock_conn.portmap = { FAKE_PORT : (FAKE_URL, True, None, FAKE_RECONNECT, [(FAKE_BACKEND_IP, FAKE_BACKEND_PORT)], []) }
+        mock_conn.portmap = { FAKE_PORT : (FAKE_URL, True, None, FAKE_RECONNECT, [(FAKE_BACKEND_IP, FAKE_BACKEND_PORT)], [], FAKE_BALANCER) }
         connection.Connection.change(mock_conn, FAKE_URL, [])
         self.assertEquals(mock_conn.portmap, {})
 
@@ -650,22 +1126,94 @@ class ConnectionTests(unittest.TestCase):
         mock_backend = mock.Mock()
         mock_backend.ip = FAKE_BACKEND_IP
         mock_backend.port = FAKE_BACKEND_PORT
+        mock_backend.weight = 2
         mock_config = mock.Mock()
         mock_config.exclusive = True
         mock_config.disposable = False
         mock_config.reconnect = FAKE_RECONNECT
         mock_config.client_subnets = []
+        mock_config.balance = "leastconn"
         mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn._cond = mock.Mock()
         mock_conn.portmap = {}
         mock_conn.url_info.return_value = FAKE_PORT
         mock_conn._endpoint_config.return_value = mock_config
         connection.Connection.change(mock_conn, FAKE_URL, [mock_backend])
         self.assertIn(FAKE_PORT, mock_conn.portmap)
-        self.assertEquals(mock_conn.portmap[FAKE_PORT], (FAKE_URL, True, None, FAKE_RECONNECT, [(FAKE_BACKEND_IP, FAKE_BACKEND_PORT)], []))
+        self.assertEquals(mock_conn.portmap[FAKE_PORT][:6], (FAKE_URL, True, None, FAKE_RECONNECT, [(FAKE_BACKEND_IP, FAKE_BACKEND_PORT)], []))
+        balancer = mock_conn.portmap[FAKE_PORT][6]
+        self.assertIsInstance(balancer, balance.LeastConnBalancer)
+        self.assertEquals(balancer.backends, [FAKE_BACKEND])
+        self.assertEquals(balancer.weights, [2.0])
 
-    def test_save(self):
-        # No logic in save.
-        pass
+    def test_change_keeps_balancer(self):
+        mock_backend = mock.Mock()
+        mock_backend.ip = FAKE_BACKEND_IP
+        mock_backend.port = FAKE_BACKEND_PORT
+        mock_backend.weight = 3
+        mock_config = mock.Mock()
+        mock_config.exclusive = False
+        mock_config.disposable = False
+        mock_config.reconnect = 0
+        mock_config.client_subnets = []
+        mock_config.balance = "roundrobin"
+        balancer = balance.create("roundrobin", [FAKE_BACKEND])
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn._cond = mock.Mock()
+        mock_conn.portmap = { FAKE_PORT : (FAKE_URL, False, None, 0, [FAKE_BACKEND], [], balancer) }
+        mock_conn.url_info.return_value = FAKE_PORT
+        mock_conn._endpoint_config.return_value = mock_config
+
+        # The same algorithm updates the existing balancer.
+        connection.Connection.change(mock_conn, FAKE_URL, [mock_backend])
+        self.assertIs(mock_conn.portmap[FAKE_PORT][6], balancer)
+        self.assertEquals(balancer.weights, [3.0])
+
+        # A different one replaces it.
+        mock_config.balance = "hash"
+        connection.Connection.change(mock_conn, FAKE_URL, [mock_backend])
+        self.assertIsInstance(mock_conn.portmap[FAKE_PORT][6], balance.HashBalancer)
+
+    def test_render(self):
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn.portmap = { FAKE_PORT : (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], [], FAKE_BALANCER) }
+        output = connection.Connection._render(mock_conn)
+
+        # New (but equivalent) balancers don't change the output.
+        mock_conn.portmap[FAKE_PORT] = mock_conn.portmap[FAKE_PORT][:6] + \
+            (balance.create("random", [FAKE_BACKEND]),)
+        self.assertEquals(connection.Connection._render(mock_conn), output)
+        mock_conn.portmap[FAKE_PORT] = mock_conn.portmap[FAKE_PORT][:6] + \
+            (balance.create("leastconn", [FAKE_BACKEND]),)
+        self.assertNotEquals(connection.Connection._render(mock_conn), output)
+
+    def test_commit(self):
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn.portmap = { FAKE_PORT : (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], [], FAKE_BALANCER) }
+        mock_conn.consumer = mock.Mock()
+        mock_conn.producer = mock.Mock()
+        mock_conn.workers = [mock.Mock()]
+        connection.Connection._commit(mock_conn, "")
+        mock_conn.consumer.set.assert_called_once_with(mock_conn.portmap)
+        mock_conn.producer.set.assert_called_once_with([FAKE_PORT])
+        mock_conn.workers[0].set.assert_called_once_with([FAKE_PORT])
+
+    def test_collect_metrics(self):
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn.portmap = { FAKE_PORT : (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], [], FAKE_BALANCER) }
+        mock_conn.consumer = mock.Mock()
+        mock_conn.consumer.metrics.return_value = {}
+        mock_conn.producer = mock.Mock()
+        mock_conn.producer.stats.return_value = { FAKE_PORT : (4, 1, 3) }
+        mock_conn.workers = [mock.Mock()]
+        mock_conn.workers[0].stats.return_value = { FAKE_PORT : (2, 1, None) }
+        mock_conn.last_metrics = time.time()
+        metrics = connection.Connection._collect_metrics(mock_conn)
+        self.assertEquals(metrics, { "%s:%d" % FAKE_BACKEND : [{
+            "accepts" : (1, 6.0),
+            "accept_errors" : (1, 2.0),
+            "accept_queue" : (1, 3.0),
+        }] })
 
     def test_handle_no_subnet(self):
         mock_accept = mock.Mock(spec=connection.Accept)
@@ -673,17 +1221,24 @@ class ConnectionTests(unittest.TestCase):
         mock_accept.src = FAKE_CLIENT_SOCKNAME
         mock_accept.dst = FAKE_SOCKNAME
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
         mock_consumer._cond = mock.Mock()
         mock_consumer.locks = mock.Mock()
         mock_consumer.locks.find.return_value = [FAKE_BACKEND_ID]
         mock_consumer.error_notify = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], [])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], [], FAKE_BALANCER)
         mock_consumer.children = {}
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertTrue(handled)
-        self.assertEquals(mock_accept.redirect.call_count, 1)
+        self.assertEquals(mock_consumer.engine.redirect.call_count, 1)
         self.assertEquals(mock_accept.drop.call_count, 0)
 
     def test_handle_in_single_subnet(self):
@@ -692,17 +1247,24 @@ class ConnectionTests(unittest.TestCase):
         mock_accept.src = FAKE_CLIENT_SOCKNAME
         mock_accept.dst = FAKE_SOCKNAME
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
         mock_consumer._cond = mock.Mock()
         mock_consumer.locks = mock.Mock()
         mock_consumer.locks.find.return_value = ["%s:%d" % (FAKE_BACKEND_IP, FAKE_PORT)]
         mock_consumer.error_notify = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], ["%s/32" % FAKE_CLIENT_IP])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], ["%s/32" % FAKE_CLIENT_IP], FAKE_BALANCER)
         mock_consumer.children = {}
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertTrue(handled)
-        self.assertEquals(mock_accept.redirect.call_count, 1)
+        self.assertEquals(mock_consumer.engine.redirect.call_count, 1)
         self.assertEquals(mock_accept.drop.call_count, 0)
 
     def test_handle_in_multi_subnet(self):
@@ -711,17 +1273,24 @@ class ConnectionTests(unittest.TestCase):
         mock_accept.src = FAKE_CLIENT_SOCKNAME
         mock_accept.dst = FAKE_SOCKNAME
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
         mock_consumer._cond = mock.Mock()
         mock_consumer.locks = mock.Mock()
         mock_consumer.locks.find.return_value = ["%s:%d" % (FAKE_BACKEND_IP, FAKE_PORT)]
         mock_consumer.error_notify = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], ["1.2.3.4/24", "%s/32" % FAKE_CLIENT_IP])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], ["1.2.3.4/24", "%s/32" % FAKE_CLIENT_IP], FAKE_BALANCER)
         mock_consumer.children = {}
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertTrue(handled)
-        self.assertEquals(mock_accept.redirect.call_count, 1)
+        self.assertEquals(mock_consumer.engine.redirect.call_count, 1)
         self.assertEquals(mock_accept.drop.call_count, 0)
 
     def test_handle_not_in_single_subnet(self):
@@ -730,14 +1299,21 @@ class ConnectionTests(unittest.TestCase):
         mock_accept.src = FAKE_CLIENT_SOCKNAME
         mock_accept.dst = FAKE_SOCKNAME
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
         mock_consumer._cond = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], ["1.2.3.4/24"])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], ["1.2.3.4/24"], FAKE_BALANCER)
         mock_consumer.children = {}
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertTrue(handled)
-        self.assertEquals(mock_accept.redirect.call_count, 0)
+        self.assertEquals(mock_consumer.engine.redirect.call_count, 0)
         self.assertEquals(mock_accept.drop.call_count, 1)
 
     def test_handle_not_in_multi_subnet(self):
@@ -746,14 +1322,21 @@ class ConnectionTests(unittest.TestCase):
         mock_accept.src = FAKE_CLIENT_SOCKNAME
         mock_accept.dst = FAKE_SOCKNAME
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
         mock_consumer._cond = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], ["1.2.3.4/24", "5.6.7.8/16"])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, None, FAKE_RECONNECT, [FAKE_BACKEND], ["1.2.3.4/24", "5.6.7.8/16"], FAKE_BALANCER)
         mock_consumer.children = {}
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertTrue(handled)
-        self.assertEquals(mock_accept.redirect.call_count, 0)
+        self.assertEquals(mock_consumer.engine.redirect.call_count, 0)
         self.assertEquals(mock_accept.drop.call_count, 1)
 
     def test_handle_unexclusive_no_hosts(self):
@@ -762,13 +1345,20 @@ class ConnectionTests(unittest.TestCase):
         mock_accept.src = FAKE_CLIENT_SOCKNAME
         mock_accept.dst = FAKE_SOCKNAME
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer.engine = mock.Mock()
         mock_consumer._cond = mock.Mock()
         mock_consumer.portmap = {}
         mock_consumer.children = {}
+        mock_consumer.active = {}
+        mock_consumer.started = {}
+        mock_consumer.accounting = {}
+        mock_consumer.counts = {}
+        mock_consumer.clients = {}
+        mock_consumer.changed = set()
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertTrue(handled)
-        self.assertEquals(mock_accept.redirect.call_count, 0)
+        self.assertEquals(mock_consumer.engine.redirect.call_count, 0)
         self.assertEquals(mock_accept.drop.call_count, 1)
 
     def test_sessions(self):
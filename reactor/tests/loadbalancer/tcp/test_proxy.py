@@ -0,0 +1,232 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+import mock
+import os
+import socket
+import select
+import threading
+
+import reactor.loadbalancer.tcp.proxy as proxy
+
+FAKE_DATA = "reactor" * 150000
+
+class FakeConnection(object):
+    def __init__(self, sock):
+        self.fd = os.dup(sock.fileno())
+        sock.close()
+
+def _listen():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(10)
+    return sock
+
+def _echo_server():
+    server = _listen()
+    def fn():
+        (conn, _) = server.accept()
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+        server.close()
+    t = threading.Thread(target=fn)
+    t.daemon = True
+    t.start()
+    return server.getsockname()[1]
+
+def _echo_server6():
+    # As above, but on the IPv6 loopback (or None if there is none).
+    try:
+        server = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        server.bind(("::1", 0))
+    except socket.error:
+        return None
+    server.listen(10)
+    def fn():
+        (conn, _) = server.accept()
+        conn.sendall(conn.recv(65536))
+        conn.close()
+        server.close()
+    t = threading.Thread(target=fn)
+    t.daemon = True
+    t.start()
+    return server.getsockname()[1]
+
+def _client():
+    # Returns a connected (client, accepted connection) pair.
+    listener = _listen()
+    client = socket.create_connection(listener.getsockname())
+    (accepted, _) = listener.accept()
+    listener.close()
+    return (client, FakeConnection(accepted))
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        chunks.append(data)
+    return "".join(chunks)
+
+class Exits(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.exits = []
+    def __call__(self, sid, error):
+        self.exits.append((sid, error))
+        self.event.set()
+
+class ProxyEngineTests(unittest.TestCase):
+
+    use_splice = True
+
+    def setUp(self):
+        self.engine = proxy.ProxyEngine(use_splice=self.use_splice)
+
+    def tearDown(self):
+        self.engine.stop()
+
+    def test_relay(self):
+        port = _echo_server()
+        (client, conn) = _client()
+        exits = Exits()
+        sid = self.engine.redirect(conn, "127.0.0.1", port, exits)
+        self.assertIsNotNone(sid)
+        self.assertIsNone(conn.fd)
+
+        # Send everything, then read back the echo.
+        sender = threading.Thread(target=lambda: (
+            client.sendall(FAKE_DATA), client.shutdown(socket.SHUT_WR)))
+        sender.start()
+        self.assertEquals(_recv_all(client), FAKE_DATA)
+        sender.join()
+        client.close()
+
+        exits.event.wait(5.0)
+        self.assertEquals(exits.exits, [(sid, False)])
+        self.assertEquals(self.engine.sessions, {})
+        self.assertEquals(self.engine.fdmap, {})
+
+    def test_stats(self):
+        port = _echo_server()
+        (client, conn) = _client()
+        exits = Exits()
+        sid = self.engine.redirect(conn, "127.0.0.1", port, exits)
+        client.sendall("hello")
+        self.assertEquals(client.recv(5), "hello")
+        self.assertEquals(self.engine.stats(sid), (5, 5))
+        client.close()
+        exits.event.wait(5.0)
+        self.assertIsNone(self.engine.stats(sid))
+
+    def test_traffic(self):
+        port = _echo_server()
+        (client, conn) = _client()
+        exits = Exits()
+        self.engine.redirect(conn, "127.0.0.1", port, exits)
+        client.sendall("hello")
+        self.assertEquals(client.recv(5), "hello")
+        self.assertEquals(self.engine.traffic(), { ("127.0.0.1", port) : (5, 5) })
+        self.assertEquals(self.engine.traffic(), { ("127.0.0.1", port) : (0, 0) })
+        client.close()
+        exits.event.wait(5.0)
+        # Reported once more after the last session, then dropped.
+        self.engine.traffic()
+        self.assertEquals(self.engine.traffic(), {})
+
+    def test_refused(self):
+        unused = _listen()
+        port = unused.getsockname()[1]
+        unused.close()
+        (client, conn) = _client()
+        exits = Exits()
+        sid = self.engine.redirect(conn, "127.0.0.1", port, exits)
+        if sid is not None:
+            exits.event.wait(5.0)
+            self.assertEquals(exits.exits, [(sid, True)])
+        self.assertEquals(_recv_all(client), "")
+
+    def test_bad_host(self):
+        (client, conn) = _client()
+        fd = conn.fd
+        exits = Exits()
+        self.assertIsNone(self.engine.redirect(conn, "no-such-host.invalid", 80, exits))
+
+        # The client is left alone.
+        self.assertEquals(conn.fd, fd)
+        self.assertEquals(self.engine.sessions, {})
+        client.close()
+
+    def test_ipv6(self):
+        port = _echo_server6()
+        if port is None:
+            # Not available here.
+            return
+        (client, conn) = _client()
+        exits = Exits()
+        sid = self.engine.redirect(conn, "::1", port, exits)
+        self.assertIsNotNone(sid)
+        client.sendall("reactor")
+        client.shutdown(socket.SHUT_WR)
+        self.assertEquals(_recv_all(client), "reactor")
+        exits.event.wait(5.0)
+        self.assertEquals(exits.exits, [(sid, False)])
+
+    def test_kill(self):
+        port = _echo_server()
+        (client, conn) = _client()
+        exits = Exits()
+        sid = self.engine.redirect(conn, "127.0.0.1", port, exits)
+        self.engine.kill(sid)
+        self.assertEquals(exits.exits, [(sid, False)])
+        self.assertEquals(_recv_all(client), "")
+        self.engine.kill(sid)
+        self.assertEquals(len(exits.exits), 1)
+
+class BufferProxyEngineTests(ProxyEngineTests):
+
+    use_splice = False
+
+class ProxyEventTests(unittest.TestCase):
+
+    def _process(self, fd, event):
+        # Returns the error reported for a session still connecting.
+        mock_session = mock.Mock(spec=proxy.ProxySession)
+        mock_session.connected = False
+        mock_session.error = False
+        mock_session.client = mock.Mock()
+        mock_session.client.fileno.return_value = 10
+        mock_session.backend = mock.Mock()
+        mock_session.backend.fileno.return_value = 11
+        mock_engine = mock.Mock(spec=proxy.ProxyEngine)
+        mock_engine._cond = mock.Mock()
+        mock_engine.fdmap = { 10 : mock_session, 11 : mock_session }
+        mock_engine._close.side_effect = lambda session: session.error
+        return proxy.ProxyEngine._process(mock_engine, [(fd, event)])
+
+    def test_backend_failed(self):
+        self.assertEquals(self._process(11, select.EPOLLERR), [True])
+        self.assertEquals(self._process(11, select.EPOLLHUP), [True])
+
+    def test_client_hangup_connecting(self):
+        # The client went away, but the backend did nothing wrong.
+        self.assertEquals(self._process(10, select.EPOLLHUP), [False])
+        self.assertEquals(self._process(10, select.EPOLLERR | select.EPOLLHUP), [False])
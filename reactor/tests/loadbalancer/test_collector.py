@@ -0,0 +1,157 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import gc
+import time
+import threading
+import unittest
+
+from reactor.loadbalancer.collector import MetricsCollector
+
+class FakeSource(object):
+
+    def __init__(self, samples):
+        self.samples = list(samples)
+        self.called = threading.Event()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def collect(self):
+        # Hold off once all samples are used up.
+        self.entered.set()
+        self.release.wait()
+        try:
+            if not self.samples:
+                return {}
+            sample = self.samples.pop(0)
+            if not self.samples:
+                self.release.clear()
+            if isinstance(sample, Exception):
+                raise sample
+            return sample
+        finally:
+            self.called.set()
+
+def _wait(source, count=1):
+    for _ in range(count):
+        source.called.wait(5.0)
+        source.called.clear()
+    # Let the sample be handed over.
+    time.sleep(0.05)
+
+class MetricsCollectorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = MetricsCollector("test")
+
+    def tearDown(self):
+        self.collector.stop()
+
+    def test_metrics(self):
+        first = FakeSource([{ "a:80" : [{ "active" : (1, 2) }] }])
+        second = FakeSource([{ "a:80" : [{ "rate" : (1, 3.0) }],
+                               "b:80" : [{ "active" : (1, 0) }] }])
+
+        # The first sample is taken when the source is registered.
+        self.collector.register("first", first.collect)
+        self.collector.register("second", second.collect)
+        _wait(first)
+        _wait(second)
+        self.assertEquals(self.collector.metrics(), {
+            "a:80" : [{ "active" : (1, 2) }, { "rate" : (1, 3.0) }],
+            "b:80" : [{ "active" : (1, 0) }],
+        })
+
+    def test_one_sample_per_call(self):
+        source = FakeSource([
+            { "a:80" : [{ "rate" : (1, 1.0) }] },
+            { "a:80" : [{ "rate" : (1, 2.0) }] }])
+        self.collector.register("counters", source.collect)
+        _wait(source)
+
+        # The source isn't sampled again until it is asked, and
+        # samples aren't repeated (they may be reset counters).
+        self.assertEquals(source.samples, [{ "a:80" : [{ "rate" : (1, 2.0) }] }])
+        source.release.clear()
+        self.assertEquals(self.collector.metrics(),
+            { "a:80" : [{ "rate" : (1, 1.0) }] })
+        self.assertEquals(self.collector.metrics(), {})
+        source.release.set()
+        _wait(source)
+        self.assertEquals(self.collector.metrics(),
+            { "a:80" : [{ "rate" : (1, 2.0) }] })
+
+    def test_slow_source(self):
+        source = FakeSource([
+            { "a:80" : [{ "active" : (1, 1) }] },
+            { "a:80" : [{ "active" : (1, 2) }] }])
+        source.release.clear()
+        self.collector.register("slow", source.collect)
+
+        # Asking while a sample is being taken queues one more.
+        source.entered.wait(5.0)
+        start = time.time()
+        self.assertEquals(self.collector.metrics(), {})
+        self.assertEquals(self.collector.metrics(), {})
+        self.assertTrue(time.time() - start < 1.0)
+
+        source.release.set()
+        _wait(source, 2)
+        self.assertEquals(self.collector.metrics(), {
+            "a:80" : [{ "active" : (1, 1) }, { "active" : (1, 2) }] })
+        self.assertEquals(source.samples, [])
+
+    def test_direct(self):
+        source = FakeSource([
+            { "a:80" : [{ "active" : (1, 1) }] },
+            Exception("failed"),
+            { "a:80" : [{ "active" : (1, 2) }] }])
+        registered = self.collector.register("direct", source.collect,
+            background=False)
+
+        # Read on each call (without a thread).
+        self.assertEquals(registered.thread, None)
+        self.assertEquals(self.collector.metrics(), { "a:80" : [{ "active" : (1, 1) }] })
+        self.assertEquals(self.collector.metrics(), {})
+        self.assertEquals(self.collector.metrics(), { "a:80" : [{ "active" : (1, 2) }] })
+
+    def test_error(self):
+        source = FakeSource([Exception("failed"), { "a:80" : [{ "active" : (1, 1) }] }])
+        self.collector.register("error", source.collect)
+        _wait(source)
+        self.assertEquals(self.collector.metrics(), {})
+        _wait(source)
+        self.assertEquals(self.collector.metrics(), { "a:80" : [{ "active" : (1, 1) }] })
+
+    def test_stop(self):
+        source = FakeSource([])
+        registered = self.collector.register("stopped", source.collect)
+        _wait(source)
+        self.collector.stop()
+        registered.thread.join(5.0)
+        self.assertFalse(registered.thread.isAlive())
+
+    def test_released(self):
+        source = FakeSource([])
+        registered = self.collector.register("gone", source.collect)
+        _wait(source)
+
+        # The source doesn't keep its object alive.
+        del source
+        gc.collect()
+        registered.trigger.set()
+        registered.thread.join(5.0)
+        self.assertFalse(registered.thread.isAlive())
@@ -0,0 +1,99 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+import threading
+import unittest
+
+from reactor.loadbalancer.connection import LoadBalancerConnection
+
+class FakeConnection(LoadBalancerConnection):
+
+    _SAVE_DELAY = 0.0
+
+    def __init__(self):
+        super(FakeConnection, self).__init__(name="fake")
+        self.output = ""
+        self.commits = []
+        self.committed = threading.Event()
+
+    def _render(self):
+        return self.output
+
+    def _commit(self, output):
+        self.commits.append(output)
+        self.committed.set()
+
+class DelayedConnection(FakeConnection):
+
+    _SAVE_DELAY = 0.1
+
+class LoadBalancerConnectionTests(unittest.TestCase):
+
+    def test_save_unchanged(self):
+        conn = FakeConnection()
+        conn.output = "a"
+        conn.save()
+        conn.save()
+        conn.output = "b"
+        conn.save()
+        self.assertEquals(conn.commits, ["a", "b"])
+        (reloads, unchanged, coalesced, reload_time) = conn.reload_stats()
+        self.assertEquals((reloads, unchanged, coalesced), (2, 1, 0))
+        self.assertTrue(reload_time >= 0.0)
+
+    def test_save_coalesced(self):
+        conn = DelayedConnection()
+        for output in ("a", "b", "c"):
+            conn.output = output
+            conn.save()
+        self.assertEquals(conn.commits, [])
+        conn.committed.wait(5.0)
+        self.assertEquals(conn.commits, ["c"])
+        self.assertEquals(conn.reload_stats()[:3], (1, 0, 2))
+
+        # Saves after the flush need another one.
+        conn.committed.clear()
+        conn.output = "d"
+        conn.save()
+        conn.committed.wait(5.0)
+        self.assertEquals(conn.commits, ["c", "d"])
+
+    def test_save_error(self):
+        conn = DelayedConnection()
+        conn.output = "a"
+        def fail(output):
+            conn.committed.set()
+            raise Exception("failed")
+        conn._commit = fail
+        conn.save()
+        conn.committed.wait(5.0)
+        time.sleep(0.1)
+        self.assertEquals(conn.reload_stats()[0], 0)
+        self.assertIsNone(conn._save_timer)
+
+    def test_metrics_stopped(self):
+        conn = FakeConnection()
+        collected = threading.Event()
+        def collect():
+            collected.set()
+            return {}
+        source = conn.collector.register("fake", collect)
+        collected.wait(5.0)
+
+        # Sampling stops with the connection.
+        conn.__del__()
+        source.thread.join(5.0)
+        self.assertFalse(source.thread.isAlive())
@@ -0,0 +1,201 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import time
+import errno
+import shutil
+import socket
+import struct
+import logging
+import tempfile
+import unittest
+import mock
+
+from reactor.loadbalancer import netstat
+
+PROC_HEADER = "  sl  local_address rem_address   st tx_queue rx_queue " + \
+              "tr tm->when retrnsmt   uid  timeout inode\n"
+
+def _proc_address(ip, port, v6=False):
+    packed = socket.inet_aton(ip)
+    if v6:
+        packed = netstat.V4_MAPPED + packed
+    words = struct.unpack("=%dI" % (len(packed) / 4), packed)
+    return "".join(["%08X" % word for word in words]) + ":%04X" % port
+
+def _proc_line(index, local, remote, state, v6=False):
+    return "%4d: %s %s %02X 00000000:00000000 00:00000000 00000000  1000 " \
+           "0 %d 1 0000000000000000 20 4 30 10 -1\n" % \
+           (index, _proc_address(local[0], local[1], v6),
+            _proc_address(remote[0], remote[1], v6), state, 10000 + index)
+
+def _sockets(count):
+    # Connections from local ports to 256 backends, with every tenth
+    # one over IPv6 and every hundredth one listening.
+    sockets = []
+    for index in range(count):
+        local = ("10.1.0.1", 1024 + index % 60000)
+        remote = ("10.2.%d.%d" % (index % 16, index % 251), 8000 + index % 16)
+        if index % 100 == 0:
+            state = netstat.TCP_LISTEN
+            remote = ("0.0.0.0", 0)
+        else:
+            state = 1
+        sockets.append((local, remote, state, index % 10 == 0))
+    return sockets
+
+def _write_proc(path, sockets):
+    tcp = open(os.path.join(path, "tcp"), "w")
+    tcp6 = open(os.path.join(path, "tcp6"), "w")
+    tcp.write(PROC_HEADER)
+    tcp6.write(PROC_HEADER)
+    for (index, (local, remote, state, v6)) in enumerate(sockets):
+        if v6:
+            tcp6.write(_proc_line(index, local, remote, state, v6=True))
+        else:
+            tcp.write(_proc_line(index, local, remote, state))
+    tcp.close()
+    tcp6.close()
+    return [os.path.join(path, "tcp"), os.path.join(path, "tcp6")]
+
+def _netstat_output(sockets):
+    # What "netstat -tn" would print for the same sockets.
+    lines = ["Active Internet connections (w/o servers)",
+             "Proto Recv-Q Send-Q Local Address           Foreign Address         State"]
+    for (local, remote, state, _) in sockets:
+        if state != netstat.TCP_LISTEN:
+            lines.append("tcp        0      0 %s:%d %s:%d ESTABLISHED" % \
+                (local[0], local[1], remote[0], remote[1]))
+    return "\n".join(lines) + "\n"
+
+def _netstat_count(stdout):
+    # The old parsing of the netstat output.
+    active_count = {}
+    for line in stdout.split("\n")[2:]:
+        try:
+            (_, _, _, _, foreign, _) = line.split()
+            (host, port) = foreign.split(":")
+            active_count[(host, int(port))] = \
+                active_count.get((host, int(port)), 0) + 1
+        except Exception:
+            pass
+    return active_count
+
+class NetstatTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_proc_count(self):
+        paths = _write_proc(self.path, [
+            (("10.1.0.1", 1024), ("10.2.0.1", 80), 1, False),
+            (("10.1.0.1", 1025), ("10.2.0.1", 80), 6, True),
+            (("10.1.0.1", 1026), ("10.2.0.2", 80), 1, False),
+            (("10.1.0.1", 80), ("0.0.0.0", 0), netstat.TCP_LISTEN, False),
+        ])
+        active = {}
+        netstat._proc_count([("10.2.0.1", 80), ("10.2.0.3", 80)], active, paths)
+        self.assertEquals(active, { ("10.2.0.1", 80) : 2 })
+
+        active = {}
+        netstat._proc_count(None, active, paths)
+        self.assertEquals(active, { ("10.2.0.1", 80) : 2, ("10.2.0.2", 80) : 1 })
+
+    def test_names_skipped(self):
+        paths = _write_proc(self.path, [
+            (("10.1.0.1", 1024), ("10.2.0.1", 80), 1, False),
+            (("10.1.0.1", 1025), ("10.2.0.2", 80), 1, False),
+        ])
+        active = {}
+        netstat._proc_count([("backend.example.com", 80), ("10.2.0.1", 80)], active, paths)
+        self.assertEquals(active, { ("10.2.0.1", 80) : 1 })
+
+        # With only names, nothing is counted (rather than everything).
+        active = {}
+        netstat._proc_count([("backend.example.com", 80)], active, paths)
+        self.assertEquals(active, {})
+        self.assertEquals(netstat._bytecode([("backend.example.com", 80)]), "")
+        with mock.patch("socket.socket") as mock_socket:
+            netstat._netlink_count([("backend.example.com", 80)], active)
+        self.assertFalse(mock_socket.called)
+
+    def _fallback(self, error):
+        # Returns True if sock_diag is still used after the error.
+        with mock.patch.object(netstat, "_use_netlink", True):
+            with mock.patch.object(netstat, "_netlink_count", side_effect=error):
+                with mock.patch.object(netstat, "_proc_count") as mock_proc:
+                    self.assertEquals(netstat.connection_count([("10.2.0.1", 80)]), {})
+                    self.assertTrue(mock_proc.called)
+                    return netstat._use_netlink
+
+    def test_netlink_fallback(self):
+        # Only errors saying sock_diag isn't there switch to /proc for good.
+        self.assertFalse(self._fallback(socket.error(errno.EPROTONOSUPPORT, "")))
+        self.assertFalse(self._fallback(socket.error(errno.ENOENT, "sock_diag failed")))
+        self.assertTrue(self._fallback(socket.timeout("timed out")))
+        self.assertTrue(self._fallback(socket.error(errno.ENOBUFS, "")))
+        self.assertTrue(self._fallback(ValueError()))
+
+    def test_netlink_count(self):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(5)
+        address = server.getsockname()
+        clients = [socket.create_connection(address) for _ in range(3)]
+        try:
+            active = {}
+            try:
+                netstat._netlink_count([("10.2.0.1", 80), address], active)
+            except socket.error:
+                # Not available here.
+                return
+            expected = {}
+            netstat._proc_count([("10.2.0.1", 80), address], expected)
+            self.assertEquals(active, expected)
+            self.assertEquals(active, { address : 3 })
+        finally:
+            for client in clients:
+                client.close()
+            server.close()
+
+    def test_proc_benchmark(self):
+        # Compare against parsing netstat output, at 100k sockets.
+        sockets = _sockets(100000)
+        paths = _write_proc(self.path, sockets)
+        stdout = _netstat_output(sockets)
+
+        start = time.time()
+        expected = _netstat_count(stdout)
+        netstat_time = time.time() - start
+
+        start = time.time()
+        active = {}
+        netstat._proc_count(expected.keys(), active, paths)
+        proc_time = time.time() - start
+
+        start = time.time()
+        unfiltered = {}
+        netstat._proc_count(None, unfiltered, paths)
+        unfiltered_time = time.time() - start
+
+        logging.info("Connection counts (%d sockets): netstat parsing %.3fs, "
+                     "/proc filtered %.3fs, /proc unfiltered %.3fs",
+                     len(sockets), netstat_time, proc_time, unfiltered_time)
+        self.assertEquals(active, expected)
+        self.assertEquals(unfiltered, expected)
@@ -1,6 +1,18 @@
+import sys
+import math
+import time
+import random
+import logging
 import pytest
 
 from reactor.metrics.calculator import EndpointCriteria
+from reactor.metrics.calculator import RuleSet
+from reactor.metrics.calculator import parse_criteria
+from reactor.metrics.calculator import calculate_weighted_averages
+from reactor.metrics.calculator import calculate_weighted_averages_batch
+from reactor.metrics.calculator import calculate_ideal_uniform
+from reactor.metrics.sketch import Histogram
+from reactor.metrics.sketch import merge_histograms
 
 def test_empty():
     x = EndpointCriteria("")
@@ -45,3 +57,167 @@ def test_both_equals():
 def test_both_less():
     x = EndpointCriteria("1.0 < foo < 2.0")
     assert str(x) == "foo => (1.0,2.0)"
+
+def test_percentile():
+    x = EndpointCriteria("p95( response ) < 300")
+    assert str(x) == "p95(response) => (None,300.0)"
+    assert (x.function, x.source, x.argument) == ("p95", "response", None)
+
+def test_ewma():
+    x = EndpointCriteria("ewma(rate, 60)<50")
+    assert str(x) == "ewma(rate,60) => (None,50.0)"
+    assert (x.function, x.source, x.argument) == ("ewma", "rate", 60.0)
+
+def test_validate_functions():
+    EndpointCriteria.validate("p95(response)<300")
+    EndpointCriteria.validate("ewma(rate,60)<50")
+    for bad in ["p0(response)<1", "p95(response,2)<1", "ewma(rate)<1", "max(rate)<1"]:
+        with pytest.raises(Exception):
+            EndpointCriteria.validate(bad)
+
+METRIC_NAMES = ["active", "rate", "response", "bytes", "pending"]
+
+def _random_rule(r):
+    metric = r.choice(METRIC_NAMES + ["instances"])
+    lower = r.choice([None, 0, 1, 2.5, 10])
+    upper = r.choice([None, 1, 5, 20, 100.0])
+    rule = metric
+    if lower is not None:
+        rule = "%s%s%s" % (lower, r.choice(["<", "<="]), rule)
+    if upper is not None:
+        rule = "%s%s%s" % (rule, r.choice(["<", "<="]), upper)
+    return rule
+
+def _random_metrics(r):
+    metrics = []
+    for _ in range(r.randint(0, 4)):
+        metric = {}
+        for name in r.sample(METRIC_NAMES, r.randint(1, len(METRIC_NAMES))):
+            metric[name] = r.choice([
+                (r.randint(0, 3), r.random() * 50),
+                [r.randint(0, 3), r.randint(0, 50)],
+                r.random() * 10,
+                { "hist" : { "10" : 1 } },
+                "bogus"])
+        metrics.append(metric)
+    return metrics
+
+def _random_endpoints(count, rule_count, seed=0):
+    r = random.Random(seed)
+    rules = [[_random_rule(r) for _ in range(rule_count)] + [""]
+             for _ in range(count)]
+    metrics = [_random_metrics(r) for _ in range(count)]
+    instances = [r.randint(0, 10) for _ in range(count)]
+    return (rules, metrics, instances)
+
+def test_weighted_averages_zero_weight():
+    assert calculate_weighted_averages([{ "active" : (0, 5) }]) == { "active" : 0.0 }
+    assert calculate_weighted_averages_batch([[{ "active" : (0, 5) }], []]) == \
+        [{ "active" : 0.0 }, {}]
+
+def test_weighted_averages_batch():
+    (_, metrics, _) = _random_endpoints(200, 0)
+    assert calculate_weighted_averages_batch(metrics) == \
+        map(calculate_weighted_averages, metrics)
+
+def test_weighted_averages_batch_parsing():
+    metrics = [[{ "a" : "12", "b" : "3.5", "c" : (1, "x"),
+                  "e" : ("2", "4"), "f" : (1, 2, 3), "g" : 7 }]]
+    assert calculate_weighted_averages_batch(metrics) == \
+        map(calculate_weighted_averages, metrics)
+
+def test_weighted_averages_batch_benchmark():
+    # Metrics are reported as (weight, value) pairs (lists, from JSON).
+    r = random.Random(0)
+    metrics = [[dict((name, [r.randint(1, 3), r.random() * 50])
+                     for name in METRIC_NAMES)
+                for _ in range(4)]
+               for _ in range(1000)]
+    start = time.time()
+    expected = map(calculate_weighted_averages, metrics)
+    single_time = time.time() - start
+
+    start = time.time()
+    results = calculate_weighted_averages_batch(metrics)
+    batch_time = time.time() - start
+
+    logging.info("Weighted averages (1000x4): single %.4fs, batch %.4fs",
+                 single_time, batch_time)
+    assert results == expected
+
+def test_parse_criteria_cached():
+    x = parse_criteria("1.0 < foo <= 2.0")
+    assert x is parse_criteria("1.0 < foo <= 2.0")
+    assert str(x) == "foo => (1.0,2.0]"
+    assert x is not parse_criteria("1.0<foo<=2.0")
+
+def test_rule_set():
+    x = RuleSet(["1.0 < foo <= 2.0", "", "instances<3"])
+    assert len(x) == 2
+    assert x.keys == ["foo", "instances"]
+    assert x.ideal({}, 0) == calculate_ideal_uniform(
+        ["1.0 < foo <= 2.0", "", "instances<3"], {}, 0)
+
+def test_rule_set_derive():
+    x = RuleSet(["p50(response)<10", "ewma(rate,60)<5", "active<1"])
+    sketches = merge_histograms([
+        { "response" : Histogram(buckets={ "10" : 3 }).dump() },
+        { "response" : Histogram(buckets={ "100" : 1 }).dump(), "rate" : (1, 2) }])
+    derived = x.derive({ "rate" : 10.0, "active" : 0.5 }, sketches=sketches)
+    assert derived["active"] == 0.5
+    assert derived["ewma(rate,60)"] == 10.0
+    assert abs(derived["p50(response)"] - Histogram._value("10")) < 1e-9
+    derived = x.derive({ "rate" : 0.0 }, elapsed=60)
+    assert abs(derived["ewma(rate,60)"] - 10.0 / math.e) < 1e-9
+    assert not "p50(response)" in derived
+
+def test_rule_set_percentile():
+    rules = ["p95(response)<300", "100<=p50(response)"]
+    x = RuleSet(rules)
+    maxint = sys.maxint
+
+    # Percentiles aren't scaled by the number of instances.
+    for (metrics, ideal) in [
+            ({ "p95(response)" : 400.0 }, (11, maxint)),
+            ({ "p95(response)" : 300.0 }, (11, maxint)),
+            ({ "p95(response)" : 200.0 }, (0, maxint)),
+            ({ "p95(response)" : 200.0, "p50(response)" : 50.0 }, (0, 9)),
+            ({ "p95(response)" : 200.0, "p50(response)" : 100.0 }, (0, maxint)),
+            ({}, (0, maxint))]:
+        assert x.ideal(metrics, 10) == ideal
+        assert calculate_ideal_uniform(rules, metrics, 10) == ideal
+    assert x.ideal({ "p50(response)" : 50.0 }, 0) == (0, 0)
+
+    # Moving averages are (as with all other averages).
+    assert RuleSet(["ewma(rate,60)<5"]).ideal({ "ewma(rate,60)" : 3.8 }, 10) == (8, maxint)
+
+def test_rule_set_ideal():
+    (rules, metrics, instances) = _random_endpoints(200, 5)
+    averages = map(calculate_weighted_averages, metrics)
+    expected = [calculate_ideal_uniform(r, a, n)
+                for (r, a, n) in zip(rules, averages, instances)]
+    assert [RuleSet(r).ideal(a, n)
+            for (r, a, n) in zip(rules, averages, instances)] == expected
+
+def test_rule_set_benchmark():
+    # Compare against parsing the rules each time, at 1k endpoints x 20 rules.
+    (rules, metrics, instances) = _random_endpoints(1000, 20)
+    averages = map(calculate_weighted_averages, metrics)
+    compiled = map(RuleSet, rules)
+    logging.disable(logging.DEBUG)
+    try:
+        start = time.time()
+        expected = [calculate_ideal_uniform(r, a, n)
+                    for (r, a, n) in zip(rules, averages, instances)]
+        uniform_time = time.time() - start
+
+        start = time.time()
+        results = [c.ideal(a, n)
+                   for (c, a, n) in zip(compiled, averages, instances)]
+        compiled_time = time.time() - start
+    finally:
+        logging.disable(logging.NOTSET)
+
+    logging.info("Ideal ranges (1000x20): uniform %.3fs, rule sets %.3fs",
+                 uniform_time, compiled_time)
+    assert results == expected
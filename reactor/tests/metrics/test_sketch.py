@@ -0,0 +1,70 @@
+import random
+
+from reactor.metrics.sketch import Histogram
+from reactor.metrics.sketch import EWMA
+from reactor.metrics.sketch import merge_histograms
+from reactor.metrics.sketch import split_histograms
+
+def test_histogram_empty():
+    assert Histogram().percentile(95) is None
+
+def test_histogram_percentile():
+    r = random.Random(0)
+    values = [r.expovariate(0.01) for _ in range(10000)]
+    hist = Histogram()
+    for value in values:
+        hist.add(value)
+    values.sort()
+    for p in [50, 90, 95, 99]:
+        exact = values[int(len(values) * p / 100.0) - 1]
+        assert abs(hist.percentile(p) - exact) <= exact * 2 * Histogram.PRECISION
+
+def test_histogram_zero():
+    hist = Histogram()
+    hist.add(0.0, count=3)
+    hist.add(5.0)
+    assert hist.percentile(50) == 0.0
+    assert hist.percentile(100) > 4.9
+
+def test_histogram_merge():
+    a = Histogram()
+    b = Histogram()
+    for value in range(1, 51):
+        a.add(value)
+    for value in range(51, 101):
+        b.add(value)
+    merged = merge_histograms([
+        { "response" : a.dump(), "rate" : (1, 1.0) },
+        { "response" : b.dump() },
+        { "response" : { "bogus" : 1 } }])
+    assert merged.keys() == ["response"]
+    assert merged["response"].count == 100
+    assert abs(merged["response"].percentile(75) - 75) < 1.5
+
+def test_split_histograms():
+    a = Histogram()
+    a.add(10.0)
+    b = Histogram()
+    b.add(20.0)
+    rate = { "rate" : (1, 1.0) }
+    (metrics, sketches) = split_histograms([
+        rate,
+        { "response" : a.dump() },
+        { "response" : b.dump(), "active" : (1, 2.0) }])
+    assert metrics == [rate, { "active" : (1, 2.0) }]
+    assert metrics[0] is rate
+    assert sketches.keys() == ["response"]
+    assert sketches["response"].count == 2
+
+def test_histogram_load():
+    a = Histogram()
+    a.add(12.0)
+    b = Histogram.load(a.dump())
+    assert b.buckets == a.buckets
+    assert Histogram.load({ "hist" : "bogus" }) is None
+
+def test_ewma():
+    x = EWMA(60)
+    assert x.update(10.0) == 10.0
+    assert x.update(0.0) == 10.0
+    assert x.update(20.0, elapsed=1e9) == 20.0
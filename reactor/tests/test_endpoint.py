@@ -14,8 +14,12 @@
 #    under the License.
 
 import uuid
+import time
+
+import mock
 
 from reactor.endpoint import State
+from reactor.cloud.instance import Instance
 
 def test_key(endpoint):
     assert endpoint.key()
@@ -82,3 +86,55 @@ def test_backends(endpoint):
 
 def test_reload(endpoint):
     pass
+
+def test_warm_target(endpoint):
+    instances = ["a", "b", "c", "d"]
+    endpoint.scaling.max_instances = 10
+    assert endpoint._warm_target(instances, ["a"], {}, 1) == 0
+    endpoint.scaling.warm_pool = 2
+    assert endpoint._warm_target(instances, [], {}, 0) == 2
+    assert endpoint._warm_target(instances, ["a", "b", "e"], {}, 2) == 4
+    assert endpoint._warm_target(instances, ["a"], { "pending" : 1.5 }, 2) == 6
+    endpoint.scaling.max_instances = 3
+    assert endpoint._warm_target(instances, ["a", "b"], {}, 2) == 3
+
+def test_scale_down_candidates(endpoint):
+    now = time.time()
+    cloud_instances = [
+        Instance("a", "a", ["10.0.0.1"], created=now - 3500),
+        Instance("b", "b", ["10.0.0.2"], created=now - 600),
+        Instance("c", "c", ["10.0.0.3"], created=now - 7000),
+        Instance("d", "d", ["10.0.0.4"]),
+    ]
+    instances = ["a", "b", "c", "d"]
+    active_ids = ["a", "b", "c"]
+    inactive_ids = ["d"]
+
+    def candidates(policy, port_metrics=None):
+        endpoint.scaling.scale_down = policy
+        return endpoint._scale_down_candidates(
+            cloud_instances, instances, active_ids, inactive_ids, port_metrics)
+
+    assert sorted(candidates("inactive")[1:]) == ["a", "b", "c"]
+    assert candidates("inactive")[0] == "d"
+    assert candidates("oldest") == ["d", "c", "a", "b"]
+    assert candidates("youngest") == ["d", "b", "a", "c"]
+    assert candidates("billing") == ["d", "a", "c", "b"]
+
+    ips = { "a" : ["10.0.0.1"], "b" : ["10.0.0.2"], "c" : ["10.0.0.3"], "d" : ["10.0.0.4"] }
+    with mock.patch.object(endpoint, "instance_ips") as instance_ips:
+        instance_ips.get.side_effect = ips.get
+        port_metrics = {
+            "10.0.0.1:80" : [{ "active" : (1, 5) }],
+            "10.0.0.2:80" : [{ "active" : (1, 1) }],
+            "10.0.0.3:80" : [{ "active" : (1, 3) }, { "active" : (1, 1) }],
+        }
+        assert candidates("load", port_metrics) == ["d", "b", "c", "a"]
+
+        with mock.patch.object(endpoint.zkobj, "sessions") as sessions:
+            sessions.return_value.active_map.return_value = {
+                "1.2.3.4" : "10.0.0.1:80",
+                "1.2.3.5" : "10.0.0.1:80",
+                "1.2.3.6" : "10.0.0.3:80",
+            }
+            assert candidates("sessions") == ["d", "b", "c", "a"]
@@ -0,0 +1,91 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+import random
+import logging
+
+import netaddr
+
+from reactor.ips import SubnetSet
+
+def _random_ip():
+    return ".".join([str(random.randint(0, 255)) for _ in range(4)])
+
+def _random_subnets(n):
+    return ["%s/%d" % (_random_ip(), random.randint(8, 32)) for _ in range(n)]
+
+def _netaddr_match(subnets, ip):
+    # The reference (per-subnet) implementation.
+    for subnet in subnets:
+        if netaddr.ip.IPAddress(ip) in netaddr.ip.IPNetwork(subnet):
+            return True
+    return False
+
+def test_subnet_set():
+    subnets = SubnetSet(["10.0.0.0/8", "192.168.1.0/24", "172.16.0.1/32"])
+    assert "10.1.2.3" in subnets
+    assert "192.168.1.255" in subnets
+    assert "172.16.0.1" in subnets
+    assert not "172.16.0.2" in subnets
+    assert not "192.168.2.1" in subnets
+    assert not "11.0.0.0" in subnets
+
+def test_subnet_set_overlapping():
+    subnets = SubnetSet(["10.0.0.0/24", "10.0.0.0/8", "10.0.1.0/24", "11.0.0.0/8"])
+    assert "10.255.255.255" in subnets
+    assert "11.0.0.0" in subnets
+    assert not "12.0.0.0" in subnets
+    assert not "9.255.255.255" in subnets
+
+def test_subnet_set_ipv6():
+    subnets = SubnetSet(["fd00::/8", "10.0.0.0/8"])
+    assert "fd12::1" in subnets
+    assert not "fe80::1" in subnets
+    assert "10.0.0.1" in subnets
+
+def test_subnet_set_invalid():
+    subnets = SubnetSet(["bogus"])
+    assert not "10.0.0.1" in subnets
+    assert not "bogus" in SubnetSet(["10.0.0.0/8"])
+
+def test_subnet_set_random():
+    subnets = _random_subnets(100)
+    compiled = SubnetSet(subnets)
+    for _ in range(1000):
+        ip = _random_ip()
+        assert (ip in compiled) == _netaddr_match(subnets, ip)
+
+def test_subnet_set_benchmark():
+    # Compare against matching each subnet with netaddr at 1k subnets.
+    subnets = _random_subnets(1000)
+    ips = [_random_ip() for _ in range(200)]
+
+    start = time.time()
+    expected = [_netaddr_match(subnets, ip) for ip in ips]
+    netaddr_time = time.time() - start
+
+    start = time.time()
+    compiled = SubnetSet(subnets)
+    compile_time = time.time() - start
+
+    start = time.time()
+    results = [ip in compiled for ip in ips]
+    match_time = time.time() - start
+
+    logging.info("Subnet matching (1000 subnets, %d clients): "
+                 "netaddr %.3fs, compile %.3fs, match %.6fs",
+                 len(ips), netaddr_time, compile_time, match_time)
+    assert results == expected
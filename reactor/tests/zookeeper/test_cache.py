@@ -0,0 +1,107 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from reactor.tests.pytest_plugin import fixture, zk_client, zk_conn
+
+@fixture()
+def ips(request):
+    from reactor.objects.ip_address import IPAddresses
+    return IPAddresses(zk_client(request), "/test/locks")
+
+@fixture()
+def locks(request):
+    from reactor.zookeeper.cache import LockCache
+    return LockCache(ips(request))
+
+def test_lock_cache_lock(locks, ips):
+    ips.add("ip1", value="foo")
+    ips.add("ip3", value="bar")
+    locks.update(ips.list())
+    assert locks.lock(["ip1", "ip2", "ip3"], value="held") == "ip2"
+    assert ips.get("ip2") == "held"
+
+    # The new lock is visible immediately.
+    assert "ip2" in locks.list()
+    assert locks.lock(["ip1", "ip2", "ip3"], value="held") is None
+
+def test_lock_cache_lock_raced(zk_conn, locks, ips):
+    # Taken by someone else, but we haven't seen it yet.
+    ips.add("ip1", value="foo")
+    zk_conn.sync()
+    locks.update([])
+    assert locks.lock(["ip1"], value="held") is None
+    assert locks.list() == ["ip1"]
+    assert ips.get("ip1") == "foo"
+
+def test_lock_cache_watch(zk_conn, locks, ips):
+    ips.add("ip1", value="foo")
+    zk_conn.sync()
+    assert locks.list() == ["ip1"]
+    ips.remove("ip1")
+    zk_conn.sync()
+    assert locks.list() == []
+
+def test_lock_cache_remove(locks, ips):
+    assert locks.lock(["ip1"], value="held") == "ip1"
+    locks.remove("ip1")
+    assert locks.list() == []
+    assert ips.list() == []
+
+def test_lock_cache_find(zk_conn, locks, ips):
+    ips.add("ip1", value="foo")
+    ips.add("ip2", value="bar")
+    zk_conn.sync()
+    assert locks.find("bar") == ["ip2"]
+
+    # Recreated with a different value, but we
+    # only saw the same list of locks in the watch.
+    ips.remove("ip2")
+    ips.add("ip2", value="baz")
+    zk_conn.sync()
+    locks._held("ip2", "bar")
+    assert locks.find("bar") == []
+    assert locks.find("baz") == ["ip2"]
+
+def test_lock_cache_remove_hook(request, ips):
+    from reactor.zookeeper.cache import LockCache
+    updates = []
+    def hook():
+        updates.append(True)
+    locks = LockCache(ips, update=hook)
+    assert locks.lock(["ip1"], value="held") == "ip1"
+    del updates[:]
+
+    # Our own releases are reported without waiting for the watch.
+    locks.remove("ip1")
+    assert updates
+
+def test_lock_cache_find_miss(zk_conn, locks, ips):
+    ips.add("ip1", value="foo")
+    zk_conn.sync()
+
+    # Taken again (with a new value) before we saw the watch.
+    locks._held("ip1", "stale")
+    assert locks.find("foo") == ["ip1"]
+    assert locks.get("ip1") == "foo"
+    assert locks.find("bar") == []
+
+def test_lock_cache_watch_values(zk_conn, locks, ips):
+    ips.add("ip1", value="foo")
+    zk_conn.sync()
+    locks._held("ip1", "stale")
+
+    # Any watch event means the values are read again.
+    locks.update(ips.list())
+    assert locks.get("ip1") == "foo"
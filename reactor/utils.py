@@ -24,6 +24,7 @@ import types
 import weakref
 import os
 import gc
+import collections
 
 from . log import log
 
@@ -81,6 +82,35 @@ def sha_hash(input_str):
 def random_key():
     return sha_hash(str(uuid.uuid4()))
 
+def memoize(size=1024):
+    """
+    A simple thread-safe LRU cache for functions with hashable arguments.
+    """
+    def _dec(fn):
+        cache = collections.OrderedDict()
+        lock = threading.Lock()
+
+        def _fn(*args):
+            with lock:
+                try:
+                    value = cache.pop(args)
+                    cache[args] = value
+                    return value
+                except KeyError:
+                    pass
+            value = fn(*args)
+            with lock:
+                cache[args] = value
+                while len(cache) > size:
+                    cache.popitem(last=False)
+            return value
+
+        _fn.__name__ = fn.__name__
+        _fn.__doc__ = fn.__doc__
+        _fn.cache = cache
+        return _fn
+    return _dec
+
 def callback(fn):
 
     def closure(ref, name=None, im_func=None):
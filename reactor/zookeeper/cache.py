@@ -13,8 +13,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import random
+
 from reactor import utils
 from reactor.atomic import Atomic
+from reactor.zookeeper.objects import JSONObject
 
 class Cache(Atomic):
 
@@ -116,3 +119,99 @@ class Cache(Atomic):
 
     def __repr__(self):
         return "cache[%s]" % self.zkobj._path
+
+class LockCache(Cache):
+
+    """
+    A watched mirror of a lock collection (see Collection.lock).
+
+    Held locks (and their values) are tracked locally, so picking free
+    candidates or finding the lock held for a given value doesn't need to
+    read the whole collection. Zookeeper is only used for the exclusive
+    create that actually takes a lock, and in find() to verify a match
+    (or to look again before reporting that there is none).
+    """
+
+    def __init__(self, zkobj, update=None):
+        super(LockCache, self).__init__(zkobj, update=update)
+
+        # Removing a lock must also update our mirror (and our user).
+        self.remove = self._remove
+
+    @Atomic.sync
+    def _held(self, name, value=None):
+        if not name in self._index:
+            self._index = sorted(self._index + [name])
+        if value:
+            self._cache[name] = value
+
+    @Atomic.sync
+    def _released(self, name):
+        if name in self._index:
+            self._index = [item for item in self._index if item != name]
+        self._cache.pop(name, None)
+
+    def _remove(self, name):
+        self.zkobj.remove(name)
+        self._released(name)
+
+        # We may not see a watch for our own change, and anyone
+        # waiting on a lock should hear about it either way.
+        self._update_hook()
+
+    def lock(self, items, value=None):
+        locked = set(self.list())
+        # NOTE: As with Collection.lock(), we shuffle the candidates
+        # to avoid colliding with other managers (and to avoid handing
+        # out the same broken backend over and over).
+        candidates = [item for item in items if not item in locked]
+        random.shuffle(candidates)
+        for item in candidates:
+            if self.zkobj._get_child(item, clazz=JSONObject)._set_data(
+                value, ephemeral=True, exclusive=True):
+                self._held(item, value)
+                return item
+            # Someone else beat us to it. We don't know
+            # the value yet, but we know that it's taken.
+            self._held(item)
+        return None
+
+    def update(self, values):
+        # A lock can be released and taken again between watches, so the
+        # list may look unchanged while the values are not. Any watch event
+        # means the values have to be read again.
+        self._forget()
+        super(LockCache, self).update(values)
+
+    @Atomic.sync
+    def _forget(self):
+        self._cache.clear()
+
+    def find(self, value):
+        found = []
+        for item in self.list():
+            if self.get(item) != value:
+                continue
+            # The lock may have been released and taken again
+            # between watches, so confirm the holder before use.
+            current = self.zkobj.get(item)
+            if current == value:
+                found.append(item)
+            elif current is None:
+                self._released(item)
+            else:
+                self._held(item, current)
+        if found:
+            return found
+
+        # The lock may also have been taken since the last watch,
+        # so check Zookeeper itself before saying there is none.
+        for item in self.zkobj.list():
+            current = self.zkobj.get(item)
+            if current is None:
+                self._released(item)
+                continue
+            self._held(item, current)
+            if current == value:
+                found.append(item)
+        return found